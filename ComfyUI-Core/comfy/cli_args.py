@@ -105,6 +105,41 @@ cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
 cache_group.add_argument("--cache-none", action="store_true", help="Reduced RAM/VRAM usage at the expense of executing every node for each run.")
+cache_group.add_argument("--cache-ram-budget", type=float, default=0, metavar="GB", help="Use byte budgeted caching: node outputs are evicted least recently used first once they hold more than GB of RAM.")
+parser.add_argument("--cache-vram-budget", type=float, default=None, metavar="GB", help="The VRAM budget for --cache-ram-budget. Defaults to a quarter of the VRAM of the torch device.")
+parser.add_argument("--cache-spill-dir", type=str, default=None, metavar="PATH", help="Write node outputs evicted from a full --cache-lru or --cache-ram-budget cache to this directory (safetensors) and load them back when they are needed again.")
+parser.add_argument("--cache-spill-size", type=float, default=10.0, metavar="GB", help="Maximum size of the --cache-spill-dir disk tier, least recently used files are removed first.")
+parser.add_argument("--persistent-cache-dir", type=str, default=None, metavar="PATH", help="Keep the outputs of opted-in nodes (PERSISTENT_CACHE = True or --persistent-cache-types) in this directory across restarts. Can be shared by several instances.")
+parser.add_argument("--persistent-cache-size", type=float, default=50.0, metavar="GB", help="Maximum size of the --persistent-cache-dir store, least recently used entries are removed first.")
+parser.add_argument("--persistent-cache-types", type=str, nargs="+", default=[], metavar="TYPE", help="Persist the outputs of every node whose outputs are all of these types, e.g. LATENT CONDITIONING.")
+parser.add_argument("--enable-common-subexpression-elimination", action="store_true", help="Merge structurally identical nodes of a prompt into one execution. Only saves work with --cache-none, --cache-lru or --max-parallel-nodes above 1, and the merged away node ids get no executing/executed messages or history outputs.")
+parser.add_argument("--cache-cost-aware", action="store_true", help="With --cache-ram-budget, evict the node outputs that are cheapest to recompute per byte first (GreedyDual-Size-Frequency) instead of the least recently used ones.")
+parser.add_argument("--scheduling-policy", type=str, default="ux", choices=["ux", "critical-path", "critical-path-memory"], help="How the next node to execute is picked. ux: output nodes and the nodes right before them first. critical-path: the node with the longest expected remaining path (from recorded execution times per node class) first. critical-path-memory: like critical-path but nodes that release the last reference to cached outputs go first.")
+parser.add_argument("--offload-sync-nodes", action="store_true", help="Run the functions of non async nodes on a dedicated thread instead of the event loop of the prompt worker, so async nodes and progress updates keep going while they execute. Implied by --max-parallel-nodes above 1.")
+
+parser.add_argument("--prompt-workers", type=int, default=1, metavar="N", help="Number of prompt executors running queued prompts concurrently, each with its own node cache (default: 1).")
+parser.add_argument("--executor-devices", type=str, nargs="+", default=None, metavar="DEVICE", help="Run one prompt worker per torch device, e.g. cuda:0 cuda:1 (the same device may be listed several times, e.g. cpu cpu). Prompts are dispatched to the worker that already has their models loaded. Overrides --prompt-workers.")
+parser.add_argument("--max-parallel-nodes", type=int, default=1, metavar="N", help="Maximum number of independent nodes of a prompt executed at the same time. Sync nodes run in a thread pool, so custom nodes must be thread safe to use values above 1 (default: 1).")
+parser.add_argument("--distributed-workers", type=str, nargs="+", default=None, metavar="URL", help="Execute parts of prompts on these ComfyUI instances (started with --distributed-worker), e.g. http://127.0.0.1:8189. Prompts are cut at the node ids listed in \"distributed_cut_points\" of extra_data or at the nodes of --distributed-cut-classes. The outputs of cut points must be tensors or primitives.")
+parser.add_argument("--distributed-cut-classes", type=str, nargs="+", default=[], metavar="CLASS", help="Node classes at which prompts are cut for --distributed-workers when extra_data doesn't list cut points, e.g. KSampler.")
+parser.add_argument("--distributed-worker", action="store_true", help="Accept subgraphs from --distributed-workers coordinators on /distributed/execute.")
+
+
+def tenant_value(value_type):
+    """The argparse type of TENANT=VALUE arguments, parsed into (tenant, value)"""
+    def parse(value):
+        name, sep, number = value.rpartition("=")
+        if sep == "" or name == "":
+            raise argparse.ArgumentTypeError(f"Expected TENANT=VALUE, got {value}")
+        return name, value_type(number)
+    return parse
+
+parser.add_argument("--fair-queue", type=str, default=None, choices=["client_id", "api_key"], help="Share execution fairly between the clients (client_id) or api keys (api_key) queueing prompts, using deficit round robin over the expected execution time of their prompts, instead of running prompts strictly in queue order. Per tenant positions are reported on /queue/tenants.")
+parser.add_argument("--fair-queue-weights", type=tenant_value(float), nargs="+", default=[], metavar="TENANT=WEIGHT", help="Relative share of --fair-queue tenants, 1 by default. Api key tenants are named key-<first 12 hex digits of the sha256 of the key>.")
+parser.add_argument("--fair-queue-max-running", type=int, default=0, metavar="N", help="Maximum number of prompts of one --fair-queue tenant executing at the same time, 0 for no limit.")
+parser.add_argument("--fair-queue-limits", type=tenant_value(int), nargs="+", default=[], metavar="TENANT=N", help="--fair-queue-max-running for specific tenants.")
+parser.add_argument("--coalesce-prompts", action="store_true", help="Execute identical prompts (same inputs, IS_CHANGED results and extra_data) only once: a prompt submitted while an identical one is queued or running gets a copy of its history entry under its own prompt_id when it finishes, and one submitted after it finished gets it right away.")
+parser.add_argument("--queue-journal", type=str, nargs="?", const="", default=None, metavar="PATH", help="Journal the prompt queue to a SQLite database so queued prompts survive a crash or restart. Uses the --database-url database (user/comfyui.db) unless a path is given.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -162,6 +197,7 @@ parser.add_argument("--multi-user", action="store_true", help="Enables per-user
 
 parser.add_argument("--verbose", default='INFO', const='DEBUG', nargs="?", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Set the logging level')
 parser.add_argument("--log-stdout", action="store_true", help="Send normal process output to stdout instead of stderr (default).")
+parser.add_argument("--profile-execution", action="store_true", help="Profile every node of every prompt (wall/CPU time, input/function/cache time, memory deltas). The profile is stored in the history and can be downloaded as a Chrome trace from /history/{prompt_id}/profile. Single prompts can opt in with \"profile\": true in extra_data.")
 
 # The default built-in provider hosted under web/
 DEFAULT_VERSION_STRING = "comfyanonymous/ComfyUI@latest"
@@ -218,22 +254,38 @@ if comfy.options.args_parsing:
 else:
     args = parser.parse_args([])
 
-if args.windows_standalone_build:
-    args.auto_launch = True
+def finalize_args(args):
+    args.fair_queue_weights = dict(args.fair_queue_weights)
+    args.fair_queue_limits = dict(args.fair_queue_limits)
 
-if args.disable_auto_launch:
-    args.auto_launch = False
+    if args.windows_standalone_build:
+        args.auto_launch = True
 
-if args.force_fp16:
-    args.fp16_unet = True
+    if args.disable_auto_launch:
+        args.auto_launch = False
 
+    if args.force_fp16:
+        args.fp16_unet = True
 
-# '--fast' is not provided, use an empty set
-if args.fast is None:
-    args.fast = set()
-# '--fast' is provided with an empty list, enable all optimizations
-elif args.fast == []:
-    args.fast = set(PerformanceFeature)
-# '--fast' is provided with a list of performance features, use that list
-else:
-    args.fast = set(args.fast)
+    # '--fast' is not provided, use an empty set
+    if args.fast is None:
+        args.fast = set()
+    # '--fast' is provided with an empty list, enable all optimizations
+    elif args.fast == []:
+        args.fast = set(PerformanceFeature)
+    # '--fast' is provided with a list of performance features, use that list
+    else:
+        args.fast = set(args.fast)
+
+finalize_args(args)
+
+
+def parse_command_line():
+    """
+    Parse the command line into args in place, for entry points that import comfy (which parses
+    an empty command line unless comfy.options.args_parsing is enabled first) before parsing it.
+    Options comfy.model_management reads when it is imported (device and VRAM state) were already
+    applied from the defaults.
+    """
+    parser.parse_args(namespace=args)
+    finalize_args(args)
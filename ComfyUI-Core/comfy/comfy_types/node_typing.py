@@ -295,6 +295,18 @@ class ComfyNodeABC(ABC):
     Comfy Docs: https://docs.comfy.org/custom-nodes/backend/lists#list-processing
     """
 
+    INPUT_IS_BATCHED: bool
+    """A flag indicating that this node can process all the items of list inputs in a single call.
+
+    Instead of being executed once for every item, the node is called once with the items stacked: tensors are concatenated along their first (batch) dimension,
+    dicts of tensors (like ``LATENT``) are concatenated key by key and other values are passed as a list with one value per item. Inputs with a single value
+    are passed as is, shared by all items. Tensor outputs are split back along their first dimension and other outputs must be lists with one value per item,
+    otherwise the node fails (it isn't executed again per item, which would repeat its side effects).
+
+    When the items can't be stacked (e.g. tensors of different sizes) the node is executed once for every item as usual. Ignored if `INPUT_IS_LIST` is set
+    or any output is in `OUTPUT_IS_LIST`.
+    """
+
     RETURN_TYPES: tuple[IO, ...]
     """A tuple representing the outputs of this node.
 
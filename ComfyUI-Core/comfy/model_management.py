@@ -16,6 +16,10 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import contextlib
+import contextvars
+import functools
+import threading
 import psutil
 import logging
 from enum import Enum
@@ -165,9 +169,28 @@ def is_ixuca():
         return True
     return False
 
+# Set by prompt workers bound to a device, see torch_device_override
+torch_device_override_var = contextvars.ContextVar("torch_device_override", default=None)
+
+@contextlib.contextmanager
+def torch_device_override(device):
+    """
+    Make get_torch_device() return device in the current context. Used to bind the prompt
+    workers of one process to different devices; the override follows the executor into its
+    event loop tasks and node threads because those copy the context.
+    """
+    token = torch_device_override_var.set(device)
+    try:
+        yield
+    finally:
+        torch_device_override_var.reset(token)
+
 def get_torch_device():
     global directml_enabled
     global cpu_state
+    device = torch_device_override_var.get()
+    if device is not None:
+        return device
     if directml_enabled:
         global directml_device
         return directml_device
@@ -416,6 +439,17 @@ except:
 
 current_loaded_models = []
 
+# Prompt workers load and unload models from several threads at once
+models_lock = threading.RLock()
+
+def with_models_lock(func):
+    """Serialize func with every other function that loads, unloads or lists current_loaded_models"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with models_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -545,6 +579,7 @@ def extra_reserved_memory():
 def minimum_inference_memory():
     return (1024 * 1024 * 1024) * 0.8 + extra_reserved_memory()
 
+@with_models_lock
 def free_memory(memory_required, device, keep_loaded=[]):
     cleanup_models_gc()
     unloaded_model = []
@@ -582,6 +617,7 @@ def free_memory(memory_required, device, keep_loaded=[]):
                 soft_empty_cache()
     return unloaded_models
 
+@with_models_lock
 def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimum_memory_required=None, force_full_load=False):
     cleanup_models_gc()
     global vram_state
@@ -661,6 +697,7 @@ def load_models_gpu(models, memory_required=0, force_patch_weights=False, minimu
 def load_model_gpu(model):
     return load_models_gpu([model])
 
+@with_models_lock
 def loaded_models(only_currently_used=False):
     output = []
     for m in current_loaded_models:
@@ -672,6 +709,7 @@ def loaded_models(only_currently_used=False):
     return output
 
 
+@with_models_lock
 def cleanup_models_gc():
     do_gc = False
     for i in range(len(current_loaded_models)):
@@ -692,6 +730,7 @@ def cleanup_models_gc():
 
 
 
+@with_models_lock
 def cleanup_models():
     to_delete = []
     for i in range(len(current_loaded_models)):
@@ -1368,6 +1407,7 @@ def soft_empty_cache(force=False):
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
 
+@with_models_lock
 def unload_all_models():
     free_memory(1e30, get_torch_device())
 
@@ -1380,23 +1420,80 @@ class InterruptProcessingException(Exception):
 
 interrupt_processing_mutex = threading.RLock()
 
+class InterruptScope:
+    """The interrupt flag of one executing prompt, see interrupt_scope"""
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.interrupted = False
+
+interrupt_scope_var = contextvars.ContextVar("interrupt_scope", default=None)
+# The InterruptScopes of the prompts executing in this process
+interrupt_scopes = set()
+
+@contextlib.contextmanager
+def interrupt_scope(prompt_id):
+    """
+    Give the prompt executed in the current context its own interrupt flag, so prompt workers
+    executing at the same time don't clear or consume each other's interrupts. Like
+    torch_device_override, the scope follows the executor into its tasks and node threads.
+    """
+    scope = InterruptScope(prompt_id)
+    with interrupt_processing_mutex:
+        interrupt_scopes.add(scope)
+    token = interrupt_scope_var.set(scope)
+    try:
+        yield scope
+    finally:
+        interrupt_scope_var.reset(token)
+        with interrupt_processing_mutex:
+            interrupt_scopes.discard(scope)
+
 interrupt_processing = False
 def interrupt_current_processing(value=True):
+    """
+    Inside an interrupt_scope, set the flag of that prompt. Elsewhere (e.g. the /interrupt route) set
+    the flag of every executing prompt.
+    """
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
+        scope = interrupt_scope_var.get()
+        if scope is not None:
+            scope.interrupted = value
+            return
         interrupt_processing = value
+        for scope in interrupt_scopes:
+            scope.interrupted = value
+
+def interrupt_prompt_processing(prompt_id):
+    """Interrupt prompt_id if it is executing, returns False if it isn't"""
+    interrupted = False
+    with interrupt_processing_mutex:
+        for scope in interrupt_scopes:
+            if scope.prompt_id == prompt_id:
+                scope.interrupted = True
+                interrupted = True
+    return interrupted
 
 def processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
+        scope = interrupt_scope_var.get()
+        if scope is not None:
+            return scope.interrupted
         return interrupt_processing
 
 def throw_exception_if_processing_interrupted():
     global interrupt_processing
     global interrupt_processing_mutex
     with interrupt_processing_mutex:
+        scope = interrupt_scope_var.get()
+        if scope is not None:
+            if scope.interrupted:
+                scope.interrupted = False
+                raise InterruptProcessingException()
+            return
         if interrupt_processing:
             interrupt_processing = False
             raise InterruptProcessingException()
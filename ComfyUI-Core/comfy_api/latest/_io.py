@@ -996,6 +996,8 @@ class Schema:
 
     Comfy Docs: https://docs.comfy.org/custom-nodes/backend/lists#list-processing
     """
+    is_input_batched: bool = False
+    """A flag indicating that this node can process all the items of list inputs in a single call, see ``INPUT_IS_BATCHED`` of V1 nodes."""
     is_output_node: bool=False
     """Flags this node as an output node, causing any inputs it requires to be executed.
 
@@ -1346,6 +1348,14 @@ class _ComfyNodeBaseInternal(_ComfyNodeInternal):
         if cls._INPUT_IS_LIST is None:
             cls.GET_SCHEMA()
         return cls._INPUT_IS_LIST
+
+    _INPUT_IS_BATCHED = None
+    @final
+    @classproperty
+    def INPUT_IS_BATCHED(cls):  # noqa
+        if cls._INPUT_IS_BATCHED is None:
+            cls.GET_SCHEMA()
+        return cls._INPUT_IS_BATCHED
     _OUTPUT_IS_LIST = None
 
     @final
@@ -1428,6 +1438,8 @@ class _ComfyNodeBaseInternal(_ComfyNodeInternal):
             cls._OUTPUT_NODE = schema.is_output_node
         if cls._INPUT_IS_LIST is None:
             cls._INPUT_IS_LIST = schema.is_input_list
+        if cls._INPUT_IS_BATCHED is None:
+            cls._INPUT_IS_BATCHED = schema.is_input_batched
         if cls._NOT_IDEMPOTENT is None:
             cls._NOT_IDEMPOTENT = schema.not_idempotent
 
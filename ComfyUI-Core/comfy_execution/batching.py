@@ -0,0 +1,118 @@
+from __future__ import annotations
+import torch
+
+from comfy_api.internal import _NodeOutputInternal
+from comfy_execution.graph_utils import ExecutionBlocker
+
+# Values of dicts (like LATENT) that don't have to be concatenated when they're equal in every item
+_SHARED_VALUE_TYPES = (int, float, bool, str, type(None))
+
+
+class BatchingError(Exception):
+    pass
+
+
+def stack_values(values):
+    """
+    The list items values combined into one batch, and the batch size of every item (None if the
+    items aren't tensors). Raises BatchingError if they can't be combined.
+    """
+    first = values[0]
+    if isinstance(first, torch.Tensor):
+        for value in values:
+            if not isinstance(value, torch.Tensor) or value.ndim == 0 or value.shape[1:] != first.shape[1:] or value.dtype != first.dtype or value.device != first.device:
+                raise BatchingError("Tensors of different shapes, types or devices")
+        return torch.cat(values), [value.shape[0] for value in values]
+    if isinstance(first, dict):
+        if not all(isinstance(value, dict) and value.keys() == first.keys() for value in values):
+            raise BatchingError("Dicts with different keys")
+        stacked = {}
+        sizes = None
+        for key in first:
+            items = [value[key] for value in values]
+            if isinstance(items[0], torch.Tensor):
+                stacked[key], key_sizes = stack_values(items)
+                if sizes is not None and key_sizes != sizes:
+                    raise BatchingError(f"Tensors of {key} have different batch sizes")
+                sizes = key_sizes
+            elif all(item is items[0] or (type(item) in _SHARED_VALUE_TYPES and item == items[0]) for item in items):
+                stacked[key] = items[0]
+            else:
+                raise BatchingError(f"Values of {key} differ")
+        if sizes is None:
+            raise BatchingError("Dicts without tensors")
+        return stacked, sizes
+    return list(values), None
+
+
+def stack_list_inputs(input_data_all, count):
+    """
+    The inputs of one call of a batch capable node for count list items, and the batch size of every
+    item (None if no tensors were stacked). None if the items can't be batched.
+    """
+    inputs = {}
+    sizes = None
+    for name, values in input_data_all.items():
+        if any(isinstance(value, ExecutionBlocker) for value in values):
+            return None
+        if len(values) == 1:
+            inputs[name] = values[0]
+            continue
+        if len(values) != count:
+            return None
+        try:
+            inputs[name], value_sizes = stack_values(values)
+        except BatchingError:
+            return None
+        if value_sizes is not None:
+            if sizes is not None and value_sizes != sizes:
+                return None
+            sizes = value_sizes
+    return inputs, sizes
+
+
+def split_value(value, count, sizes):
+    if isinstance(value, torch.Tensor) and value.ndim > 0:
+        if sizes is not None and value.shape[0] == sum(sizes):
+            return list(torch.split(value, sizes))
+        if value.shape[0] % count == 0:
+            return list(torch.split(value, value.shape[0] // count))
+        raise BatchingError(f"Can't split an output of batch size {value.shape[0]} into {count} items")
+    if isinstance(value, dict):
+        columns = {k: split_value(v, count, sizes) if isinstance(v, torch.Tensor) else [v] * count for k, v in value.items()}
+        return [{k: column[i] for k, column in columns.items()} for i in range(count)]
+    if isinstance(value, (list, tuple)) and len(value) == count:
+        return list(value)
+    raise BatchingError(f"Outputs of batched calls have to be tensors or lists of {count} values, got {type(value).__name__}")
+
+
+def split_batched_result(return_value, count, sizes):
+    """The return values of count calls, one for each list item, from the return value of one batched call"""
+    ui = None
+    if isinstance(return_value, _NodeOutputInternal):
+        if return_value.expand is not None:
+            raise BatchingError("Batched nodes can't expand subgraphs")
+        if return_value.block_execution is not None:
+            return [return_value] * count
+        result = return_value.result
+        if return_value.ui is not None:
+            ui = return_value.ui if isinstance(return_value.ui, dict) else return_value.ui.as_dict()
+    elif isinstance(return_value, dict):
+        if "expand" in return_value:
+            raise BatchingError("Batched nodes can't expand subgraphs")
+        result = return_value.get("result", None)
+        ui = return_value.get("ui", None)
+    else:
+        result = return_value
+    if isinstance(result, ExecutionBlocker):
+        return [return_value] * count
+
+    items = [{} for _ in range(count)]
+    if result is not None:
+        columns = [split_value(value, count, sizes) for value in result]
+        for i in range(count):
+            items[i]["result"] = tuple(column[i] for column in columns)
+    if ui is not None:
+        # The UI of the whole batch, merged results list the UI of every item in order anyway
+        items[0]["ui"] = ui
+    return items
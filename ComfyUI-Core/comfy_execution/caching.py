@@ -1,21 +1,29 @@
+import hashlib
 import itertools
-from typing import Sequence, Mapping, Dict
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Sequence, Mapping
 from comfy_execution.graph import DynamicPrompt
 from abc import ABC, abstractmethod
 
 import nodes
 
 from comfy_execution.graph_utils import is_link
-
-NODE_CLASS_CONTAINS_UNIQUE_ID: Dict[str, bool] = {}
+from comfy_execution.node_schema import get_node_schema
 
 
 def include_unique_id_in_input(class_type: str) -> bool:
-    if class_type in NODE_CLASS_CONTAINS_UNIQUE_ID:
-        return NODE_CLASS_CONTAINS_UNIQUE_ID[class_type]
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-    NODE_CLASS_CONTAINS_UNIQUE_ID[class_type] = "UNIQUE_ID" in class_def.INPUT_TYPES().get("hidden", {}).values()
-    return NODE_CLASS_CONTAINS_UNIQUE_ID[class_type]
+    return get_node_schema(class_def).contains_unique_id
 
 class CacheKeySet(ABC):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
@@ -58,6 +66,58 @@ def to_hashable(obj):
         # TODO - Support other objects like tensors?
         return Unhashable()
 
+SIGNATURE_DIGEST_SIZE = 20
+UNHASHABLE_DIGEST_PREFIX = "unhashable-"
+
+class _SignatureEncoding:
+    """Collects what update_signature_hash feeds a hasher, to order dict items by their encoded keys"""
+    def __init__(self):
+        self.data = bytearray()
+
+    def update(self, data):
+        self.data += data
+
+def update_signature_hash(hasher, obj):
+    """
+    Feed a canonical encoding of obj into hasher. Returns False if obj (or anything inside it)
+    can't be part of a signature, in which case the node must not share its cache entry.
+    """
+    if obj is None or isinstance(obj, (bool, int, str)):
+        hasher.update(f"{type(obj).__name__}:{obj!r};".encode())
+        return True
+    elif isinstance(obj, float):
+        if math.isnan(obj):
+            # NaN never compares equal, e.g. IS_CHANGED returning float("NaN") to always execute
+            return False
+        hasher.update(f"float:{obj!r};".encode())
+        return True
+    elif isinstance(obj, Mapping):
+        # Sorted by the encoded keys, the keys themselves may not be comparable (e.g. int and str)
+        items = []
+        for k, v in obj.items():
+            key = _SignatureEncoding()
+            if not update_signature_hash(key, k):
+                return False
+            items.append((bytes(key.data), v))
+        items.sort(key=lambda item: item[0])
+        hasher.update(b"{")
+        for key, v in items:
+            hasher.update(key)
+            if not update_signature_hash(hasher, v):
+                return False
+        hasher.update(b"}")
+        return True
+    elif isinstance(obj, Sequence):
+        hasher.update(b"[")
+        for i in obj:
+            if not update_signature_hash(hasher, i):
+                return False
+        hasher.update(b"]")
+        return True
+    else:
+        # TODO - Support other objects like tensors?
+        return False
+
 class CacheKeySetID(CacheKeySet):
     def __init__(self, dynprompt, node_ids, is_changed_cache):
         super().__init__(dynprompt, node_ids, is_changed_cache)
@@ -78,6 +138,7 @@ class CacheKeySetInputSignature(CacheKeySet):
         super().__init__(dynprompt, node_ids, is_changed_cache)
         self.dynprompt = dynprompt
         self.is_changed_cache = is_changed_cache
+        self.node_digests = {}
 
     def include_node_id_in_input(self) -> bool:
         return False
@@ -93,62 +154,262 @@ class CacheKeySetInputSignature(CacheKeySet):
             self.subcache_keys[node_id] = (node_id, node["class_type"])
 
     async def get_node_signature(self, dynprompt, node_id):
-        signature = []
-        ancestors, order_mapping = self.get_ordered_ancestry(dynprompt, node_id)
-        signature.append(await self.get_immediate_node_signature(dynprompt, node_id, order_mapping))
-        for ancestor_id in ancestors:
-            signature.append(await self.get_immediate_node_signature(dynprompt, ancestor_id, order_mapping))
-        return to_hashable(signature)
-
-    async def get_immediate_node_signature(self, dynprompt, node_id, ancestor_order_mapping):
-        if not dynprompt.has_node(node_id):
-            # This node doesn't exist -- we can't cache it.
-            return [float("NaN")]
+        """
+        Returns a fixed-size digest of the node, its constant inputs, its IS_CHANGED value and the
+        digests of its parents (a Merkle hash of the node's ancestry). Digests are memoized on the
+        key set, so signing a whole prompt visits each node once.
+        """
+        # Iterative post-order walk so that deep graphs don't hit the recursion limit
+        stack = [(node_id, False)]
+        while len(stack) > 0:
+            current_id, parents_done = stack.pop()
+            if current_id in self.node_digests:
+                continue
+            if not dynprompt.has_node(current_id):
+                # This node doesn't exist -- we can't cache it.
+                self.node_digests[current_id] = self.get_unique_digest()
+                continue
+            if not parents_done:
+                stack.append((current_id, True))
+                inputs = dynprompt.get_node(current_id)["inputs"]
+                for key in sorted(inputs.keys()):
+                    if is_link(inputs[key]) and inputs[key][0] not in self.node_digests:
+                        stack.append((inputs[key][0], False))
+                continue
+            self.node_digests[current_id] = await self.get_immediate_node_signature(dynprompt, current_id)
+        return self.node_digests[node_id]
+
+    async def get_immediate_node_signature(self, dynprompt, node_id):
+        # Expects the digests of all of the node's parents to be present in self.node_digests
         node = dynprompt.get_node(node_id)
         class_type = node["class_type"]
         class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-        signature = [class_type, await self.is_changed_cache.get(node_id)]
+        hasher = hashlib.blake2b(digest_size=SIGNATURE_DIGEST_SIZE)
+        hashable = update_signature_hash(hasher, class_type)
+        hashable &= update_signature_hash(hasher, await self.is_changed_cache.get(node_id))
         if self.include_node_id_in_input() or (hasattr(class_def, "NOT_IDEMPOTENT") and class_def.NOT_IDEMPOTENT) or include_unique_id_in_input(class_type):
-            signature.append(node_id)
+            hashable &= update_signature_hash(hasher, node_id)
         inputs = node["inputs"]
         for key in sorted(inputs.keys()):
+            hashable &= update_signature_hash(hasher, key)
             if is_link(inputs[key]):
                 (ancestor_id, ancestor_socket) = inputs[key]
-                ancestor_index = ancestor_order_mapping[ancestor_id]
-                signature.append((key,("ANCESTOR", ancestor_index, ancestor_socket)))
+                hasher.update(b"ANCESTOR:" + self.node_digests[ancestor_id].encode())
+                hashable &= update_signature_hash(hasher, ancestor_socket)
             else:
-                signature.append((key, inputs[key]))
-        return signature
-
-    # This function returns a list of all ancestors of the given node. The order of the list is
-    # deterministic based on which specific inputs the ancestor is connected by.
-    def get_ordered_ancestry(self, dynprompt, node_id):
-        ancestors = []
-        order_mapping = {}
-        self.get_ordered_ancestry_internal(dynprompt, node_id, ancestors, order_mapping)
-        return ancestors, order_mapping
-
-    def get_ordered_ancestry_internal(self, dynprompt, node_id, ancestors, order_mapping):
-        if not dynprompt.has_node(node_id):
+                hashable &= update_signature_hash(hasher, inputs[key])
+        if not hashable:
+            return self.get_unique_digest()
+        return hasher.hexdigest()
+
+    def get_unique_digest(self):
+        # Used for nodes that can't be signed. Like the NaN in the old nested signatures, it never
+        # matches the signature of any other node.
+        return UNHASHABLE_DIGEST_PREFIX + uuid.uuid4().hex
+
+class SpillFormatError(Exception):
+    pass
+
+def flatten_spill_value(value, tensors):
+    # Replace the tensors in a node output by references into `tensors`, raising SpillFormatError
+    # if the output contains anything that can't be written as JSON plus tensors.
+    torch = sys.modules.get("torch")
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif torch is not None and isinstance(value, torch.Tensor):
+        name = str(len(tensors))
+        tensors[name] = value
+        return {"__tensor__": name, "device": str(value.device)}
+    elif isinstance(value, (list, tuple)):
+        return {"__list__": [flatten_spill_value(v, tensors) for v in value], "tuple": isinstance(value, tuple)}
+    elif isinstance(value, dict) and all(isinstance(k, str) for k in value.keys()):
+        return {"__dict__": {k: flatten_spill_value(v, tensors) for k, v in value.items()}}
+    raise SpillFormatError(f"Can't spill a value of type {type(value).__name__}")
+
+def unflatten_spill_value(value, tensors):
+    if isinstance(value, dict):
+        if "__tensor__" in value:
+            tensor = tensors[value["__tensor__"]]
+            if value["device"] != "cpu":
+                try:
+                    tensor = tensor.to(value["device"])
+                except (RuntimeError, AssertionError):
+                    pass
+            return tensor
+        elif "__list__" in value:
+            items = [unflatten_spill_value(v, tensors) for v in value["__list__"]]
+            return tuple(items) if value["tuple"] else items
+        elif "__dict__" in value:
+            return {k: unflatten_spill_value(v, tensors) for k, v in value["__dict__"].items()}
+    return value
+
+class SafetensorsFileStore:
+    """
+    Stores node outputs on local disk, one safetensors file per cache key. The tensors go in the
+    file, the surrounding lists and primitives are stored as JSON in its metadata. Files are
+    loaded back through mmap. Outputs holding anything else (models, arbitrary objects) are not
+    stored. The store has its own size cap and removes least recently used files first.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = OrderedDict() # cache key -> file size
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def can_store_key(key):
+        return isinstance(key, str) and not key.startswith(UNHASHABLE_DIGEST_PREFIX)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".safetensors")
+
+    def store(self, key, value):
+        if not self.can_store_key(key):
+            return False
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+        try:
+            tensors = {}
+            structure = flatten_spill_value(value, tensors)
+        except SpillFormatError:
+            return False
+        if len(tensors) == 0:
+            return False
+        import safetensors.torch
+        # safetensors needs contiguous CPU tensors that don't share memory
+        tensors = {name: t.detach().to("cpu", copy=True).contiguous() for name, t in tensors.items()}
+        path = self.get_path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            safetensors.torch.save_file(tensors, temp_path, metadata={"structure": json.dumps(structure)})
+            # Readers (possibly other processes sharing the directory) never see a partial file
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.warning(f"Failed to write cache entry to {path}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+        size = os.path.getsize(path)
+        with self.lock:
+            self.entries[key] = size
+            self.size += size
+            while self.size > self.max_size and len(self.entries) > 0:
+                self._remove(next(iter(self.entries)))
+        return True
+
+    def load(self, key):
+        if not self.can_store_key(key):
+            return None
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        import safetensors
+        path = self.get_path(key)
+        try:
+            with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+                structure = json.loads(f.metadata()["structure"])
+                tensors = {name: f.get_tensor(name) for name in f.keys()}
+        except Exception as e:
+            logging.warning(f"Failed to load cache entry {path}: {e}")
+            with self.lock:
+                self._remove(key)
+            return None
+        return unflatten_spill_value(structure, tensors)
+
+    def _remove(self, key):
+        size = self.entries.pop(key, None)
+        if size is None:
             return
-        inputs = dynprompt.get_node(node_id)["inputs"]
-        input_keys = sorted(inputs.keys())
-        for key in input_keys:
-            if is_link(inputs[key]):
-                ancestor_id = inputs[key][0]
-                if ancestor_id not in order_mapping:
-                    ancestors.append(ancestor_id)
-                    order_mapping[ancestor_id] = len(ancestors) - 1
-                    self.get_ordered_ancestry_internal(dynprompt, ancestor_id, ancestors, order_mapping)
+        self.size -= size
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+class DiskSpillTier(SafetensorsFileStore):
+    """
+    A second cache tier on local disk: outputs evicted from a cache are stored here and loaded
+    back on a later hit. Each tier uses a private subdirectory that is removed with the tier.
+    """
+    def __init__(self, directory, max_size):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(tempfile.mkdtemp(prefix="spill-", dir=directory), max_size)
+        weakref.finalize(self, shutil.rmtree, self.directory, True)
+
+class PersistentResultStore(SafetensorsFileStore):
+    """
+    A content addressed store of node outputs that survives restarts. Files are named after the
+    node signature digest of CacheKeySetInputSignature, which only depends on the node, its inputs
+    and its ancestry, so any process sharing the directory can reuse them.
+
+    Only outputs of opted-in nodes are stored: classes with PERSISTENT_CACHE = True, or nodes whose
+    output types are all in output_types. Such nodes must be deterministic.
+    """
+    def __init__(self, directory, max_size, output_types=()):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, max_size)
+        self.output_types = frozenset(output_types)
+        files = []
+        for name in os.listdir(directory):
+            key, ext = os.path.splitext(name)
+            if ext == ".safetensors" and self.can_store_key(key):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, key, stat.st_size))
+        # Least recently used first, load() touches the files so the order survives restarts
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        logging.info("Persistent result store {} holds {} entries ({:.2f} GB)".format(directory, len(self.entries), self.size / (1024 ** 3)))
+
+    @staticmethod
+    def can_store_key(key):
+        return isinstance(key, str) and len(key) > 0 and all(c in "0123456789abcdef" for c in key)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".safetensors")
+
+    def accepts(self, class_def):
+        if getattr(class_def, "PERSISTENT_CACHE", False):
+            return True
+        return_types = class_def.RETURN_TYPES
+        return len(self.output_types) > 0 and len(return_types) > 0 and all(t in self.output_types for t in return_types)
+
+    def load(self, key):
+        if not self.can_store_key(key):
+            return None
+        path = self.get_path(key)
+        with self.lock:
+            if key not in self.entries:
+                # Possibly written by another process sharing the directory
+                if not os.path.exists(path):
+                    return None
+                size = os.path.getsize(path)
+                self.entries[key] = size
+                self.size += size
+        value = super().load(key)
+        if value is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return value
 
 class BasicCache:
-    def __init__(self, key_class):
+    def __init__(self, key_class, spill_tier=None):
         self.key_class = key_class
         self.initialized = False
         self.dynprompt: DynamicPrompt
         self.cache_key_set: CacheKeySet
         self.cache = {}
         self.subcaches = {}
+        self.spill_tier = spill_tier
+        self.persistent_store = None
 
     async def set_prompt(self, dynprompt, node_ids, is_changed_cache):
         self.dynprompt = dynprompt
@@ -173,6 +434,16 @@ class BasicCache:
         for key in to_remove:
             del self.cache[key]
 
+    def _spill(self, key, value):
+        # Called for entries evicted because the cache is full (not for every entry a prompt stops using),
+        # returns whether the tier stored it
+        if self.spill_tier is not None:
+            return self.spill_tier.store(key, value)
+        return False
+
+    def _restore_from_disk(self, node_id, cache_key, value):
+        self.cache[cache_key] = value
+
     def _clean_subcaches(self):
         preserve_subcaches = set(self.cache_key_set.get_used_subcache_keys())
 
@@ -192,6 +463,18 @@ class BasicCache:
         assert self.initialized
         cache_key = self.cache_key_set.get_data_key(node_id)
         self.cache[cache_key] = value
+        if self._is_persistent(node_id):
+            self.persistent_store.store(cache_key, value)
+
+    def _is_persistent(self, node_id):
+        if self.persistent_store is None or not self.dynprompt.has_node(node_id):
+            return False
+        class_type = self.dynprompt.get_node(node_id)["class_type"]
+        return self.persistent_store.accepts(nodes.NODE_CLASS_MAPPINGS[class_type])
+
+    def set_execution_cost(self, node_id, seconds):
+        # How long node_id took to produce the value that is about to be set. Only used by CostAwareCache.
+        pass
 
     def _get_immediate(self, node_id):
         if not self.initialized:
@@ -199,14 +482,23 @@ class BasicCache:
         cache_key = self.cache_key_set.get_data_key(node_id)
         if cache_key in self.cache:
             return self.cache[cache_key]
-        else:
+        elif cache_key is None:
             return None
+        value = None
+        if self.spill_tier is not None:
+            value = self.spill_tier.load(cache_key)
+        if value is None and self._is_persistent(node_id):
+            value = self.persistent_store.load(cache_key)
+        if value is not None:
+            self._restore_from_disk(node_id, cache_key, value)
+        return value
 
     async def _ensure_subcache(self, node_id, children_ids):
         subcache_key = self.cache_key_set.get_subcache_key(node_id)
         subcache = self.subcaches.get(subcache_key, None)
         if subcache is None:
-            subcache = BasicCache(self.key_class)
+            subcache = BasicCache(self.key_class, spill_tier=self.spill_tier)
+            subcache.persistent_store = self.persistent_store
             self.subcaches[subcache_key] = subcache
         await subcache.set_prompt(self.dynprompt, children_ids, self.is_changed_cache)
         return subcache
@@ -219,6 +511,9 @@ class BasicCache:
         else:
             return None
 
+    def get_entry_count(self):
+        return len(self.cache) + sum(subcache.get_entry_count() for subcache in list(self.subcaches.values()))
+
     def recursive_debug_dump(self):
         result = []
         for key in self.cache:
@@ -228,8 +523,8 @@ class BasicCache:
         return result
 
 class HierarchicalCache(BasicCache):
-    def __init__(self, key_class):
-        super().__init__(key_class)
+    def __init__(self, key_class, spill_tier=None):
+        super().__init__(key_class, spill_tier=spill_tier)
 
     def _get_cache_for(self, node_id):
         assert self.dynprompt is not None
@@ -266,8 +561,8 @@ class HierarchicalCache(BasicCache):
         return await cache._ensure_subcache(node_id, children_ids)
 
 class LRUCache(BasicCache):
-    def __init__(self, key_class, max_size=100):
-        super().__init__(key_class)
+    def __init__(self, key_class, max_size=100, spill_tier=None):
+        super().__init__(key_class, spill_tier=spill_tier)
         self.max_size = max_size
         self.min_generation = 0
         self.generation = 0
@@ -285,6 +580,7 @@ class LRUCache(BasicCache):
             self.min_generation += 1
             to_remove = [key for key in self.cache if self.used_generation[key] < self.min_generation]
             for key in to_remove:
+                self._spill(key, self.cache[key])
                 del self.cache[key]
                 del self.used_generation[key]
                 if key in self.children:
@@ -318,6 +614,244 @@ class LRUCache(BasicCache):
         return self
 
 
+MEMORY_USAGE_MAX_DEPTH = 8
+
+def estimate_memory_usage(obj) -> tuple[int, int]:
+    """
+    Estimate the memory held by a cached value, returned as (ram_bytes, vram_bytes).
+
+    Walks nested lists, tuples, dicts and object attributes. Tensors are counted by their storage
+    (shared storages and views only once) and assigned to RAM or VRAM by device. Objects with a
+    model_size() method (model patchers) are counted as a whole, their loaded_size() as VRAM.
+    """
+    torch = sys.modules.get("torch")
+    ram = 0
+    vram = 0
+    seen = set()
+    seen_storages = set()
+    stack = [(obj, 0)]
+    while len(stack) > 0:
+        current, depth = stack.pop()
+        if current is None or isinstance(current, (bool, int, float)) or id(current) in seen:
+            continue
+        seen.add(id(current))
+        if torch is not None and isinstance(current, torch.Tensor):
+            try:
+                storage = current.untyped_storage()
+                storage_key = (current.device, storage.data_ptr())
+                if storage_key in seen_storages:
+                    continue
+                seen_storages.add(storage_key)
+                size = storage.nbytes()
+            except (NotImplementedError, RuntimeError):
+                size = current.nelement() * current.element_size()
+            if current.device.type == "cpu":
+                ram += size
+            else:
+                vram += size
+        elif isinstance(current, (str, bytes, bytearray)):
+            ram += len(current)
+        elif isinstance(current, Mapping):
+            ram += sys.getsizeof(current)
+            stack.extend((v, depth + 1) for v in current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            ram += sys.getsizeof(current)
+            stack.extend((v, depth + 1) for v in current)
+        elif callable(getattr(current, "model_size", None)):
+            total = current.model_size()
+            loaded = current.loaded_size() if callable(getattr(current, "loaded_size", None)) else 0
+            ram += max(total - loaded, 0)
+            vram += loaded
+        elif isinstance(getattr(current, "nbytes", None), int):
+            # numpy arrays and similar buffers
+            ram += current.nbytes
+        elif depth < MEMORY_USAGE_MAX_DEPTH and hasattr(current, "__dict__"):
+            stack.extend((v, depth + 1) for v in vars(current).values())
+    return ram, vram
+
+class ByteBudgetCache(BasicCache):
+    """
+    An LRU cache that evicts by the memory held by its entries instead of their number.
+    RAM and VRAM are budgeted separately (in bytes); once a budget is exceeded, the least recently
+    used entries holding that kind of memory are dropped. Like LRUCache, entries used by the
+    current prompt are never evicted.
+    """
+    def __init__(self, key_class, ram_budget, vram_budget, spill_tier=None):
+        super().__init__(key_class, spill_tier=spill_tier)
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        self.generation = 0
+        self.used_generation = {}
+        self.children = {}
+        self.entry_sizes = {}
+        self.ram_used = 0
+        self.vram_used = 0
+
+    async def set_prompt(self, dynprompt, node_ids, is_changed_cache):
+        await super().set_prompt(dynprompt, node_ids, is_changed_cache)
+        self.generation += 1
+        for node_id in node_ids:
+            self._mark_used(node_id)
+
+    def is_over_budget(self):
+        return self.ram_used > self.ram_budget or self.vram_used > self.vram_budget
+
+    def _eviction_order(self, candidates):
+        return sorted(candidates, key=lambda key: self.used_generation.get(key, 0))
+
+    def _evict(self):
+        if not self.is_over_budget():
+            return
+        candidates = [key for key in self.cache if self.used_generation.get(key, 0) < self.generation]
+        for key in self._eviction_order(candidates):
+            ram_over = self.ram_used > self.ram_budget
+            vram_over = self.vram_used > self.vram_budget
+            if not (ram_over or vram_over):
+                break
+            ram, vram = self.entry_sizes.get(key, (0, 0))
+            if (ram_over and ram > 0) or (vram_over and vram > 0):
+                self._remove_key(key)
+
+    def _remove_key(self, key):
+        self._spill(key, self.cache[key])
+        del self.cache[key]
+        self.used_generation.pop(key, None)
+        self.children.pop(key, None)
+        ram, vram = self.entry_sizes.pop(key, (0, 0))
+        self.ram_used -= ram
+        self.vram_used -= vram
+
+    def clean_unused(self):
+        self._evict()
+        self._clean_subcaches()
+
+    def get(self, node_id):
+        self._mark_used(node_id)
+        return self._get_immediate(node_id)
+
+    def _mark_used(self, node_id):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is not None:
+            self.used_generation[cache_key] = self.generation
+
+    def set(self, node_id, value):
+        self._mark_used(node_id)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        self._account(cache_key, value)
+        self._set_immediate(node_id, value)
+        self._evict()
+
+    def _account(self, cache_key, value):
+        ram, vram = self.entry_sizes.pop(cache_key, (0, 0))
+        self.ram_used -= ram
+        self.vram_used -= vram
+        ram, vram = estimate_memory_usage(value)
+        self.entry_sizes[cache_key] = (ram, vram)
+        self.ram_used += ram
+        self.vram_used += vram
+
+    def _restore_from_disk(self, node_id, cache_key, value):
+        self._account(cache_key, value)
+        self.cache[cache_key] = value
+        self._evict()
+
+    async def ensure_subcache_for(self, node_id, children_ids):
+        # Just uses subcaches for tracking 'live' nodes
+        await super()._ensure_subcache(node_id, children_ids)
+
+        await self.cache_key_set.add_keys(children_ids)
+        self._mark_used(node_id)
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        self.children[cache_key] = []
+        for child_id in children_ids:
+            self._mark_used(child_id)
+            self.children[cache_key].append(self.cache_key_set.get_data_key(child_id))
+        return self
+
+    def get_memory_usage(self):
+        return {
+            "entries": len(self.cache),
+            "ram_used": self.ram_used,
+            "ram_budget": self.ram_budget,
+            "vram_used": self.vram_used,
+            "vram_budget": self.vram_budget,
+        }
+
+
+class CostAwareCache(ByteBudgetCache):
+    """
+    A ByteBudgetCache that evicts with GreedyDual-Size-Frequency instead of recency.
+
+    Every entry gets the priority L + frequency * cost / size, where cost is the time the node took
+    to produce the output, size its estimated memory and frequency the number of prompts that used
+    it. The entry with the lowest priority is evicted first and L is raised to its priority, so
+    entries that haven't been used for a while age out. Slow, frequently reused outputs (loaded
+    checkpoints, text encodings) stay cached while cheap, large intermediates go first.
+    """
+    def __init__(self, key_class, ram_budget, vram_budget, spill_tier=None):
+        super().__init__(key_class, ram_budget, vram_budget, spill_tier=spill_tier)
+        self.inflation = 0.0
+        self.costs = {}
+        self.frequency = {}
+        self.priority = {}
+        self.spilled_stats = {} # cache key -> (cost, frequency) of entries in the spill tier
+
+    def set_execution_cost(self, node_id, seconds):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is not None:
+            self.costs[cache_key] = seconds
+
+    def _update_priority(self, cache_key):
+        ram, vram = self.entry_sizes.get(cache_key, (0, 0))
+        cost = self.costs.get(cache_key, 0.0)
+        self.priority[cache_key] = self.inflation + self.frequency.get(cache_key, 1) * cost / max(ram + vram, 1)
+
+    def _mark_used(self, node_id):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        if cache_key is not None and cache_key in self.cache and self.used_generation.get(cache_key) != self.generation:
+            # Count each prompt that uses the entry once, get() is called several times per prompt
+            self.frequency[cache_key] = self.frequency.get(cache_key, 1) + 1
+            self._update_priority(cache_key)
+        super()._mark_used(node_id)
+
+    def set(self, node_id, value):
+        cache_key = self.cache_key_set.get_data_key(node_id)
+        self.frequency.setdefault(cache_key, 1)
+        super().set(node_id, value)
+        self._update_priority(cache_key)
+
+    def _eviction_order(self, candidates):
+        for key in candidates:
+            if key not in self.priority:
+                self._update_priority(key)
+        return sorted(candidates, key=lambda key: self.priority[key])
+
+    def _remove_key(self, key):
+        self.inflation = max(self.inflation, self.priority.pop(key, self.inflation))
+        super()._remove_key(key)
+        self.costs.pop(key, None)
+        self.frequency.pop(key, None)
+
+    def _spill(self, key, value):
+        stored = super()._spill(key, value)
+        if stored:
+            self.spilled_stats[key] = (self.costs.get(key, 0.0), self.frequency.get(key, 1))
+            if len(self.spilled_stats) > 2 * len(self.spill_tier.entries):
+                # Forget the entries the tier has dropped in the meantime
+                with self.spill_tier.lock:
+                    self.spilled_stats = {k: v for k, v in self.spilled_stats.items() if k in self.spill_tier.entries}
+        return stored
+
+    def _restore_from_disk(self, node_id, cache_key, value):
+        cost, frequency = self.spilled_stats.pop(cache_key, (0.0, 0))
+        self.costs[cache_key] = cost
+        # Counts the prompt that is using it now
+        self.frequency[cache_key] = frequency + 1
+        super()._restore_from_disk(node_id, cache_key, value)
+        if cache_key in self.cache:
+            self._update_priority(cache_key)
+
+
 class DependencyAwareCache(BasicCache):
     """
     A cache implementation that tracks dependencies between nodes and manages
@@ -0,0 +1,100 @@
+from __future__ import annotations
+import hashlib
+
+import execution
+from comfy_execution.caching import CacheKeySetInputSignature, UNHASHABLE_DIGEST_PREFIX, update_signature_hash
+from comfy_execution.graph import DynamicPrompt
+
+# extra_data that doesn't change what a prompt computes
+IGNORED_EXTRA_DATA_KEYS = ("client_id",)
+
+
+async def get_prompt_digest(prompt_id, prompt, outputs_to_execute, extra_data):
+    """
+    A digest of everything that determines the results of a prompt: the cache signatures of its outputs
+    (which include the IS_CHANGED results of their ancestors), which outputs are executed and the
+    extra_data nodes can read. None if the prompt can't be coalesced, e.g. because a node is always
+    executed again.
+    """
+    dynprompt = DynamicPrompt(prompt)
+    is_changed_cache = execution.IsChangedCache(prompt_id, dynprompt, None)
+    key_set = CacheKeySetInputSignature(dynprompt, [], is_changed_cache)
+    hasher = hashlib.blake2b(digest_size=20)
+    for node_id in sorted(outputs_to_execute):
+        hasher.update(node_id.encode() + b":" + (await key_set.get_node_signature(dynprompt, node_id)).encode() + b";")
+    if any(digest.startswith(UNHASHABLE_DIGEST_PREFIX) for digest in key_set.node_digests.values()):
+        return None
+    if not update_signature_hash(hasher, {k: v for k, v in extra_data.items() if k not in IGNORED_EXTRA_DATA_KEYS}):
+        return None
+    return hasher.hexdigest()
+
+
+class PromptCoalescer:
+    """
+    Tracks the digests (see get_prompt_digest) of queued and executing prompts, so a prompt identical
+    to one of them is attached to it instead of being executed again, and of recently finished ones,
+    so it can be answered from their history entry.
+
+    The first prompt with a digest leads. Prompts with the same digest submitted while it is queued or
+    running follow it: they aren't queued and get a copy of its history entry when it finishes. If the
+    leader fails or is deleted, its first follower is queued in its place and leads the others.
+
+    Not thread safe, PromptQueue calls it with its mutex held.
+    """
+    def __init__(self, max_finished=execution.MAXIMUM_HISTORY_SIZE):
+        self.max_finished = max_finished
+        self.leaders = {} # digest -> prompt_id of the queued or running prompt
+        self.digests = {} # prompt_id of a leader -> digest
+        self.followers = {} # prompt_id of a leader -> items attached to it, in submission order
+        self.finished = {} # digest -> prompt_id of its last successful execution, oldest first
+
+    def find(self, digest):
+        """(prompt_id, finished) of the prompt a prompt with digest can attach to, (None, False) if none"""
+        prompt_id = self.leaders.get(digest)
+        if prompt_id is not None:
+            return prompt_id, False
+        prompt_id = self.finished.get(digest)
+        if prompt_id is not None:
+            return prompt_id, True
+        return None, False
+
+    def lead(self, prompt_id, digest):
+        self.leaders[digest] = prompt_id
+        self.digests[prompt_id] = digest
+        self.followers[prompt_id] = []
+
+    def follow(self, leader_id, item):
+        self.followers[leader_id].append(item)
+
+    def finish(self, prompt_id, success):
+        """The digest and the followers of prompt_id, which is no longer queued or running"""
+        digest = self.digests.pop(prompt_id, None)
+        if digest is None:
+            return None, []
+        del self.leaders[digest]
+        followers = self.followers.pop(prompt_id)
+        self.finished.pop(digest, None)
+        if success:
+            self.finished[digest] = prompt_id
+            while len(self.finished) > self.max_finished:
+                del self.finished[next(iter(self.finished))]
+        return digest, followers
+
+    def forget_finished(self, digest):
+        # The history entry of the finished prompt was deleted
+        self.finished.pop(digest, None)
+
+    def remove_follower(self, function):
+        """Remove and return the first follower for which function returns True"""
+        for followers in self.followers.values():
+            for item in followers:
+                if function(item):
+                    followers.remove(item)
+                    return item
+        return None
+
+    def get_followers(self):
+        return [item for followers in self.followers.values() for item in followers]
+
+    def get_follower_count(self):
+        return sum(len(followers) for followers in self.followers.values())
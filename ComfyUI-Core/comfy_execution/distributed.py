@@ -0,0 +1,307 @@
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import json
+import logging
+import struct
+import threading
+import traceback
+from typing import NamedTuple
+
+import aiohttp
+from aiohttp import web
+
+import comfy.model_management
+import execution
+from comfy_execution.caching import SpillFormatError, flatten_spill_value, unflatten_spill_value
+from comfy_execution.graph_utils import is_link
+
+EXECUTE_PATH = "/distributed/execute"
+INTERRUPT_POLL_INTERVAL = 0.1
+
+
+class DistributedExecutionError(Exception):
+    """A subgraph failed on (or couldn't be sent to) a worker, node_id is the node to report it on"""
+    def __init__(self, node_id, message, exception_type=None, traceback_lines=None):
+        super().__init__(message)
+        self.node_id = node_id
+        self.message = message
+        self.exception_type = exception_type or "DistributedExecutionError"
+        self.traceback_lines = traceback_lines or []
+
+    def as_dict(self):
+        return {
+            "node_id": self.node_id,
+            "exception_message": self.message,
+            "exception_type": self.exception_type,
+            "traceback": self.traceback_lines,
+        }
+
+    @classmethod
+    def from_dict(cls, error, default_node_id):
+        node_id = error.get("node_id")
+        return cls(node_id if node_id is not None else default_node_id, error.get("exception_message", ""), error.get("exception_type"), error.get("traceback"))
+
+
+def encode_payload(header, values) -> bytes:
+    """
+    Serialize header (JSON) and values ({node_id: node output}) as a single safetensors buffer.
+    The tensors are stored as raw tensor data, everything around them as JSON in the metadata.
+    Raises SpillFormatError if an output holds anything else (models, arbitrary objects).
+    """
+    import safetensors.torch
+    tensors = {}
+    structure = {node_id: flatten_spill_value(value, tensors) for node_id, value in values.items()}
+    # safetensors needs contiguous CPU tensors that don't share memory
+    tensors = {name: t.detach().to("cpu", copy=True).contiguous() for name, t in tensors.items()}
+    return safetensors.torch.save(tensors, metadata={"header": json.dumps(header), "structure": json.dumps(structure)})
+
+
+def decode_payload(data: bytes):
+    """The (header, values) of a buffer written by encode_payload"""
+    import safetensors.torch
+    header_size = struct.unpack("<Q", data[:8])[0]
+    metadata = json.loads(data[8:8 + header_size]).get("__metadata__", {})
+    tensors = safetensors.torch.load(data)
+    structure = json.loads(metadata["structure"])
+    values = {node_id: unflatten_spill_value(value, tensors) for node_id, value in structure.items()}
+    return json.loads(metadata["header"]), values
+
+
+def get_linked_nodes(node):
+    return [value[0] for value in node["inputs"].values() if is_link(value)]
+
+
+def get_ancestors(prompt, node_ids, stop_at=()):
+    """node_ids and every node they (transitively) link to, without descending into stop_at"""
+    visited = set()
+    stack = list(node_ids)
+    while len(stack) > 0:
+        node_id = stack.pop()
+        if node_id in visited:
+            continue
+        visited.add(node_id)
+        if node_id in stop_at:
+            continue
+        stack.extend(get_linked_nodes(prompt[node_id]))
+    return visited
+
+
+class Subgraph(NamedTuple):
+    cut_point: str
+    node_ids: frozenset # the nodes executed remotely, cut_point included
+    dependencies: frozenset # the other cut points whose outputs it receives
+
+
+def partition_prompt(prompt, cut_points) -> dict[str, Subgraph]:
+    """
+    Split prompt into one subgraph per cut point: the cut point and its ancestors, stopping at other
+    cut points, which become dependencies of the subgraph. Nodes feeding several cut points (e.g.
+    model loaders) are part of each of their subgraphs.
+    """
+    cut_points = set(cut_points)
+    subgraphs = {}
+    for cut_point in cut_points:
+        node_ids = set()
+        dependencies = set()
+        stack = [cut_point]
+        while len(stack) > 0:
+            node_id = stack.pop()
+            if node_id in node_ids:
+                continue
+            node_ids.add(node_id)
+            for linked_id in get_linked_nodes(prompt[node_id]):
+                if linked_id in cut_points:
+                    dependencies.add(linked_id)
+                else:
+                    stack.append(linked_id)
+        subgraphs[cut_point] = Subgraph(cut_point, frozenset(node_ids), frozenset(dependencies))
+    return subgraphs
+
+
+class DistributedCoordinator:
+    """
+    Executes parts of a prompt on other ComfyUI processes (started with --distributed-worker).
+
+    The prompt is cut at cut points: the node ids listed in extra_data["distributed_cut_points"],
+    otherwise every node whose class is in cut_classes. Each cut point and its ancestors up to the
+    other cut points form a subgraph, which is sent to the least busy worker together with the
+    outputs of the cut points it depends on. Independent subgraphs run at the same time. The worker
+    returns the output of the cut point, which is stored in caches.outputs, so the rest of the
+    prompt then executes locally as if the cut point had been cached.
+
+    Outputs cross processes as safetensors buffers, so the outputs of cut points must be tensors,
+    primitives and lists/dicts of them (LATENT, IMAGE, CONDITIONING, ...), not models. Only the
+    cut points the local part of the prompt links to (and their dependencies) are executed and,
+    since the partition is static, lazy inputs are treated as needed.
+    """
+    def __init__(self, worker_urls, cut_classes=()):
+        if len(worker_urls) == 0:
+            raise ValueError("At least one distributed worker url is required")
+        self.worker_urls = [url.rstrip("/") for url in worker_urls]
+        self.cut_classes = set(cut_classes)
+        self.lock = threading.Lock()
+        self.in_flight = {url: 0 for url in self.worker_urls}
+
+    def get_cut_points(self, prompt, extra_data, execute_outputs):
+        cut_points = extra_data.get("distributed_cut_points")
+        if cut_points is None:
+            cut_points = [node_id for node_id, node in prompt.items() if node["class_type"] in self.cut_classes]
+        # Output nodes run locally so their UI outputs end up in the history
+        return [node_id for node_id in cut_points if node_id in prompt and node_id not in execute_outputs]
+
+    def get_needed_subgraphs(self, prompt, subgraphs, execute_outputs, outputs_cache):
+        local_nodes = get_ancestors(prompt, execute_outputs, stop_at=subgraphs.keys())
+        needed = {}
+        stack = [node_id for node_id in local_nodes if node_id in subgraphs]
+        while len(stack) > 0:
+            cut_point = stack.pop()
+            if cut_point in needed or outputs_cache.get(cut_point) is not None:
+                continue
+            needed[cut_point] = subgraphs[cut_point]
+            stack.extend(subgraphs[cut_point].dependencies)
+        return needed
+
+    def acquire_worker(self):
+        with self.lock:
+            url = min(self.worker_urls, key=lambda u: self.in_flight[u])
+            self.in_flight[url] += 1
+            return url
+
+    def release_worker(self, url):
+        with self.lock:
+            self.in_flight[url] -= 1
+
+    async def execute_subgraph(self, session, prompt, prompt_id, subgraph, inputs, used_urls):
+        cut_point = subgraph.cut_point
+        # The worker gets all ancestors, so its cache keys match ours, but only executes the subgraph
+        sub_prompt = {}
+        for node_id in get_ancestors(prompt, [cut_point]):
+            sub_prompt[node_id] = {"class_type": prompt[node_id]["class_type"], "inputs": prompt[node_id]["inputs"]}
+        try:
+            body = encode_payload({"prompt_id": prompt_id, "prompt": sub_prompt, "outputs": [cut_point]}, inputs)
+        except SpillFormatError as e:
+            raise DistributedExecutionError(cut_point, f"The inputs of the subgraph ending at node {cut_point} can't be sent to a worker: {e}")
+
+        url = self.acquire_worker()
+        used_urls.add(url)
+        try:
+            async with session.post(url + EXECUTE_PATH, data=body, headers={"Content-Type": "application/octet-stream"}) as response:
+                data = await response.read()
+                if response.status != 200:
+                    try:
+                        error = json.loads(data)["error"]
+                    except (ValueError, KeyError, TypeError):
+                        error = {"exception_message": f"{url} returned status {response.status}"}
+                    raise DistributedExecutionError.from_dict(error, cut_point)
+        except aiohttp.ClientError as e:
+            raise DistributedExecutionError(cut_point, f"Failed to execute the subgraph ending at node {cut_point} on {url}: {e}")
+        finally:
+            self.release_worker(url)
+        _, values = decode_payload(data)
+        logging.debug(f"Executed the subgraph ending at node {cut_point} ({len(subgraph.node_ids)} nodes) on {url}")
+        return values[cut_point]
+
+    async def interrupt_workers(self, session, urls, prompt_id):
+        for url in urls:
+            try:
+                # Only the subgraphs of this prompt, the workers may execute others at the same time
+                async with session.post(url + "/interrupt", json={"prompt_id": prompt_id}) as response:
+                    await response.read()
+            except aiohttp.ClientError as e:
+                logging.warning(f"Failed to interrupt distributed worker {url}: {e}")
+
+    async def execute_subgraphs(self, dynprompt, prompt_id, extra_data, execute_outputs, outputs_cache):
+        """
+        Execute the subgraphs the prompt needs on the workers and store the outputs of their cut
+        points in outputs_cache. Returns the error details and exception of the first failure (or
+        the interruption), otherwise (None, None).
+        """
+        prompt = dynprompt.original_prompt
+        cut_points = self.get_cut_points(prompt, extra_data, execute_outputs)
+        if len(cut_points) == 0:
+            return None, None
+        needed = self.get_needed_subgraphs(prompt, partition_prompt(prompt, cut_points), execute_outputs, outputs_cache)
+        if len(needed) == 0:
+            return None, None
+
+        tasks = {}
+        used_urls = set()
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            async def run(subgraph):
+                for dependency in subgraph.dependencies:
+                    if dependency in tasks:
+                        await tasks[dependency]
+                inputs = {dependency: outputs_cache.get(dependency) for dependency in subgraph.dependencies}
+                value = await self.execute_subgraph(session, prompt, prompt_id, subgraph, inputs, used_urls)
+                outputs_cache.set(subgraph.cut_point, value)
+
+            for cut_point, subgraph in needed.items():
+                tasks[cut_point] = asyncio.create_task(run(subgraph))
+            pending = set(tasks.values())
+            try:
+                while len(pending) > 0:
+                    done, pending = await asyncio.wait(pending, timeout=INTERRUPT_POLL_INTERVAL, return_when=asyncio.FIRST_EXCEPTION)
+                    for task in done:
+                        task.result()
+                    comfy.model_management.throw_exception_if_processing_interrupted()
+            except Exception as ex:
+                for task in tasks.values():
+                    task.cancel()
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                if isinstance(ex, comfy.model_management.InterruptProcessingException):
+                    await self.interrupt_workers(session, used_urls, prompt_id)
+                    error = {"node_id": next(iter(needed)), "exception_message": "", "exception_type": "", "traceback": []}
+                elif isinstance(ex, DistributedExecutionError):
+                    error = ex.as_dict()
+                    if error["node_id"] not in prompt:
+                        # Ephemeral nodes of the worker don't exist here
+                        error["node_id"] = next(iter(needed))
+                else:
+                    error = {"node_id": next(iter(needed)), "exception_message": str(ex), "exception_type": execution.full_type_name(type(ex)), "traceback": traceback.format_tb(ex.__traceback__)}
+                error["current_inputs"] = []
+                error["current_outputs"] = []
+                return error, ex
+        return None, None
+
+
+class SubgraphWorker:
+    """
+    Executes the subgraphs sent by a DistributedCoordinator to POST /distributed/execute, one at a
+    time on a dedicated thread. The outputs of the cut points the subgraph depends on are put in the
+    output cache before executing, the output of its cut point is sent back. The executor keeps a
+    classic cache, so subgraphs resubmitted with the same inputs reuse the previous outputs.
+    """
+    def __init__(self, server, max_parallel_nodes=1):
+        self.executor = execution.PromptExecutor(server, cache_type=execution.CacheType.CLASSIC, max_parallel_nodes=max_parallel_nodes)
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="subgraph-worker")
+
+    def execute(self, data):
+        try:
+            header, inputs = decode_payload(data)
+        except Exception as e:
+            raise DistributedExecutionError(None, f"Invalid subgraph request: {e}")
+        e = self.executor
+        e.execute(header["prompt"], header["prompt_id"], {}, header["outputs"], preset_outputs=inputs)
+        event, message = e.status_messages[-1]
+        if event == "execution_interrupted":
+            raise DistributedExecutionError(message["node_id"], "Interrupted", "comfy.model_management.InterruptProcessingException")
+        if event != "execution_success":
+            raise DistributedExecutionError(message.get("node_id"), message.get("exception_message", ""), message.get("exception_type"), message.get("traceback"))
+        outputs = {node_id: e.caches.outputs.get(node_id) for node_id in header["outputs"]}
+        try:
+            return encode_payload({"prompt_id": header["prompt_id"]}, outputs)
+        except SpillFormatError as ex:
+            raise DistributedExecutionError(header["outputs"][0], f"The output of node {header['outputs'][0]} can't be sent back: {ex}")
+
+    async def handle_request(self, request):
+        data = await request.read()
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.thread_pool, self.execute, data)
+        except DistributedExecutionError as e:
+            return web.json_response({"error": e.as_dict()}, status=500)
+        except Exception as e:
+            logging.exception("Failed to execute a distributed subgraph")
+            return web.json_response({"error": {"exception_message": str(e), "exception_type": execution.full_type_name(type(e)), "traceback": traceback.format_tb(e.__traceback__)}}, status=500)
+        return web.Response(body=body, content_type="application/octet-stream")
@@ -0,0 +1,227 @@
+from __future__ import annotations
+import collections
+import hashlib
+import heapq
+import math
+
+import execution
+from comfy_execution.scheduling import node_timing_stats
+
+TENANT_KEYS = ("client_id", "api_key")
+
+
+class TenantQueue:
+    def __init__(self, name, weight, max_running):
+        self.name = name
+        self.weight = weight
+        self.max_running = max_running # 0 for no limit
+        self.items = [] # heap ordered like PromptQueue.queue, so number and front still apply within a tenant
+        self.deficit = 0.0
+        self.running = 0
+
+    def copy(self):
+        tenant = TenantQueue(self.name, self.weight, self.max_running)
+        tenant.items = list(self.items)
+        tenant.deficit = self.deficit
+        tenant.running = self.running
+        return tenant
+
+    def can_start(self):
+        return self.max_running <= 0 or self.running < self.max_running
+
+
+def estimate_prompt_cost(prompt):
+    """The expected execution time of prompt from the recorded times of its node classes"""
+    return sum(node_timing_stats.get_estimate(node["class_type"]) for node in prompt.values() if isinstance(node, dict) and "class_type" in node)
+
+
+class FairPromptQueue(execution.PromptQueue):
+    """
+    A PromptQueue that shares execution between tenants instead of running prompts strictly by
+    number, so one client queueing hundreds of prompts (or putting them in front) doesn't starve
+    the others.
+
+    Every tenant (client_id, or the hashed api key of extra_data with tenant_key="api_key") has its
+    own sub-queue, ordered by number as before. The next prompt is picked by deficit round robin
+    between the tenants with queued prompts: each round a tenant is credited QUANTUM times its
+    weight, and starts its next prompt once its credit covers the expected execution time of that
+    prompt (the sum of the recorded times of its node classes). Tenants at their max_running limit
+    are skipped until one of their prompts finishes.
+
+    queue still holds every pending item, so /queue keeps its shape. get_tenant_stats reports the
+    position at which each pending prompt is expected to start.
+    """
+    # Expected seconds of execution credited per round to a tenant of weight 1
+    QUANTUM = 1.0
+
+    def __init__(self, server, tenant_key="client_id", weights=None, default_weight=1.0, max_running=None, default_max_running=0):
+        if tenant_key not in TENANT_KEYS:
+            raise ValueError(f"Unknown tenant key {tenant_key}, expected one of {TENANT_KEYS}")
+        weights = dict(weights or {})
+        for name, weight in list(weights.items()) + [(None, default_weight)]:
+            if weight <= 0:
+                raise ValueError(f"Tenant weights must be positive, got {weight} for {name or 'the default'}")
+        super().__init__(server)
+        self.tenant_key = tenant_key
+        self.weights = weights
+        self.default_weight = default_weight
+        self.max_running = dict(max_running or {})
+        self.default_max_running = default_max_running
+        self.tenants = {} # name -> TenantQueue with queued or running prompts
+        self.active = collections.deque() # names of the tenants with queued prompts, in round robin order
+        self.item_costs = {} # prompt_id -> estimated cost of a queued prompt
+        self.running_tenants = {} # item_id -> tenant name
+
+    def get_tenant_name(self, item):
+        extra_data = item[3]
+        if self.tenant_key == "api_key":
+            api_key = extra_data.get("api_key_comfy_org")
+            if isinstance(api_key, str) and len(api_key) > 0:
+                return "key-" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+        client_id = extra_data.get("client_id")
+        return str(client_id) if client_id is not None else "anonymous"
+
+    def get_tenant(self, name):
+        tenant = self.tenants.get(name)
+        if tenant is None:
+            weight = self.weights.get(name, self.default_weight)
+            max_running = self.max_running.get(name, self.default_max_running)
+            tenant = self.tenants[name] = TenantQueue(name, weight, max_running)
+        return tenant
+
+    def forget_tenant(self, tenant):
+        if len(tenant.items) == 0 and tenant.running == 0:
+            self.tenants.pop(tenant.name, None)
+
+    def get_cost(self, item):
+        cost = self.item_costs.get(item[1])
+        return cost if cost is not None else estimate_prompt_cost(item[2])
+
+    def select_tenant(self, tenants, active, respect_limits):
+        """
+        Advance the round robin over active to the tenant whose next item starts next, crediting the
+        tenants passed over. Returns None if every tenant with queued items is at its limit.
+        """
+        eligible = [tenants[name] for name in active if not respect_limits or tenants[name].can_start()]
+        if len(eligible) == 0:
+            return None
+        # Skip the rounds in which no tenant has enough credit for its next item
+        rounds = min(math.ceil((self.get_cost(t.items[0]) - t.deficit) / (self.QUANTUM * t.weight)) for t in eligible) - 1
+        if rounds > 0:
+            for tenant in eligible:
+                tenant.deficit += rounds * self.QUANTUM * tenant.weight
+        while True:
+            tenant = tenants[active[0]]
+            if not respect_limits or tenant.can_start():
+                if tenant.deficit >= self.get_cost(tenant.items[0]):
+                    return tenant
+                tenant.deficit += self.QUANTUM * tenant.weight
+            active.rotate(-1)
+
+    def charge(self, tenant, active, item):
+        tenant.deficit -= self.get_cost(item)
+        tenant.running += 1
+        if len(tenant.items) == 0:
+            # As in deficit round robin, a tenant doesn't keep credit while it has nothing queued
+            tenant.deficit = 0.0
+            active.remove(tenant.name)
+
+    def simulate(self, count=None, respect_limits=False):
+        """The next count pending items (all by default) in the order they are expected to start"""
+        tenants = {name: tenant.copy() for name, tenant in self.tenants.items()}
+        active = collections.deque(self.active)
+        order = []
+        while len(active) > 0 and (count is None or len(order) < count):
+            tenant = self.select_tenant(tenants, active, respect_limits)
+            if tenant is None:
+                break
+            item = heapq.heappop(tenant.items)
+            self.charge(tenant, active, item)
+            order.append(item)
+        return order
+
+    def push_item(self, item):
+        super().push_item(item)
+        tenant = self.get_tenant(self.get_tenant_name(item))
+        heapq.heappush(tenant.items, item)
+        self.item_costs[item[1]] = estimate_prompt_cost(item[2])
+        if tenant.name not in self.active:
+            self.active.append(tenant.name)
+
+    def take_next_item(self):
+        if len(self.active) == 0:
+            return None
+        tenant = self.select_tenant(self.tenants, self.active, True)
+        if tenant is None:
+            return None
+        item = heapq.heappop(tenant.items)
+        self.charge(tenant, self.active, item)
+        self.item_costs.pop(item[1], None)
+        super().remove_item(item)
+        return item
+
+    def peek_items(self, count):
+        return self.simulate(count, respect_limits=True)
+
+    def take_item(self, item):
+        tenant = self.tenants[self.get_tenant_name(item)]
+        tenant.items.remove(item)
+        heapq.heapify(tenant.items)
+        self.charge(tenant, self.active, item)
+        self.item_costs.pop(item[1], None)
+        super().remove_item(item)
+
+    def remove_item(self, item):
+        super().remove_item(item)
+        tenant = self.tenants[self.get_tenant_name(item)]
+        tenant.items.remove(item)
+        heapq.heapify(tenant.items)
+        self.item_costs.pop(item[1], None)
+        if len(tenant.items) == 0:
+            tenant.deficit = 0.0
+            self.active.remove(tenant.name)
+            self.forget_tenant(tenant)
+
+    def start_item(self, item):
+        with self.mutex:
+            item, item_id = super().start_item(item)
+            self.running_tenants[item_id] = self.get_tenant_name(item)
+            return item, item_id
+
+    def task_done(self, item_id, history_result, status):
+        with self.mutex:
+            name = self.running_tenants.pop(item_id, None)
+            tenant = self.tenants.get(name)
+            if tenant is not None:
+                tenant.running -= 1
+                self.forget_tenant(tenant)
+            super().task_done(item_id, history_result, status)
+            # A tenant at its limit may start its next prompt now
+            self.not_empty.notify_all()
+
+    def wipe_queue(self):
+        with self.mutex:
+            super().wipe_queue()
+            for tenant in list(self.tenants.values()):
+                tenant.items = []
+                tenant.deficit = 0.0
+                self.forget_tenant(tenant)
+            self.active.clear()
+            self.item_costs = {}
+
+    def get_tenant_stats(self):
+        with self.mutex:
+            stats = {}
+            for name, tenant in self.tenants.items():
+                stats[name] = {
+                    "weight": tenant.weight,
+                    "max_running": tenant.max_running,
+                    "running": tenant.running,
+                    "pending": len(tenant.items),
+                    "deficit": tenant.deficit,
+                    "queue": [],
+                }
+            # Positions assume no more prompts are queued and ignore the limits, which only delay a tenant
+            for position, item in enumerate(self.simulate()):
+                stats[self.get_tenant_name(item)]["queue"].append({"prompt_id": item[1], "number": item[0], "position": position})
+            return stats
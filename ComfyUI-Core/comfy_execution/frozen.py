@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(f"'{type(self).__name__}' object is immutable")
+
+
+class FrozenDict(dict):
+    """
+    A dict that can't be modified. It's still a dict, so it serializes to JSON and passes the
+    isinstance checks of existing code. Copies return the object itself, which is what lets the
+    queue, history and executor share one prompt. set() returns a modified copy that shares all
+    other values.
+    """
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def set(self, key, value) -> FrozenDict:
+        items = dict(self)
+        items[key] = freeze(value)
+        return FrozenDict(items)
+
+
+class FrozenList(list):
+    """A list that can't be modified, see FrozenDict. Links stay lists, so is_link still applies."""
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+
+# Values that are shared as they are, checked by exact type so the common case costs no call
+_ATOMIC_TYPES = frozenset((str, int, float, bool, type(None), FrozenDict, FrozenList))
+
+
+def freeze(value):
+    """A frozen version of value, the dicts and lists in it are converted once, everything else is shared"""
+    value_type = type(value)
+    if value_type in _ATOMIC_TYPES:
+        return value
+    elif isinstance(value, dict):
+        return FrozenDict({k: v if type(v) in _ATOMIC_TYPES else freeze(v) for k, v in value.items()})
+    elif isinstance(value, list):
+        return FrozenList([v if type(v) in _ATOMIC_TYPES else freeze(v) for v in value])
+    elif value_type is tuple:
+        return tuple(v if type(v) in _ATOMIC_TYPES else freeze(v) for v in value)
+    return value
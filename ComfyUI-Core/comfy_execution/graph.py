@@ -3,8 +3,10 @@ from typing import Type, Literal
 
 import nodes
 import asyncio
+import heapq
 import inspect
 from comfy_execution.graph_utils import is_link, ExecutionBlocker
+from comfy_execution.node_schema import get_node_schema
 from comfy.comfy_types.node_typing import ComfyNodeABC, InputTypeDict, InputTypeOptions
 
 # NOTE: ExecutionBlocker code got moved to graph_utils.py to prevent torch being imported too soon during unit tests
@@ -19,10 +21,15 @@ class NodeInputError(Exception):
 class NodeNotFoundError(Exception):
     pass
 
+class LoopBodyError(Exception):
+    pass
+
 class DynamicPrompt:
-    def __init__(self, original_prompt):
+    def __init__(self, original_prompt, user_prompt=None):
         # The original prompt provided by the user
         self.original_prompt = original_prompt
+        # The prompt as submitted, if original_prompt is a rewritten (optimized) version of it
+        self.user_prompt = user_prompt if user_prompt is not None else original_prompt
         # Any extra pieces of the graph created during execution
         self.ephemeral_prompt = {}
         self.ephemeral_parents = {}
@@ -60,7 +67,7 @@ class DynamicPrompt:
         return set(self.original_prompt.keys()).union(set(self.ephemeral_prompt.keys()))
 
     def get_original_prompt(self):
-        return self.original_prompt
+        return self.user_prompt
 
 def get_input_info(
     class_def: Type[ComfyNodeABC],
@@ -72,13 +79,14 @@ def get_input_info(
     Arguments:
         class_def: The class definition of the node.
         input_name: The name of the input to get info for.
-        valid_inputs: The valid inputs for the node, or None to use the class_def.INPUT_TYPES().
+        valid_inputs: The valid inputs for the node, or None to use the cached schema of class_def.
 
     Returns:
         tuple[str, str, dict] | tuple[None, None, None]: The input type, category, and extra info for the input name.
     """
 
-    valid_inputs = valid_inputs or class_def.INPUT_TYPES()
+    if not valid_inputs:
+        return get_node_schema(class_def).get_input_info(input_name)
     input_info = None
     input_category = None
     if "required" in valid_inputs and input_name in valid_inputs["required"]:
@@ -99,12 +107,53 @@ def get_input_info(
         extra_info = {}
     return input_type, input_category, extra_info
 
+class LoopSchedule:
+    """
+    The execution order of a loop body, computed once and reused by every iteration. Only the body
+    nodes that the targets (node ids of the next state, the condition and the result) or an output
+    node depend on are run. external_node_ids are the nodes outside the body that it links to.
+    """
+    def __init__(self, graph, state_id, target_ids):
+        self.external_node_ids = set()
+        needed = set()
+        node_ids = [node_id for node_id in target_ids if node_id in graph]
+        for node_id, node in graph.items():
+            class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+            if getattr(class_def, "OUTPUT_NODE", False) == True:
+                node_ids.append(node_id)
+        dependencies = {}
+        while len(node_ids) > 0:
+            node_id = node_ids.pop()
+            if node_id in needed:
+                continue
+            needed.add(node_id)
+            dependencies[node_id] = set()
+            for value in graph[node_id]["inputs"].values():
+                if not is_link(value) or value[0] == state_id:
+                    continue
+                if value[0] in graph:
+                    dependencies[node_id].add(value[0])
+                    node_ids.append(value[0])
+                else:
+                    self.external_node_ids.add(value[0])
+        # Kahn's algorithm, in the order the nodes were added to the body
+        self.order = []
+        done = set()
+        while len(self.order) < len(needed):
+            ready = [node_id for node_id in graph if node_id in needed and node_id not in done and dependencies[node_id] <= done]
+            if len(ready) == 0:
+                raise DependencyCycleError("Dependency cycle detected in loop body")
+            self.order.extend(ready)
+            done.update(ready)
+
 class TopologicalSort:
     def __init__(self, dynprompt):
         self.dynprompt = dynprompt
         self.pendingNodes = {}
         self.blockCount = {} # Number of nodes this node is directly blocked by
         self.blocking = {} # Which nodes are blocked by this node
+        self.blockedBy = {} # Which nodes this node is blocked by (the reverse of blocking)
+        self.readyNodes = {} # Pending nodes with a block count of zero, in the order they became ready
         self.externalBlocks = 0
         self.unblockedEvent = asyncio.Event()
 
@@ -128,9 +177,29 @@ class TopologicalSort:
             self.add_node(from_node_id)
             if to_node_id not in self.blocking[from_node_id]:
                 self.blocking[from_node_id][to_node_id] = {}
-                self.blockCount[to_node_id] += 1
+                self.blockedBy[to_node_id].add(from_node_id)
+                self.add_block(to_node_id)
+                self.links_changed(from_node_id)
             self.blocking[from_node_id][to_node_id][from_socket] = True
 
+    def add_block(self, node_id):
+        self.blockCount[node_id] += 1
+        self.readyNodes.pop(node_id, None)
+
+    def remove_block(self, node_id):
+        self.blockCount[node_id] -= 1
+        if self.blockCount[node_id] == 0 and node_id in self.pendingNodes:
+            self.readyNodes[node_id] = True
+            self.node_ready(node_id)
+
+    def node_ready(self, node_id):
+        # Called whenever a pending node becomes ready to execute
+        pass
+
+    def links_changed(self, node_id):
+        # Called when node_id starts blocking another node
+        pass
+
     def add_node(self, node_unique_id, include_lazy=False, subgraph_nodes=None):
         node_ids = [node_unique_id]
         links = []
@@ -143,6 +212,9 @@ class TopologicalSort:
             self.pendingNodes[unique_id] = True
             self.blockCount[unique_id] = 0
             self.blocking[unique_id] = {}
+            self.blockedBy[unique_id] = set()
+            self.readyNodes[unique_id] = True
+            self.node_ready(unique_id)
 
             inputs = self.dynprompt.get_node(unique_id)["inputs"]
             for input_name in inputs:
@@ -163,24 +235,24 @@ class TopologicalSort:
     def add_external_block(self, node_id):
         assert node_id in self.blockCount, "Can't add external block to a node that isn't pending"
         self.externalBlocks += 1
-        self.blockCount[node_id] += 1
+        self.add_block(node_id)
         def unblock():
             self.externalBlocks -= 1
-            self.blockCount[node_id] -= 1
+            self.remove_block(node_id)
             self.unblockedEvent.set()
         return unblock
 
     def is_cached(self, node_id):
         return False
 
-    def get_ready_nodes(self):
-        return [node_id for node_id in self.pendingNodes if self.blockCount[node_id] == 0]
-
     def pop_node(self, unique_id):
         del self.pendingNodes[unique_id]
+        self.readyNodes.pop(unique_id, None)
         for blocked_node_id in self.blocking[unique_id]:
-            self.blockCount[blocked_node_id] -= 1
+            self.blockedBy[blocked_node_id].discard(unique_id)
+            self.remove_block(blocked_node_id)
         del self.blocking[unique_id]
+        self.blockedBy.pop(unique_id, None)
 
     def is_empty(self):
         return len(self.pendingNodes) == 0
@@ -194,84 +266,153 @@ class ExecutionList(TopologicalSort):
         super().__init__(dynprompt)
         self.output_cache = output_cache
         self.staged_node_id = None
+        # Nodes staged through stage_ready_nodes that are currently executing concurrently
+        self.staged_node_ids = set()
+        # Ready nodes are kept in a heap of (priority, sequence, node_id). Entries are invalidated
+        # lazily: an entry is only current if its sequence matches readySequence[node_id].
+        self.readyHeap = []
+        self.readySequence = {}
+        self.nextSequence = 0
+        # Nodes whose pick priority has to be (re)computed before the next pick
+        self.dirtyNodes = {}
+        self.classTraits = {}
 
     def is_cached(self, node_id):
         return self.output_cache.get(node_id) is not None
 
+    async def wait_for_unblock(self):
+        # Wait for an external block to be released
+        await self.unblockedEvent.wait()
+        self.unblockedEvent.clear()
+
     async def stage_node_execution(self):
         assert self.staged_node_id is None
         if self.is_empty():
             return None, None, None
-        available = self.get_ready_nodes()
-        while len(available) == 0 and self.externalBlocks > 0:
-            # Wait for an external block to be released
-            await self.unblockedEvent.wait()
-            self.unblockedEvent.clear()
-            available = self.get_ready_nodes()
-        if len(available) == 0:
-            cycled_nodes = self.get_nodes_in_cycle()
-            # Because cycles composed entirely of static nodes are caught during initial validation,
-            # we will 'blame' the first node in the cycle that is not a static node.
-            blamed_node = cycled_nodes[0]
-            for node_id in cycled_nodes:
-                display_node_id = self.dynprompt.get_display_node_id(node_id)
-                if display_node_id != node_id:
-                    blamed_node = display_node_id
-                    break
-            ex = DependencyCycleError("Dependency cycle detected")
-            error_details = {
-                "node_id": blamed_node,
-                "exception_message": str(ex),
-                "exception_type": "graph.DependencyCycleError",
-                "traceback": [],
-                "current_inputs": []
-            }
+        node_id = self.pop_ready_node()
+        while node_id is None and self.externalBlocks > 0:
+            await self.wait_for_unblock()
+            node_id = self.pop_ready_node()
+        if node_id is None:
+            error_details, ex = self.get_cycle_error()
             return None, error_details, ex
 
-        self.staged_node_id = self.ux_friendly_pick_node(available)
+        self.staged_node_id = node_id
         return self.staged_node_id, None, None
 
-    def ux_friendly_pick_node(self, node_list):
+    def stage_ready_nodes(self, limit):
+        """
+        Stage up to `limit` ready nodes for concurrent execution. Each staged node must be
+        handed back through unstage_node or complete_node. Returns an empty list when nothing
+        is ready; the caller decides whether to wait for running nodes, external blocks or
+        report a cycle.
+        """
+        staged = []
+        while len(staged) < limit:
+            node_id = self.pop_ready_node()
+            if node_id is None:
+                break
+            staged.append(node_id)
+        self.staged_node_ids.update(staged)
+        return staged
+
+    def unstage_node(self, node_id):
+        self.staged_node_ids.discard(node_id)
+        self.dirtyNodes[node_id] = True
+
+    def complete_node(self, node_id):
+        self.pop_node(node_id)
+        self.staged_node_ids.discard(node_id)
+
+    def output_produced(self, node_id, value):
+        # Called with the output of every node executed from this list before it's completed
+        pass
+
+    def get_cycle_error(self):
+        cycled_nodes = self.get_nodes_in_cycle()
+        # Because cycles composed entirely of static nodes are caught during initial validation,
+        # we will 'blame' the first node in the cycle that is not a static node.
+        blamed_node = cycled_nodes[0]
+        for node_id in cycled_nodes:
+            display_node_id = self.dynprompt.get_display_node_id(node_id)
+            if display_node_id != node_id:
+                blamed_node = display_node_id
+                break
+        ex = DependencyCycleError("Dependency cycle detected")
+        error_details = {
+            "node_id": blamed_node,
+            "exception_message": str(ex),
+            "exception_type": "graph.DependencyCycleError",
+            "traceback": [],
+            "current_inputs": []
+        }
+        return error_details, ex
+
+    def node_ready(self, node_id):
+        self.dirtyNodes[node_id] = True
+
+    def links_changed(self, node_id):
+        # A new link can give node_id (and the nodes blocking it) a better pick priority
+        self.dirtyNodes[node_id] = True
+        for blocking_node_id in self.blockedBy[node_id]:
+            self.dirtyNodes[blocking_node_id] = True
+
+    def get_class_traits(self, node_id):
+        # (is_output, is_async) for the class of node_id, looked up once per class
+        class_type = self.dynprompt.get_node(node_id)["class_type"]
+        traits = self.classTraits.get(class_type)
+        if traits is None:
+            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+            is_output = hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True
+            is_async = inspect.iscoroutinefunction(getattr(class_def, class_def.FUNCTION))
+            traits = (is_output, is_async)
+            self.classTraits[class_type] = traits
+        return traits
+
+    def get_pick_priority(self, node_id):
+        """
+        The UX friendly pick order as a number, lower is picked first. Links are only ever added to
+        a pending node, so the priority of a node can only improve while it is pending.
+        """
+        is_output = lambda x: self.get_class_traits(x)[0]
         # If an output node is available, do that first.
         # Technically this has no effect on the overall length of execution, but it feels better as a user
         # for a PreviewImage to display a result as soon as it can
-        # Some other heuristics could probably be used here to improve the UX further.
-        def is_output(node_id):
-            class_type = self.dynprompt.get_node(node_id)["class_type"]
-            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-            if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
-                return True
-            return False
-
-        # If an available node is async, do that first.
+        # If an available node is async, do that first too.
         # This will execute the asynchronous function earlier, reducing the overall time.
-        def is_async(node_id):
-            class_type = self.dynprompt.get_node(node_id)["class_type"]
-            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-            return inspect.iscoroutinefunction(getattr(class_def, class_def.FUNCTION))
-
-        for node_id in node_list:
-            if is_output(node_id) or is_async(node_id):
-                return node_id
-
+        if any(self.get_class_traits(node_id)):
+            return 0
         #This should handle the VAEDecode -> preview case
-        for node_id in node_list:
-            for blocked_node_id in self.blocking[node_id]:
-                if is_output(blocked_node_id):
-                    return node_id
-
+        for blocked_node_id in self.blocking[node_id]:
+            if is_output(blocked_node_id):
+                return 1
         #This should handle the VAELoader -> VAEDecode -> preview case
-        for node_id in node_list:
-            for blocked_node_id in self.blocking[node_id]:
-                for blocked_node_id1 in self.blocking[blocked_node_id]:
-                    if is_output(blocked_node_id1):
-                        return node_id
-
-        #TODO: this function should be improved
-        return node_list[0]
+        for blocked_node_id in self.blocking[node_id]:
+            for blocked_node_id1 in self.blocking[blocked_node_id]:
+                if is_output(blocked_node_id1):
+                    return 2
+        return 3
+
+    def pop_ready_node(self):
+        """Remove and return the ready node that should be executed next, or None if there is none"""
+        for node_id in self.dirtyNodes:
+            if node_id in self.readyNodes and node_id not in self.staged_node_ids and node_id != self.staged_node_id:
+                self.readySequence[node_id] = self.nextSequence
+                heapq.heappush(self.readyHeap, (self.get_pick_priority(node_id), self.nextSequence, node_id))
+                self.nextSequence += 1
+        self.dirtyNodes.clear()
+        while len(self.readyHeap) > 0:
+            _, sequence, node_id = heapq.heappop(self.readyHeap)
+            if self.readySequence.get(node_id) != sequence:
+                continue
+            del self.readySequence[node_id]
+            if node_id in self.readyNodes:
+                return node_id
+        return None
 
     def unstage_node_execution(self):
         assert self.staged_node_id is not None
+        self.dirtyNodes[self.staged_node_id] = True
         self.staged_node_id = None
 
     def complete_node_execution(self):
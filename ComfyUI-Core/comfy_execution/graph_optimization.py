@@ -0,0 +1,73 @@
+from __future__ import annotations
+import logging
+
+import nodes
+from comfy_execution.caching import CacheKeySetInputSignature, UNHASHABLE_DIGEST_PREFIX
+from comfy_execution.graph import DynamicPrompt
+from comfy_execution.graph_utils import is_link
+
+
+def can_merge_node(class_def) -> bool:
+    if getattr(class_def, "OUTPUT_NODE", False) == True:
+        return False
+    if getattr(class_def, "NOT_IDEMPOTENT", False):
+        return False
+    return True
+
+
+async def eliminate_common_subexpressions(dynprompt: DynamicPrompt, is_changed_cache, protected_ids=()):
+    """
+    Merge structurally identical nodes of a prompt so they are executed once.
+
+    Nodes are compared by their CacheKeySetInputSignature digest, which already covers the class,
+    the constant inputs, IS_CHANGED and (through the parent digests) the whole ancestry, so two
+    nodes with equal digests are exactly the nodes the output cache would treat as the same.
+    Output nodes, NOT_IDEMPOTENT nodes, nodes that can't be signed and protected_ids are never
+    merged.
+
+    With the classic cache and one node at a time, the second of two such nodes is a cache hit
+    anyway. Merging matters when it isn't: with --cache-none (DEPENDENCY_AWARE) the first output may
+    already be freed when the duplicate runs, an LRU cache may have evicted it, and with
+    --max-parallel-nodes both copies are dispatched before either finished. The removed nodes send no
+    progress messages and have no history outputs, so it is opt-in
+    (--enable-common-subexpression-elimination).
+
+    Returns (prompt, merged) where prompt is a rewritten copy of the prompt with every duplicate
+    removed and its links pointing at the node it was merged into, and merged maps each removed
+    node id to that node. When nothing was merged the original prompt is returned unchanged.
+    """
+    prompt = dynprompt.original_prompt
+    protected_ids = set(protected_ids)
+    key_set = CacheKeySetInputSignature(dynprompt, prompt.keys(), is_changed_cache)
+    canonical = {}
+    merged = {}
+    for node_id in prompt:
+        class_def = nodes.NODE_CLASS_MAPPINGS[prompt[node_id]["class_type"]]
+        if node_id in protected_ids or not can_merge_node(class_def):
+            continue
+        digest = await key_set.get_node_signature(dynprompt, node_id)
+        if digest.startswith(UNHASHABLE_DIGEST_PREFIX):
+            continue
+        if digest in canonical:
+            merged[node_id] = canonical[digest]
+        else:
+            canonical[digest] = node_id
+
+    if len(merged) == 0:
+        return prompt, merged
+
+    optimized = {}
+    for node_id, node in prompt.items():
+        if node_id in merged:
+            continue
+        inputs = node["inputs"]
+        if any(is_link(v) and v[0] in merged for v in inputs.values()):
+            new_inputs = {}
+            for key, value in inputs.items():
+                if is_link(value) and value[0] in merged:
+                    value = [merged[value[0]], value[1]]
+                new_inputs[key] = value
+            node = {**node, "inputs": new_inputs}
+        optimized[node_id] = node
+    logging.info(f"Merged {len(merged)} duplicate node(s) into {len(set(merged.values()))}")
+    return optimized, merged
@@ -1,3 +1,5 @@
+import contextvars
+
 def is_link(obj):
     if not isinstance(obj, list):
         return False
@@ -9,12 +11,12 @@ def is_link(obj):
         return False
     return True
 
+# (prefix_root, call_index, graph_index) of the node call currently building graphs. This is a
+# context variable so that nodes executing concurrently each get their own default prefix.
+_default_prefix = contextvars.ContextVar("graph_builder_default_prefix", default=("", 0, 0))
+
 # The GraphBuilder is just a utility class that outputs graphs in the form expected by the ComfyUI back-end
 class GraphBuilder:
-    _default_prefix_root = ""
-    _default_prefix_call_index = 0
-    _default_prefix_graph_index = 0
-
     def __init__(self, prefix = None):
         if prefix is None:
             self.prefix = GraphBuilder.alloc_prefix()
@@ -25,20 +27,19 @@ class GraphBuilder:
 
     @classmethod
     def set_default_prefix(cls, prefix_root, call_index, graph_index = 0):
-        cls._default_prefix_root = prefix_root
-        cls._default_prefix_call_index = call_index
-        cls._default_prefix_graph_index = graph_index
+        _default_prefix.set((prefix_root, call_index, graph_index))
 
     @classmethod
     def alloc_prefix(cls, root=None, call_index=None, graph_index=None):
+        default_root, default_call_index, default_graph_index = _default_prefix.get()
         if root is None:
-            root = GraphBuilder._default_prefix_root
+            root = default_root
         if call_index is None:
-            call_index = GraphBuilder._default_prefix_call_index
+            call_index = default_call_index
         if graph_index is None:
-            graph_index = GraphBuilder._default_prefix_graph_index
+            graph_index = default_graph_index
         result = f"{root}.{call_index}.{graph_index}."
-        GraphBuilder._default_prefix_graph_index += 1
+        _default_prefix.set((default_root, default_call_index, default_graph_index + 1))
         return result
 
     def node(self, class_type, id=None, **kwargs):
@@ -112,6 +113,53 @@ class Node:
             serialized["override_display_id"] = self.override_display_id
         return serialized
 
+class LoopBody:
+    """
+    A subgraph that is executed repeatedly. Return it from a node in place of an expanded graph,
+    {"result": outputs, "expand": loop}, with outputs linking to the loop state (its final value) or
+    to body nodes (their outputs in the last iteration).
+
+    Unlike an expanded graph, the body is added to the prompt once and every iteration re-runs the
+    same nodes with the loop state rebound, so an iteration costs the same no matter how many came
+    before it. Body nodes read the state through the links returned by state(), and set_next() gives
+    the value of each state in the next iteration. The loop runs max_iterations times, or while the
+    body output given to set_condition() is true (at most max_iterations times, if set).
+
+    Body nodes are evaluated eagerly, so lazy inputs are always computed. They can return another
+    LoopBody, but can't expand regular subgraphs.
+    """
+    def __init__(self, graph, max_iterations=None):
+        self.graph = graph
+        self.max_iterations = max_iterations
+        # The virtual node whose outputs are the current values of the loop state
+        self.state_id = graph.prefix + "loop_state"
+        self.state_names = []
+        self.initial_state = []
+        self.next_state = {}
+        self.condition = None
+
+    def state(self, name, initial_value):
+        if name not in self.state_names:
+            self.state_names.append(name)
+            self.initial_state.append(initial_value)
+        return [self.state_id, self.state_names.index(name)]
+
+    def set_next(self, name, value):
+        if name not in self.state_names:
+            raise ValueError(f"Unknown loop state {name}")
+        self.next_state[name] = value
+
+    def set_condition(self, value):
+        self.condition = value
+
+    def finalize(self):
+        if self.max_iterations is None and self.condition is None:
+            raise ValueError("A loop needs max_iterations or a condition")
+        for name in self.state_names:
+            if name not in self.next_state:
+                raise ValueError(f"Loop state {name} has no next value")
+        return self.graph.finalize()
+
 def add_graph_prefix(graph, outputs, prefix):
     # Change the node IDs and any internal links
     new_graph = {}
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import bisect
+import threading
+import time
+
+HISTORY_FIELDS = ("prompt", "outputs", "status", "meta", "profile")
+
+
+class HistoryIndex:
+    """The sequence numbers of a set of history entries in completion order"""
+    def __init__(self):
+        self.seqs = []
+
+    def add(self, seq):
+        # Entries are added in sequence order
+        self.seqs.append(seq)
+
+    def remove(self, seq):
+        i = bisect.bisect_left(self.seqs, seq)
+        if i < len(self.seqs) and self.seqs[i] == seq:
+            del self.seqs[i]
+
+    def __len__(self):
+        return len(self.seqs)
+
+
+class HistoryStore:
+    """
+    The history of executed prompts, indexed by prompt_id, by completion time and by client_id.
+
+    Entries are immutable once added and are returned without copying, so queries only hold the
+    store's own lock (not the prompt queue mutex) while collecting references, and serializing
+    the response happens outside of it. Queries page with cursors (the sequence number of the last
+    returned entry) so polling clients only get what changed since their last request.
+
+    The store keeps the last max_items entries. It is also a read only mapping of prompt_id to
+    entry in completion order, like the dict it replaces.
+    """
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.entries = {} # prompt_id -> (seq, completed_at, client_id, entry)
+        self.seq_prompt_ids = {} # seq -> prompt_id
+        self.by_time = HistoryIndex() # every entry, completion order is time order
+        self.times = [] # completed_at of the entries of by_time
+        self.by_client = {} # client_id -> HistoryIndex
+        self.next_seq = 0
+
+    def add(self, prompt_id, entry, client_id=None):
+        with self.lock:
+            self._remove(prompt_id)
+            while len(self.entries) >= self.max_items:
+                self._remove(self.seq_prompt_ids[self.by_time.seqs[0]])
+            seq = self.next_seq
+            self.next_seq += 1
+            completed_at = time.time()
+            self.entries[prompt_id] = (seq, completed_at, client_id, entry)
+            self.seq_prompt_ids[seq] = prompt_id
+            self.by_time.add(seq)
+            self.times.append(completed_at)
+            if client_id is not None:
+                self.by_client.setdefault(client_id, HistoryIndex()).add(seq)
+            return seq
+
+    def _remove(self, prompt_id):
+        record = self.entries.pop(prompt_id, None)
+        if record is None:
+            return
+        seq, _, client_id, _ = record
+        del self.seq_prompt_ids[seq]
+        i = bisect.bisect_left(self.by_time.seqs, seq)
+        del self.by_time.seqs[i]
+        del self.times[i]
+        if client_id is not None:
+            index = self.by_client[client_id]
+            index.remove(seq)
+            if len(index) == 0:
+                del self.by_client[client_id]
+
+    def remove(self, prompt_id):
+        with self.lock:
+            self._remove(prompt_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.seq_prompt_ids = {}
+            self.by_time = HistoryIndex()
+            self.times = []
+            self.by_client = {}
+
+    def get(self, prompt_id):
+        record = self.entries.get(prompt_id)
+        return record[3] if record is not None else None
+
+    def get_range(self, offset, max_items):
+        """(prompt_id, entry) pairs of the entries at offset in completion order"""
+        with self.lock:
+            seqs = self.by_time.seqs[offset:offset + max_items if max_items is not None else None]
+            return [(self.seq_prompt_ids[seq], self.entries[self.seq_prompt_ids[seq]][3]) for seq in seqs]
+
+    def query(self, max_items=None, cursor=None, descending=False, client_id=None, since=None, until=None, status=None, fields=None):
+        """
+        Entries in completion order (newest first if descending) after cursor, optionally only those
+        of client_id, completed between the since and until timestamps or with the given status_str.
+        fields projects every entry to those keys. Returns the (prompt_id, entry) pairs and the
+        cursor of the next page, None when there are no more entries.
+        """
+        with self.lock:
+            seqs = self.by_time.seqs
+            if client_id is not None:
+                seqs = self.by_client[client_id].seqs if client_id in self.by_client else []
+            # The seq bounds of the time range, seqs and times are both ordered by completion
+            low, high = 0, len(seqs)
+            if since is not None:
+                start = bisect.bisect_left(self.times, since)
+                low = bisect.bisect_left(seqs, self.by_time.seqs[start]) if start < len(self.times) else len(seqs)
+            if until is not None:
+                end = bisect.bisect_right(self.times, until)
+                high = bisect.bisect_right(seqs, self.by_time.seqs[end - 1]) if end > 0 else 0
+            if cursor is not None:
+                if descending:
+                    high = min(high, bisect.bisect_left(seqs, cursor))
+                else:
+                    low = max(low, bisect.bisect_right(seqs, cursor))
+            positions = range(high - 1, low - 1, -1) if descending else range(low, high)
+            results = []
+            last_seq = None
+            for i in positions:
+                seq = seqs[i]
+                prompt_id = self.seq_prompt_ids[seq]
+                entry = self.entries[prompt_id][3]
+                last_seq = seq
+                if status is not None and (entry.get("status") or {}).get("status_str") != status:
+                    continue
+                results.append((prompt_id, entry))
+                if max_items is not None and len(results) >= max_items:
+                    break
+            more = last_seq is not None and last_seq != (seqs[low] if descending else seqs[high - 1])
+        if fields is not None:
+            results = [(prompt_id, {k: entry[k] for k in fields if k in entry}) for prompt_id, entry in results]
+        return results, last_seq if more else None
+
+    def __getitem__(self, prompt_id):
+        return self.entries[prompt_id][3]
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            return iter([self.seq_prompt_ids[seq] for seq in self.by_time.seqs])
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        with self.lock:
+            return [(self.seq_prompt_ids[seq], self.entries[self.seq_prompt_ids[seq]][3]) for seq in self.by_time.seqs]
+
+    def values(self):
+        return [entry for _, entry in self.items()]
+
+    def pop(self, prompt_id, default=None):
+        with self.lock:
+            record = self.entries.get(prompt_id)
+            self._remove(prompt_id)
+        return record[3] if record is not None else default
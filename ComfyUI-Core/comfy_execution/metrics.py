@@ -0,0 +1,196 @@
+from __future__ import annotations
+import math
+import threading
+from typing import Callable, Iterable, NamedTuple
+
+# Prompts take from milliseconds (fully cached) to many minutes (video models)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricFamily(NamedTuple):
+    """A metric produced by a collector at scrape time, samples are (labels dict, value) pairs"""
+    name: str
+    type: str
+    help: str
+    samples: list
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+        if len(self.label_names) == 0:
+            # Metrics without labels are reported from the start, not after their first update
+            self.values[()] = self.initial_value()
+
+    def initial_value(self):
+        return 0
+
+    def label_values(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} expects the labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.type}")
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, help, label_names)
+
+    def initial_value(self):
+        # [per bucket counts, sum, count]
+        return [[0] * len(self.buckets), 0.0, 0]
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = self.initial_value()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.type}")
+        with self.lock:
+            values = [(k, (list(v[0]), v[1], v[2])) for k, v in self.values.items()]
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values, extra=[("le", format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them in the Prometheus text exposition format.
+
+    Counters and histograms are updated where things happen. Values that are cheaper to read
+    when scraped (queue depth, cache sizes, loaded models) come from collectors, callables
+    returning MetricFamily objects, so nothing has to be kept up to date between scrapes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=()) -> Counter:
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()) -> Gauge:
+        return self.register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def set_collector(self, name, collector: Callable[[], Iterable[MetricFamily]]):
+        """Register collector under name, replacing the collector previously registered under it"""
+        with self.lock:
+            self.collectors[name] = collector
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors.values())
+        lines = []
+        for metric in metrics:
+            metric.render(lines)
+        for collector in collectors:
+            for family in collector():
+                lines.append(f"# HELP {family.name} {family.help}")
+                lines.append(f"# TYPE {family.name} {family.type}")
+                for labels, value in family.samples:
+                    lines.append(f"{family.name}{format_labels(labels.keys(), labels.values())} {format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+metrics_registry = MetricsRegistry()
+
+queue_enqueued = metrics_registry.counter("comfyui_queue_enqueued_total", "Prompts added to the queue")
+queue_dequeued = metrics_registry.counter("comfyui_queue_dequeued_total", "Prompts taken from the queue for execution")
+queue_wait_seconds = metrics_registry.histogram("comfyui_queue_wait_seconds", "Time prompts spent in the queue before execution started")
+prompts_executed = metrics_registry.counter("comfyui_prompts_executed_total", "Executed prompts by outcome", ("status",))
+prompt_duration_seconds = metrics_registry.histogram("comfyui_prompt_duration_seconds", "Prompt execution time by outcome", ("status",))
+node_duration_seconds = metrics_registry.histogram("comfyui_node_duration_seconds", "Execution time of nodes that weren't cached, by node class", ("class_type",))
+node_failures = metrics_registry.counter("comfyui_node_failures_total", "Node executions that raised an exception, by node class", ("class_type",))
+interrupts = metrics_registry.counter("comfyui_interrupts_total", "Prompts interrupted while executing")
+node_cache_lookups = metrics_registry.counter("comfyui_node_cache_lookups_total", "Output cache lookups of nodes about to execute", ("result",))
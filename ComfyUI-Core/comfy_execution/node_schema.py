@@ -0,0 +1,192 @@
+from __future__ import annotations
+import logging
+import os
+import threading
+from typing import Any, NamedTuple, Optional
+
+import folder_paths
+
+
+class NodeSchema(NamedTuple):
+    """
+    The parsed input and output schema of a node class.
+
+    Attributes:
+        input_types: The result of INPUT_TYPES(), including hidden inputs
+        visible_input_types: input_types without the hidden inputs for V3 nodes (V1 nodes receive
+            their hidden inputs as regular inputs, so for them this is input_types)
+        v3_schema: The finalized Schema of a V3 node, None for V1 nodes
+        input_info: Maps every input name to its (input_type, input_category, extra_info)
+        contains_unique_id: Whether the node requests its UNIQUE_ID as a hidden input
+        output_types: RETURN_TYPES
+        output_is_list: OUTPUT_IS_LIST, defaulting to False for every output
+        output_names: RETURN_NAMES, or None if the class doesn't define them
+    """
+    input_types: dict
+    visible_input_types: dict
+    v3_schema: Optional[Any]
+    input_info: dict
+    contains_unique_id: bool
+    output_types: tuple
+    output_is_list: tuple
+    output_names: Optional[tuple]
+
+    def get_input_info(self, input_name):
+        return self.input_info.get(input_name, (None, None, None))
+
+
+def parse_input_info(input_types):
+    input_info = {}
+    # Later categories don't override earlier ones, matching the lookup order of get_input_info
+    for category in ("hidden", "optional", "required"):
+        for input_name, info in input_types.get(category, {}).items():
+            if info is None:
+                continue
+            extra_info = info[1] if len(info) > 1 else {}
+            input_info[input_name] = (info[0], category, extra_info)
+    return input_info
+
+
+class SchemaRegistry:
+    """
+    Caches the NodeSchema of every node class so INPUT_TYPES() isn't evaluated again on each
+    node execution, topological sort or validation.
+
+    Schemas are invalidated explicitly. While INPUT_TYPES() runs, the folder_paths file lists it
+    reads are recorded; when one of those lists changes (see refresh) only the dependent classes
+    are dropped. The same goes for the input, output and temp directories it gets from folder_paths
+    (e.g. to os.listdir the input directory), which are rechecked by modification time, so files
+    copied there by hand or by other nodes show up. invalidate() drops everything.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.schemas = {}
+        self.folder_dependents = {} # folder name -> set of classes whose INPUT_TYPES read it
+        self.directory_dependents = {} # directory -> {class: its mtime when INPUT_TYPES got it}
+        self.local = threading.local()
+        folder_paths.add_filename_list_listener(self.on_filename_list)
+        folder_paths.add_directory_listener(self.on_directory)
+
+    def get(self, class_def) -> NodeSchema:
+        schema = self.schemas.get(class_def)
+        if schema is None:
+            schema = self.build(class_def)
+        return schema
+
+    def build(self, class_def) -> NodeSchema:
+        collecting = getattr(self.local, "collecting", None)
+        if collecting is None:
+            collecting = self.local.collecting = []
+        folders = set()
+        directories = {}
+        collecting.append((folders, directories))
+        try:
+            schema = parse_node_schema(class_def)
+        finally:
+            collecting.pop()
+        with self.lock:
+            self.schemas[class_def] = schema
+            for folder_name in folders:
+                self.folder_dependents.setdefault(folder_name, set()).add(class_def)
+            for directory, mtime in directories.items():
+                self.directory_dependents.setdefault(directory, {})[class_def] = mtime
+        return schema
+
+    @staticmethod
+    def get_mtime(directory):
+        try:
+            return os.path.getmtime(directory)
+        except OSError:
+            return None
+
+    def on_directory(self, directory):
+        collecting = getattr(self.local, "collecting", None)
+        if not collecting:
+            return
+        # Taken before INPUT_TYPES lists the directory, so files added meanwhile still change it
+        mtime = self.get_mtime(directory)
+        for _, directories in collecting:
+            directories.setdefault(directory, mtime)
+
+    def on_filename_list(self, folder_name, changed):
+        for folders, _ in getattr(self.local, "collecting", None) or []:
+            folders.add(folder_name)
+        if changed:
+            with self.lock:
+                dependents = self.folder_dependents.pop(folder_name, set())
+                for class_def in dependents:
+                    self.schemas.pop(class_def, None)
+            if len(dependents) > 0:
+                logging.debug(f"File list '{folder_name}' changed, invalidated the schema of {len(dependents)} node class(es)")
+
+    def refresh(self):
+        """
+        Re-check the file lists read by cached schemas and drop the schemas whose lists changed.
+        Only touches the modification times of the folders unless something actually changed.
+        """
+        with self.lock:
+            folder_names = list(self.folder_dependents.keys())
+        for folder_name in folder_names:
+            try:
+                folder_paths.get_filename_list(folder_name)
+            except KeyError:
+                self.on_filename_list(folder_name, True)
+        with self.lock:
+            directories = list(self.directory_dependents.keys())
+        for directory in directories:
+            mtime = self.get_mtime(directory)
+            with self.lock:
+                dependents = self.directory_dependents.get(directory, {})
+                stale = [class_def for class_def, recorded in dependents.items() if recorded != mtime]
+                for class_def in stale:
+                    del dependents[class_def]
+                    self.schemas.pop(class_def, None)
+                if len(dependents) == 0:
+                    self.directory_dependents.pop(directory, None)
+            if len(stale) > 0:
+                logging.debug(f"Directory '{directory}' changed, invalidated the schema of {len(stale)} node class(es)")
+
+    def invalidate(self, class_def=None):
+        with self.lock:
+            if class_def is None:
+                self.schemas.clear()
+                self.folder_dependents.clear()
+                self.directory_dependents.clear()
+            else:
+                self.schemas.pop(class_def, None)
+
+
+def parse_node_schema(class_def) -> NodeSchema:
+    from comfy_api.internal import _ComfyNodeInternal
+    v3_schema = None
+    if issubclass(class_def, _ComfyNodeInternal):
+        input_types, v3_schema = class_def.INPUT_TYPES(return_schema=True)
+        visible_input_types = {k: v for k, v in input_types.items() if k != "hidden"}
+    else:
+        input_types = class_def.INPUT_TYPES()
+        visible_input_types = input_types
+    output_types = tuple(class_def.RETURN_TYPES)
+    output_is_list = getattr(class_def, "OUTPUT_IS_LIST", None)
+    output_names = getattr(class_def, "RETURN_NAMES", None)
+    return NodeSchema(
+        input_types=input_types,
+        visible_input_types=visible_input_types,
+        v3_schema=v3_schema,
+        input_info=parse_input_info(input_types),
+        contains_unique_id="UNIQUE_ID" in input_types.get("hidden", {}).values(),
+        output_types=output_types,
+        output_is_list=tuple(output_is_list) if output_is_list is not None else (False,) * len(output_types),
+        output_names=tuple(output_names) if output_names is not None else None,
+    )
+
+
+schema_registry = SchemaRegistry()
+
+def get_node_schema(class_def) -> NodeSchema:
+    return schema_registry.get(class_def)
+
+def invalidate_node_schemas(class_def=None):
+    schema_registry.invalidate(class_def)
+
+def refresh_node_schemas():
+    schema_registry.refresh()
@@ -0,0 +1,239 @@
+from __future__ import annotations
+import contextlib
+import contextvars
+import sys
+import threading
+import time
+from typing import Optional
+
+import psutil
+import torch
+
+# (ExecutionProfiler, NodeProfile, lane) of the node being executed by the current task or worker thread
+current_node_profile: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar("current_node_profile", default=None)
+
+
+def get_peak_rss() -> Optional[int]:
+    """The peak resident set size of the process in bytes, None if the platform doesn't report it"""
+    try:
+        import resource
+    except ImportError:
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class NodeProfile:
+    """
+    What the profiler measured for one node of a prompt. A node that is executed more than once
+    (lazy inputs, expansion, async results) accumulates the times of every execution.
+
+    All times are in seconds. cpu_time only covers the node function itself, the CPU time of the
+    thread running it. The memory deltas compare the process (and the torch device) before and
+    after each execution, when nodes execute in parallel they include the other nodes as well. The
+    peak deltas are how much an execution raised the peak memory of the process so far.
+    """
+    def __init__(self, node_id, class_type, display_node_id):
+        self.node_id = node_id
+        self.class_type = class_type
+        self.display_node_id = display_node_id
+        self.cache_hit = False
+        self.executions = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.input_time = 0.0
+        self.function_time = 0.0
+        self.cache_time = 0.0
+        self.rss_delta = 0
+        self.peak_rss_delta = 0
+        self.vram_delta = 0
+        self.peak_vram_delta = 0
+        self.spans = [] # (start, duration, lane) of every execution, relative to the prompt start
+        self.phases = [] # (name, start, duration, lane)
+
+    def as_dict(self):
+        return {
+            "node_id": self.node_id,
+            "class_type": self.class_type,
+            "display_node_id": self.display_node_id,
+            "cache_hit": self.cache_hit,
+            "executions": self.executions,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "input_time": self.input_time,
+            "function_time": self.function_time,
+            "cache_time": self.cache_time,
+            "rss_delta": self.rss_delta,
+            "peak_rss_delta": self.peak_rss_delta,
+            "vram_delta": self.vram_delta,
+            "peak_vram_delta": self.peak_vram_delta,
+            "spans": [list(span) for span in self.spans],
+            "phases": [list(phase) for phase in self.phases],
+        }
+
+
+class ExecutionProfiler:
+    """
+    Records a NodeProfile for every node executed in a prompt.
+
+    execution.execute wraps each node in node(). Inside it, profile_phase() and profile_cpu_time()
+    attribute time to the node through the current_node_profile contextvar, which follows the
+    node into the thread pool used for parallel execution. Nodes running at the same time are
+    assigned different lanes, which become the threads of the Chrome trace.
+    """
+    PHASE_FIELDS = {
+        "input": "input_time",
+        "function": "function_time",
+        "cache": "cache_time",
+    }
+
+    def __init__(self, prompt_id, device=None):
+        self.prompt_id = prompt_id
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.wall_time = None
+        self.nodes = {}
+        self.busy_lanes = set()
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+        self.cuda_device = device if device is not None and device.type == "cuda" else None
+
+    def acquire_lane(self):
+        with self.lock:
+            lane = 0
+            while lane in self.busy_lanes:
+                lane += 1
+            self.busy_lanes.add(lane)
+            return lane
+
+    def release_lane(self, lane):
+        with self.lock:
+            self.busy_lanes.discard(lane)
+
+    def memory_snapshot(self):
+        # The peak counters aren't reset (which would sync the device and clobber peaks other code
+        # reads), the peak deltas are how much a node raised the peak of the whole process instead
+        vram, peak_vram = 0, 0
+        if self.cuda_device is not None:
+            vram = torch.cuda.memory_allocated(self.cuda_device)
+            peak_vram = torch.cuda.max_memory_allocated(self.cuda_device)
+        return self.process.memory_info().rss, get_peak_rss(), vram, peak_vram
+
+    @contextlib.contextmanager
+    def node(self, node_id, class_type, display_node_id):
+        record = self.nodes.get(node_id)
+        if record is None:
+            record = self.nodes[node_id] = NodeProfile(node_id, class_type, display_node_id)
+        lane = self.acquire_lane()
+        rss, peak_rss, vram, peak_vram = self.memory_snapshot()
+        token = current_node_profile.set((self, record, lane))
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            current_node_profile.reset(token)
+            self.release_lane(lane)
+            record.executions += 1
+            record.wall_time += end - start
+            record.spans.append((start - self.origin, end - start, lane))
+            record.rss_delta += self.process.memory_info().rss - rss
+            new_peak_rss = get_peak_rss()
+            if peak_rss is not None and new_peak_rss is not None:
+                record.peak_rss_delta = max(record.peak_rss_delta, new_peak_rss - peak_rss)
+            if self.cuda_device is not None:
+                record.vram_delta += torch.cuda.memory_allocated(self.cuda_device) - vram
+                record.peak_vram_delta = max(record.peak_vram_delta, torch.cuda.max_memory_allocated(self.cuda_device) - peak_vram)
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self.origin
+
+    def as_dict(self):
+        return {
+            "prompt_id": self.prompt_id,
+            "started_at": self.started_at,
+            "wall_time": self.wall_time,
+            "nodes": [record.as_dict() for record in self.nodes.values()],
+        }
+
+
+@contextlib.contextmanager
+def profile_phase(name):
+    """Attribute the time spent in the block to a phase of the node being profiled, if any"""
+    current = current_node_profile.get()
+    if current is None:
+        yield
+        return
+    profiler, record, lane = current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        field = ExecutionProfiler.PHASE_FIELDS[name]
+        setattr(record, field, getattr(record, field) + duration)
+        record.phases.append((name, start - profiler.origin, duration, lane))
+
+
+@contextlib.contextmanager
+def profile_cpu_time():
+    """Add the CPU time of the current thread spent in the block to the node being profiled, if any"""
+    current = current_node_profile.get()
+    if current is None:
+        yield
+        return
+    record = current[1]
+    start = time.thread_time()
+    try:
+        yield
+    finally:
+        record.cpu_time += time.thread_time() - start
+
+
+def mark_cache_hit():
+    current = current_node_profile.get()
+    if current is not None:
+        current[1].cache_hit = True
+
+
+def to_chrome_trace(profile):
+    """
+    Convert the "profile" of a history entry to the Chrome trace event format, which can be
+    opened in chrome://tracing and in Perfetto (ui.perfetto.dev).
+    """
+    events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": f"prompt {profile['prompt_id']}"}}]
+    lanes = set()
+    for node in profile["nodes"]:
+        name = f"{node['class_type']} #{node['display_node_id']}"
+        args = {k: v for k, v in node.items() if k not in ("spans", "phases")}
+        for start, duration, lane in node["spans"]:
+            lanes.add(lane)
+            events.append({
+                "name": name,
+                "cat": "cached" if node["cache_hit"] else "node",
+                "ph": "X",
+                "pid": 1,
+                "tid": lane,
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "args": args,
+            })
+        for phase, start, duration, lane in node["phases"]:
+            events.append({
+                "name": phase,
+                "cat": "phase",
+                "ph": "X",
+                "pid": 1,
+                "tid": lane,
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "args": {"node_id": node["node_id"]},
+            })
+    for lane in sorted(lanes):
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": f"lane {lane}"}})
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"prompt_id": profile["prompt_id"], "started_at": profile["started_at"], "wall_time": profile["wall_time"]},
+    }
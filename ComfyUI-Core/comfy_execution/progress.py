@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import contextvars
 from typing import TypedDict, Dict, Optional, Tuple
 from typing_extensions import override
 from PIL import Image
@@ -318,18 +319,18 @@ class ProgressRegistry:
         for handler in self.handlers.values():
             handler.reset()
 
-# Global registry instance
-global_progress_registry: ProgressRegistry | None = None
+# Registry of the prompt executing in the current context. Each prompt worker runs its
+# prompts in its own context, so concurrent workers don't share progress state.
+current_progress_registry: contextvars.ContextVar[ProgressRegistry | None] = contextvars.ContextVar("current_progress_registry", default=None)
 
 def reset_progress_state(prompt_id: str, dynprompt: "DynamicPrompt") -> None:
-    global global_progress_registry
-
     # Reset existing handlers if registry exists
-    if global_progress_registry is not None:
-        global_progress_registry.reset_handlers()
+    registry = current_progress_registry.get()
+    if registry is not None:
+        registry.reset_handlers()
 
     # Create new registry
-    global_progress_registry = ProgressRegistry(prompt_id, dynprompt)
+    current_progress_registry.set(ProgressRegistry(prompt_id, dynprompt))
 
 
 def add_progress_handler(handler: ProgressHandler) -> None:
@@ -339,11 +340,12 @@ def add_progress_handler(handler: ProgressHandler) -> None:
 
 
 def get_progress_state() -> ProgressRegistry:
-    global global_progress_registry
-    if global_progress_registry is None:
+    registry = current_progress_registry.get()
+    if registry is None:
         from comfy_execution.graph import DynamicPrompt
 
-        global_progress_registry = ProgressRegistry(
+        registry = ProgressRegistry(
             prompt_id="", dynprompt=DynamicPrompt({})
         )
-    return global_progress_registry
+        current_progress_registry.set(registry)
+    return registry
@@ -0,0 +1,160 @@
+from __future__ import annotations
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# Journaled events of a prompt: put, then start, then done. remove when deleted from the queue.
+EVENT_PUT = "put"
+EVENT_START = "start"
+EVENT_DONE = "done"
+EVENT_REMOVE = "remove"
+
+
+class QueueJournal:
+    """
+    Append only journal of the prompt queue in a SQLite table, so queued prompts survive a crash
+    or restart.
+
+    Recording an event only appends to an in-memory batch. A background thread serializes the
+    batch and commits it in one transaction every flush_interval seconds, so there is one fsync
+    per batch instead of one per prompt and an event is durable after at most flush_interval.
+    Items are serialized before they start executing, while their prompt is still as submitted.
+
+    recover() replays the journal: prompts that were queued or executing when the process stopped
+    are returned to be queued again. Sensitive extra_data (api keys) is never written, so recovered
+    prompts that need them have to be resubmitted.
+    """
+    # Rows of finished prompts are deleted after this many done/remove events
+    COMPACT_INTERVAL = 1000
+
+    def __init__(self, path, flush_interval=0.05, sensitive_keys=()):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.sensitive_keys = tuple(sensitive_keys)
+        self.lock = threading.Lock()
+        self.pending_events = [] # (event, prompt_id, number, item or serialized item, time)
+        self.unserialized = {} # prompt_id -> index in pending_events of a put not serialized yet
+        self.finished_since_compact = 0
+        self.closed = False
+        self.thread = None
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS prompt_queue_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            prompt_id TEXT NOT NULL,
+            number REAL,
+            item TEXT,
+            created_at REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS prompt_queue_journal_prompt_id ON prompt_queue_journal (prompt_id)")
+
+    def serialize_item(self, item):
+        number, prompt_id, prompt, extra_data, outputs_to_execute = item[:5]
+        extra_data = {k: v for k, v in extra_data.items() if k not in self.sensitive_keys}
+        try:
+            return json.dumps([number, prompt_id, prompt, extra_data, outputs_to_execute])
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Prompt {prompt_id} can't be written to the queue journal: {e}")
+            return None
+
+    def record(self, event, prompt_id, number=None, item=None):
+        with self.lock:
+            if item is not None:
+                self.unserialized[prompt_id] = len(self.pending_events)
+            elif event == EVENT_START:
+                self.serialize_pending(prompt_id)
+            self.pending_events.append((event, prompt_id, number, item, time.time()))
+
+    def serialize_pending(self, prompt_id):
+        # Called with the lock held
+        index = self.unserialized.pop(prompt_id, None)
+        if index is not None:
+            event, prompt_id, number, item, created_at = self.pending_events[index]
+            self.pending_events[index] = (event, prompt_id, number, self.serialize_item(item), created_at)
+
+    def record_put(self, item):
+        self.record(EVENT_PUT, item[1], number=item[0], item=item)
+
+    def record_start(self, prompt_id):
+        self.record(EVENT_START, prompt_id)
+
+    def record_done(self, prompt_id):
+        self.record(EVENT_DONE, prompt_id)
+
+    def record_remove(self, prompt_id):
+        self.record(EVENT_REMOVE, prompt_id)
+
+    def recover(self):
+        """The items that were queued or executing when the journal was last written, in queue order"""
+        items = {}
+        started = set()
+        for event, prompt_id, item in self.connection.execute("SELECT event, prompt_id, item FROM prompt_queue_journal ORDER BY seq"):
+            if event == EVENT_PUT:
+                items[prompt_id] = item
+            elif event == EVENT_START:
+                started.add(prompt_id)
+            else:
+                items.pop(prompt_id, None)
+                started.discard(prompt_id)
+        recovered = []
+        for prompt_id, item in items.items():
+            try:
+                number, prompt_id, prompt, extra_data, outputs_to_execute = json.loads(item)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Skipping prompt {prompt_id} of the queue journal: {e}")
+                continue
+            recovered.append((number, prompt_id, prompt, extra_data, outputs_to_execute))
+        self.compact()
+        if len(started) > 0:
+            logging.warning(f"Requeueing {len(started)} prompt(s) that were executing when the queue journal was last written")
+        return sorted(recovered, key=lambda item: item[0])
+
+    def compact(self):
+        self.connection.execute("""DELETE FROM prompt_queue_journal WHERE prompt_id IN
+            (SELECT prompt_id FROM prompt_queue_journal WHERE event IN (?, ?))""", (EVENT_DONE, EVENT_REMOVE))
+        self.finished_since_compact = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="queue-journal", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.closed:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to write the prompt queue journal")
+
+    def flush(self):
+        with self.lock:
+            # Serialize one item at a time so enqueueing never waits for a whole batch
+            while len(self.unserialized) > 0:
+                self.serialize_pending(next(iter(self.unserialized)))
+                self.lock.release()
+                self.lock.acquire()
+            events = self.pending_events
+            self.pending_events = []
+        if len(events) == 0:
+            return
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT INTO prompt_queue_journal (event, prompt_id, number, item, created_at) VALUES (?, ?, ?, ?, ?)", events)
+        self.finished_since_compact += sum(1 for event in events if event[0] in (EVENT_DONE, EVENT_REMOVE))
+        if self.finished_since_compact >= self.COMPACT_INTERVAL:
+            self.compact()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+        self.connection.close()
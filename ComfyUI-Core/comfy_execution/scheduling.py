@@ -0,0 +1,149 @@
+from __future__ import annotations
+import threading
+
+from comfy_execution.caching import estimate_memory_usage
+from comfy_execution.graph import ExecutionList
+from comfy_execution.graph_utils import is_link
+
+SCHEDULING_POLICIES = ("ux", "critical-path", "critical-path-memory")
+
+
+class NodeTimingStats:
+    """
+    Exponential moving average of the execution time of every node class, fed by
+    execution.execute with the time of each node that wasn't cached.
+    """
+    def __init__(self, smoothing=0.3, default_estimate=1.0):
+        self.smoothing = smoothing
+        self.default_estimate = default_estimate
+        self.lock = threading.Lock()
+        self.estimates = {}
+        self.mean_estimate = None
+
+    def record(self, class_type, seconds):
+        with self.lock:
+            estimate = self.estimates.get(class_type)
+            if estimate is None:
+                estimate = seconds
+            else:
+                estimate += self.smoothing * (seconds - estimate)
+            self.estimates[class_type] = estimate
+            self.mean_estimate = sum(self.estimates.values()) / len(self.estimates)
+
+    def get_estimate(self, class_type):
+        """The expected execution time of class_type, the mean over all classes if it never ran"""
+        estimate = self.estimates.get(class_type)
+        if estimate is not None:
+            return estimate
+        mean_estimate = self.mean_estimate
+        return mean_estimate if mean_estimate is not None else self.default_estimate
+
+
+node_timing_stats = NodeTimingStats()
+
+
+class CriticalPathExecutionList(ExecutionList):
+    """
+    Picks the ready node with the longest remaining path to an output first, where the length of
+    a path is the sum of the expected execution times (NodeTimingStats) of its nodes. Starting
+    the longest chain early shortens the prompt when nodes run in parallel, and when executing
+    serially it still reaches the expensive part of the graph as early as possible.
+
+    Async nodes are still picked first so their work overlaps with everything else and ties are
+    broken by the ux ordering of ExecutionList.
+
+    With free_memory_first, ready nodes that consume the last pending reference to cached outputs
+    are picked before the critical path, weighted by the size of those outputs. This lowers the
+    peak memory with caches that drop outputs once nothing needs them anymore (--cache-none).
+    """
+    def __init__(self, dynprompt, output_cache, timing_stats=node_timing_stats, free_memory_first=False):
+        super().__init__(dynprompt, output_cache)
+        self.timing_stats = timing_stats
+        self.free_memory_first = free_memory_first
+        self.bottomLevels = {} # node_id -> longest expected time from the start of node_id to an output
+        self.consumers = {} # node_id -> pending nodes linked to an output of node_id
+        self.outputSizes = {} # node_id -> bytes of the output it produced in this prompt
+        self.graphChanged = True
+
+    def links_changed(self, node_id):
+        super().links_changed(node_id)
+        self.graphChanged = True
+
+    def node_ready(self, node_id):
+        super().node_ready(node_id)
+        if self.free_memory_first:
+            # Every pending node is reported ready once when it's added, links to cached nodes included
+            for producer_id in self.get_linked_producers(node_id):
+                self.consumers.setdefault(producer_id, set()).add(node_id)
+
+    def get_bottom_level(self, node_id):
+        levels = self.bottomLevels
+        stack = [(node_id, False)]
+        while len(stack) > 0:
+            current, expanded = stack.pop()
+            if current in levels:
+                continue
+            if expanded:
+                cost = self.timing_stats.get_estimate(self.dynprompt.get_node(current)["class_type"])
+                # levels.get guards against cycles, which are reported when nothing is ready
+                levels[current] = cost + max((levels.get(b, 0.0) for b in self.blocking.get(current, ())), default=0.0)
+            else:
+                stack.append((current, True))
+                for blocked_node_id in self.blocking.get(current, ()):
+                    if blocked_node_id not in levels:
+                        stack.append((blocked_node_id, False))
+        return levels[node_id]
+
+    def get_linked_producers(self, node_id):
+        inputs = self.dynprompt.get_node(node_id)["inputs"]
+        return {value[0] for value in inputs.values() if is_link(value)}
+
+    def get_freed_bytes(self, node_id):
+        freed = 0
+        for producer_id in self.get_linked_producers(node_id):
+            size = self.outputSizes.get(producer_id)
+            if size is not None and self.consumers.get(producer_id, set()) <= {node_id}:
+                freed += size
+        return freed
+
+    def get_pick_priority(self, node_id):
+        is_async = self.get_class_traits(node_id)[1]
+        priority = (0 if is_async else 1, -self.get_bottom_level(node_id), super().get_pick_priority(node_id))
+        if self.free_memory_first:
+            priority = (priority[0], -self.get_freed_bytes(node_id)) + priority[1:]
+        return priority
+
+    def pop_ready_node(self):
+        if self.graphChanged:
+            # New nodes or links change the remaining path of the nodes upstream of them
+            self.graphChanged = False
+            self.bottomLevels.clear()
+            for node_id in self.readyNodes:
+                self.dirtyNodes[node_id] = True
+        return super().pop_ready_node()
+
+    def pop_node(self, unique_id):
+        super().pop_node(unique_id)
+        if self.free_memory_first:
+            for producer_id in self.get_linked_producers(unique_id):
+                consumers = self.consumers.get(producer_id)
+                if consumers is None:
+                    continue
+                consumers.discard(unique_id)
+                if len(consumers) == 1:
+                    # The remaining consumer now frees the output
+                    self.dirtyNodes[next(iter(consumers))] = True
+
+    def output_produced(self, node_id, value):
+        if self.free_memory_first:
+            ram, vram = estimate_memory_usage(value)
+            self.outputSizes[node_id] = ram + vram
+
+
+def get_execution_list_class(policy):
+    """The ExecutionList factory for a --scheduling-policy"""
+    if policy == "critical-path":
+        return CriticalPathExecutionList
+    elif policy == "critical-path-memory":
+        return lambda dynprompt, output_cache: CriticalPathExecutionList(dynprompt, output_cache, free_memory_first=True)
+    return ExecutionList
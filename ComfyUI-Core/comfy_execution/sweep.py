@@ -0,0 +1,213 @@
+from __future__ import annotations
+import itertools
+from typing import NamedTuple
+
+import execution
+import nodes
+from comfy_execution.frozen import freeze
+from comfy_execution.graph_utils import is_link
+from comfy_execution.node_schema import get_node_schema
+from comfy_execution.scheduling import node_timing_stats
+
+SWEEP_MODES = ("grid", "zip")
+SWEEP_ORDERS = ("cache", "given")
+# Upper bound of the number of prompts a single sweep can queue
+MAXIMUM_SWEEP_VARIANTS = 10000
+
+
+class SweepError(Exception):
+    pass
+
+
+class SweepParameter(NamedTuple):
+    node_id: str
+    input_name: str
+    values: list
+
+
+def parse_sweep_parameters(prompt, parameters):
+    """The SweepParameters of the parameters of a sweep request, raises SweepError if they are invalid"""
+    if not isinstance(parameters, list) or len(parameters) == 0:
+        raise SweepError("parameters must be a non empty list")
+    parsed = []
+    for parameter in parameters:
+        if not isinstance(parameter, dict):
+            raise SweepError("Every parameter must be an object with node_id, input and values")
+        node_id = str(parameter.get("node_id"))
+        input_name = parameter.get("input")
+        values = parameter.get("values")
+        if node_id not in prompt:
+            raise SweepError(f"Node {node_id} of a parameter isn't in the prompt")
+        class_type = prompt[node_id].get("class_type")
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type)
+        if class_def is None:
+            raise SweepError(f"Node {node_id} has the unknown class_type {class_type}")
+        input_types = get_node_schema(class_def).visible_input_types
+        if input_name not in input_types.get("required", {}) and input_name not in input_types.get("optional", {}):
+            raise SweepError(f"{class_type} (node {node_id}) has no input {input_name}")
+        if not isinstance(values, list) or len(values) == 0:
+            raise SweepError(f"The values of {node_id}.{input_name} must be a non empty list")
+        if is_link(prompt[node_id].get("inputs", {}).get(input_name)):
+            raise SweepError(f"{node_id}.{input_name} is a linked input, only widget values can be swept")
+        if any(p.node_id == node_id and p.input_name == input_name for p in parsed):
+            raise SweepError(f"{node_id}.{input_name} is swept twice")
+        parsed.append(SweepParameter(node_id, input_name, values))
+    return parsed
+
+
+def get_variant_count(parameters, mode="grid"):
+    """The number of prompts the sweep queues, raises SweepError if the parameters don't fit mode"""
+    if mode not in SWEEP_MODES:
+        raise SweepError(f"Unknown sweep mode {mode}, expected one of {SWEEP_MODES}")
+    if mode == "zip":
+        count = len(parameters[0].values)
+        if any(len(p.values) != count for p in parameters):
+            raise SweepError("All parameters of a zip sweep need the same number of values")
+    else:
+        count = 1
+        for p in parameters:
+            count *= len(p.values)
+    if count > MAXIMUM_SWEEP_VARIANTS:
+        raise SweepError(f"The sweep has {count} variants, the maximum is {MAXIMUM_SWEEP_VARIANTS}")
+    return count
+
+
+async def validate_sweep_values(prompt_id, prompt, parameters, mode="grid"):
+    """
+    Validate the values of the parameters against the already validated prompt, which only has to
+    validate the swept nodes instead of the whole prompt per variant. When several inputs of a node
+    are swept, every combination of their values the sweep produces is validated, since
+    VALIDATE_INPUTS can reject combinations of values that are valid on their own. Returns the
+    parameters with their values converted like validate_inputs does, and the node errors.
+    """
+    # Every other node passed the validation of the whole prompt
+    base_validated = {node_id: (True, [], node_id) for node_id in prompt}
+    converted = [list(p.values) for p in parameters]
+    node_errors = {}
+    node_parameters = {}
+    for index, parameter in enumerate(parameters):
+        node_parameters.setdefault(parameter.node_id, []).append(index)
+    for node_id, indices in node_parameters.items():
+        if mode == "zip":
+            combinations = [(i,) * len(indices) for i in range(len(parameters[indices[0]].values))]
+        else:
+            combinations = itertools.product(*[range(len(parameters[index].values)) for index in indices])
+        node = prompt[node_id]
+        for combination in combinations:
+            inputs = dict(node["inputs"])
+            for index, i in zip(indices, combination):
+                inputs[parameters[index].input_name] = parameters[index].values[i]
+            variant = dict(prompt)
+            variant[node_id] = dict(node, inputs=inputs)
+            validated = dict(base_validated)
+            del validated[node_id]
+            try:
+                valid, reasons, _ = await execution.validate_inputs(prompt_id, variant, node_id, validated)
+            except Exception as ex:
+                valid, reasons = False, [{
+                    "type": "exception_during_validation",
+                    "message": "Exception when validating node",
+                    "details": str(ex),
+                    "extra_info": {},
+                }]
+            if not valid:
+                errors = node_errors.setdefault(node_id, {"errors": [], "dependent_outputs": [], "class_type": node["class_type"]})
+                errors["errors"].extend(reasons)
+            for index, i in zip(indices, combination):
+                converted[index][i] = inputs[parameters[index].input_name]
+    return [SweepParameter(p.node_id, p.input_name, values) for p, values in zip(parameters, converted)], node_errors
+
+
+def get_invalidation_cost(prompt, node_id, outputs):
+    """
+    The expected time to execute node_id and everything that depends on it (up to outputs) again, which
+    is what changing one of its inputs costs when everything else is cached
+    """
+    dependents = {}
+    needed = set()
+    stack = list(outputs)
+    while len(stack) > 0:
+        current = stack.pop()
+        if current in needed:
+            continue
+        needed.add(current)
+        for value in prompt[current]["inputs"].values():
+            if is_link(value) and value[0] in prompt:
+                dependents.setdefault(value[0], set()).add(current)
+                stack.append(value[0])
+    invalidated = set()
+    stack = [node_id]
+    while len(stack) > 0:
+        current = stack.pop()
+        if current in invalidated or current not in needed:
+            continue
+        invalidated.add(current)
+        stack.extend(dependents.get(current, ()))
+    return sum(node_timing_stats.get_estimate(prompt[n]["class_type"]) for n in invalidated)
+
+
+def order_parameters_for_cache(prompt, parameters, outputs):
+    """
+    The parameters from outermost to innermost so consecutive variants reuse as much of the cache as
+    possible: the parameter whose changes invalidate the least (usually the most downstream one) varies
+    fastest.
+    """
+    costs = [get_invalidation_cost(prompt, p.node_id, outputs) for p in parameters]
+    order = sorted(range(len(parameters)), key=lambda i: -costs[i])
+    return [parameters[i] for i in order]
+
+
+def iterate_variant_indices(sizes, serpentine):
+    """
+    Index tuples of the grid of the given sizes, last index varying fastest. In serpentine order inner
+    indices sweep back and forth, so the values of the inner parameters stay the same when an outer one
+    changes, which keeps the outputs of nodes that only depend on the inner parameters cached.
+    """
+    if not serpentine:
+        yield from itertools.product(*[range(size) for size in sizes])
+        return
+    total = 1
+    for size in sizes:
+        total *= size
+    for n in range(total):
+        indices = []
+        # Mixed radix digits of n, each reflected when the digits above it are odd
+        remaining = n
+        radices = []
+        for size in reversed(sizes):
+            radices.append(remaining % size)
+            remaining //= size
+        radices.reverse()
+        above = 0
+        for size, digit in zip(sizes, radices):
+            indices.append(digit if above % 2 == 0 else size - 1 - digit)
+            above = above * size + digit
+        yield tuple(indices)
+
+
+def expand_sweep(prompt, parameters, outputs, mode="grid", order="cache"):
+    """
+    The variants of the sweep as (prompt, values) pairs, values mapping "node_id.input" to the value of
+    every parameter. The prompt is frozen once and every variant shares all the nodes it doesn't change.
+    """
+    if order not in SWEEP_ORDERS:
+        raise SweepError(f"Unknown sweep order {order}, expected one of {SWEEP_ORDERS}")
+    count = get_variant_count(parameters, mode)
+    if mode == "zip":
+        indices = [(i,) * len(parameters) for i in range(count)]
+    else:
+        if order == "cache":
+            parameters = order_parameters_for_cache(prompt, parameters, outputs)
+        indices = iterate_variant_indices([len(p.values) for p in parameters], order == "cache")
+
+    prompt = freeze(prompt)
+    variants = []
+    for variant_indices in indices:
+        variant = prompt
+        values = {}
+        for p, i in zip(parameters, variant_indices):
+            node = variant[p.node_id]
+            variant = variant.set(p.node_id, node.set("inputs", node["inputs"].set(p.input_name, p.values[i])))
+            values[f"{p.node_id}.{p.input_name}"] = p.values[i]
+        variants.append((variant, values))
+    return variants
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import nodes
+from comfy_execution.caching import SIGNATURE_DIGEST_SIZE, update_signature_hash
+
+
+class ValidationCache:
+    """
+    Remembers which nodes passed validate_inputs so resubmitting a workflow only revalidates the
+    nodes whose inputs changed.
+
+    Entries are keyed on the local part of a node's validation: its class_type, its constant
+    inputs and the type each linked input receives. Whether the linked nodes are valid is not
+    part of the key, validate_inputs still visits them (which is cheap when they hit too). Only
+    successful validations are stored, together with the converted constant values that
+    validate_inputs writes back into the prompt. Nodes with a VALIDATE_INPUTS/validate_inputs
+    function are never cached, since what it checks (e.g. that a file exists) isn't in the key.
+
+    An entry is only used while the NodeSchema it was validated against is current, so anything
+    that invalidates the schema registry (e.g. new files in a model folder) invalidates the
+    validations of the affected classes as well.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (schema, converted_inputs)
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, prompt, unique_id) -> Optional[str]:
+        """The key of the node, None if the node can't be cached (e.g. a malformed link)."""
+        node = prompt[unique_id]
+        hasher = hashlib.blake2b(digest_size=SIGNATURE_DIGEST_SIZE)
+        if not update_signature_hash(hasher, node["class_type"]):
+            return None
+        for name, value in sorted(node["inputs"].items()):
+            if not update_signature_hash(hasher, name):
+                return None
+            if isinstance(value, list):
+                received_type = self.get_received_type(prompt, value)
+                if received_type is None:
+                    return None
+                hasher.update(b"link:")
+                if not update_signature_hash(hasher, received_type):
+                    return None
+            else:
+                hasher.update(b"value:")
+                if not update_signature_hash(hasher, value):
+                    return None
+        return hasher.hexdigest()
+
+    @staticmethod
+    def get_received_type(prompt, link):
+        if len(link) != 2 or not isinstance(link[1], int) or isinstance(link[1], bool):
+            return None
+        linked_node = prompt.get(link[0])
+        if not isinstance(linked_node, dict):
+            return None
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(linked_node.get("class_type"))
+        if class_def is None:
+            return None
+        return_types = class_def.RETURN_TYPES
+        if not 0 <= link[1] < len(return_types):
+            return None
+        return return_types[link[1]]
+
+    def get(self, key, schema) -> Optional[dict]:
+        """The converted constant inputs stored for key, None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] is not schema:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, schema, converted_inputs):
+        with self.lock:
+            self.entries[key] = (schema, converted_inputs)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+validation_cache = ValidationCache()
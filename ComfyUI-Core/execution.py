@@ -1,3 +1,4 @@
+import contextvars
 import copy
 import heapq
 import inspect
@@ -9,16 +10,21 @@ import traceback
 from enum import Enum
 from typing import List, Literal, NamedTuple, Optional, Union
 import asyncio
+import concurrent.futures
 
 import torch
 
 import comfy.model_management
 import nodes
+from comfy_execution.batching import BatchingError, split_batched_result, stack_list_inputs
 from comfy_execution.caching import (
     BasicCache,
+    ByteBudgetCache,
     CacheKeySetID,
     CacheKeySetInputSignature,
+    CostAwareCache,
     DependencyAwareCache,
+    DiskSpillTier,
     HierarchicalCache,
     LRUCache,
 )
@@ -26,10 +32,30 @@ from comfy_execution.graph import (
     DynamicPrompt,
     ExecutionBlocker,
     ExecutionList,
+    LoopBodyError,
+    LoopSchedule,
     get_input_info,
 )
-from comfy_execution.graph_utils import GraphBuilder, is_link
+from comfy_execution.graph_optimization import eliminate_common_subexpressions
+from comfy_execution.graph_utils import GraphBuilder, LoopBody, is_link
+from comfy_execution.frozen import FrozenDict, freeze
+from comfy_execution.history_store import HistoryStore
+from comfy_execution.node_schema import get_node_schema, refresh_node_schemas
 from comfy_execution.validation import validate_node_input
+from comfy_execution.validation_cache import validation_cache
+from comfy_execution.metrics import (
+    interrupts,
+    node_cache_lookups,
+    node_duration_seconds,
+    node_failures,
+    prompt_duration_seconds,
+    prompts_executed,
+    queue_dequeued,
+    queue_enqueued,
+    queue_wait_seconds,
+)
+from comfy_execution.profiler import ExecutionProfiler, mark_cache_hit, profile_cpu_time, profile_phase
+from comfy_execution.scheduling import get_execution_list_class, node_timing_stats
 from comfy_execution.progress import get_progress_state, reset_progress_state, add_progress_handler, WebUIProgressHandler
 from comfy_execution.utils import CurrentNodeContext
 from comfy_api.internal import _ComfyNodeInternal, _NodeOutputInternal, first_real_override, is_class, make_locked_method_func
@@ -45,11 +71,12 @@ class DuplicateNodeError(Exception):
     pass
 
 class IsChangedCache:
-    def __init__(self, prompt_id: str, dynprompt: DynamicPrompt, outputs_cache: BasicCache):
+    def __init__(self, prompt_id: str, dynprompt: DynamicPrompt, outputs_cache: BasicCache, is_changed=None):
         self.prompt_id = prompt_id
         self.dynprompt = dynprompt
         self.outputs_cache = outputs_cache
-        self.is_changed = {}
+        # Kept here rather than in the (frozen) prompt, so it can be passed on to a rewritten prompt
+        self.is_changed = dict(is_changed) if is_changed is not None else {}
 
     async def get(self, node_id):
         if node_id in self.is_changed:
@@ -79,12 +106,10 @@ class IsChangedCache:
         try:
             is_changed = await _async_map_node_over_list(self.prompt_id, node_id, class_def, input_data_all, is_changed_name)
             is_changed = await resolve_map_node_over_list_results(is_changed)
-            node["is_changed"] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
+            self.is_changed[node_id] = [None if isinstance(x, ExecutionBlocker) else x for x in is_changed]
         except Exception as e:
             logging.warning("WARNING: {}".format(e))
-            node["is_changed"] = float("NaN")
-        finally:
-            self.is_changed[node_id] = node["is_changed"]
+            self.is_changed[node_id] = float("NaN")
         return self.is_changed[node_id]
 
 
@@ -92,10 +117,22 @@ class CacheType(Enum):
     CLASSIC = 0
     LRU = 1
     DEPENDENCY_AWARE = 2
+    BYTE_BUDGET = 3
+    COST_AWARE = 4
 
 
 class CacheSet:
-    def __init__(self, cache_type=None, cache_size=None):
+    def __init__(self, cache_type=None, cache_size=None, cache_spill=None, persistent_store=None):
+        # cache_spill is an optional (directory, max_size_in_bytes) pair for a disk tier under the output cache.
+        # Only caches that evict by size or budget spill, the others drop whatever the prompt doesn't use.
+        self.spill_tier = None
+        if cache_spill is not None and cache_type not in (CacheType.LRU, CacheType.BYTE_BUDGET, CacheType.COST_AWARE):
+            logging.warning("The cache spill directory is only used with the LRU and byte budget caches, ignoring it.")
+        elif cache_spill is not None:
+            spill_directory, spill_size = cache_spill
+            self.spill_tier = DiskSpillTier(spill_directory, spill_size)
+            logging.info("Spilling evicted node outputs to {} (up to {:.2f} GB)".format(self.spill_tier.directory, spill_size / (1024 ** 3)))
+
         if cache_type == CacheType.DEPENDENCY_AWARE:
             self.init_dependency_aware_cache()
             logging.info("Disabling intermediate node cache.")
@@ -104,22 +141,38 @@ class CacheSet:
                 cache_size = 0
             self.init_lru_cache(cache_size)
             logging.info("Using LRU cache")
+        elif cache_type == CacheType.BYTE_BUDGET:
+            ram_budget, vram_budget = cache_size
+            self.init_byte_budget_cache(ram_budget, vram_budget)
+            logging.info("Using byte budget cache (RAM: {:.2f} GB, VRAM: {:.2f} GB)".format(ram_budget / (1024 ** 3), vram_budget / (1024 ** 3)))
+        elif cache_type == CacheType.COST_AWARE:
+            ram_budget, vram_budget = cache_size
+            self.init_byte_budget_cache(ram_budget, vram_budget, cache_class=CostAwareCache)
+            logging.info("Using cost aware cache (RAM: {:.2f} GB, VRAM: {:.2f} GB)".format(ram_budget / (1024 ** 3), vram_budget / (1024 ** 3)))
         else:
             self.init_classic_cache()
 
+        # Outputs of opted-in nodes are also read from and written to the persistent store
+        self.outputs.persistent_store = persistent_store
         self.all = [self.outputs, self.ui, self.objects]
 
     # Performs like the old cache -- dump data ASAP
     def init_classic_cache(self):
-        self.outputs = HierarchicalCache(CacheKeySetInputSignature)
+        self.outputs = HierarchicalCache(CacheKeySetInputSignature, spill_tier=self.spill_tier)
         self.ui = HierarchicalCache(CacheKeySetInputSignature)
         self.objects = HierarchicalCache(CacheKeySetID)
 
     def init_lru_cache(self, cache_size):
-        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
+        self.outputs = LRUCache(CacheKeySetInputSignature, max_size=cache_size, spill_tier=self.spill_tier)
         self.ui = LRUCache(CacheKeySetInputSignature, max_size=cache_size)
         self.objects = HierarchicalCache(CacheKeySetID)
 
+    # cache_size is a (ram_budget, vram_budget) pair in bytes
+    def init_byte_budget_cache(self, ram_budget, vram_budget, cache_class=ByteBudgetCache):
+        self.outputs = cache_class(CacheKeySetInputSignature, ram_budget, vram_budget, spill_tier=self.spill_tier)
+        self.ui = ByteBudgetCache(CacheKeySetInputSignature, ram_budget, vram_budget)
+        self.objects = HierarchicalCache(CacheKeySetID)
+
     # only hold cached items while the decendents have not executed
     def init_dependency_aware_cache(self):
         self.outputs = DependencyAwareCache(CacheKeySetInputSignature)
@@ -135,12 +188,19 @@ class CacheSet:
 
 SENSITIVE_EXTRA_DATA_KEYS = ("auth_token_comfy_org", "api_key_comfy_org")
 
+def strip_sensitive_extra_data(item):
+    """item without the sensitive keys of its extra_data, for storing in the history"""
+    extra_data = item[3]
+    if any(sensitive_val in extra_data for sensitive_val in SENSITIVE_EXTRA_DATA_KEYS):
+        extra_data = FrozenDict({k: v for k, v in extra_data.items() if k not in SENSITIVE_EXTRA_DATA_KEYS})
+        item = item[:3] + (extra_data,) + item[4:]
+    return item
+
 def get_input_data(inputs, class_def, unique_id, outputs=None, dynprompt=None, extra_data={}):
     is_v3 = issubclass(class_def, _ComfyNodeInternal)
-    if is_v3:
-        valid_inputs, schema = class_def.INPUT_TYPES(include_hidden=False, return_schema=True)
-    else:
-        valid_inputs = class_def.INPUT_TYPES()
+    node_schema = get_node_schema(class_def)
+    valid_inputs = node_schema.visible_input_types
+    schema = node_schema.v3_schema
     input_data_all = {}
     missing_keys = {}
     hidden_inputs_v3 = {}
@@ -214,7 +274,17 @@ async def resolve_map_node_over_list_results(results):
                 raise exc
         return [x.result() if isinstance(x, asyncio.Task) else x for x in results]
 
-async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None, hidden_inputs=None):
+async def _run_sync_node_function(sync_executor, f, inputs, prompt_id, unique_id, list_index):
+    # The worker thread gets a copy of the caller's contextvars (progress registry, GraphBuilder
+    # prefix) and the inference mode, which is thread local in torch.
+    inference_mode = torch.is_inference_mode_enabled()
+    context = contextvars.copy_context()
+    def run():
+        with torch.inference_mode(inference_mode), CurrentNodeContext(prompt_id, unique_id, list_index), profile_cpu_time():
+            return f(**inputs)
+    return await asyncio.get_running_loop().run_in_executor(sync_executor, context.run, run)
+
+async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, func, allow_interrupt=False, execution_block_cb=None, pre_execute_cb=None, hidden_inputs=None, sync_executor=None, allow_batching=False):
     # check if node wants the lists
     input_is_list = getattr(obj, "INPUT_IS_LIST", False)
 
@@ -223,12 +293,18 @@ async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, f
     else:
         max_len_input = max(len(x) for x in input_data_all.values())
 
+    # check if node can process all the list items in one call (only FUNCTION, not its helpers)
+    batch = None
+    if allow_batching and not input_is_list and max_len_input > 1 and getattr(obj, "INPUT_IS_BATCHED", False) and not any(getattr(obj, "OUTPUT_IS_LIST", None) or ()):
+        batch = stack_list_inputs(input_data_all, max_len_input)
+
     # get a slice of inputs, repeat last input when list isn't long enough
     def slice_dict(d, i):
         return {k: v[i if len(v) > i else -1] for k, v in d.items()}
 
     results = []
     async def process_inputs(inputs, index=None, input_is_list=False):
+        # The return value of func for inputs, a Task if it's still running
         if allow_interrupt:
             nodes.before_node_execution()
         execution_block = None
@@ -268,25 +344,44 @@ async def _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, f
                 # Give the task a chance to execute without yielding
                 await asyncio.sleep(0)
                 if task.done():
-                    result = task.result()
-                    results.append(result)
-                else:
-                    results.append(task)
+                    return task.result()
+                return task
+            elif sync_executor is not None:
+                return await _run_sync_node_function(sync_executor, f, inputs, prompt_id, unique_id, index)
             else:
-                with CurrentNodeContext(prompt_id, unique_id, index):
-                    result = f(**inputs)
-                results.append(result)
+                with CurrentNodeContext(prompt_id, unique_id, index), profile_cpu_time():
+                    return f(**inputs)
         else:
-            results.append(execution_block)
+            return execution_block
+
+    async def process_items():
+        return [await process_inputs(slice_dict(input_data_all, i), i) for i in range(max_len_input)]
+
+    def split(result):
+        try:
+            return split_batched_result(result, max_len_input, batch_sizes)
+        except BatchingError as e:
+            # FUNCTION already ran for all the items, calling it again per item would repeat its side effects
+            raise BatchingError(f"Node {unique_id} declares INPUT_IS_BATCHED but its result can't be split into {max_len_input} items: {e}") from e
 
     if input_is_list:
-        await process_inputs(input_data_all, 0, input_is_list=input_is_list)
+        results.append(await process_inputs(input_data_all, 0, input_is_list=input_is_list))
     elif max_len_input == 0:
-        await process_inputs({})
+        results.append(await process_inputs({}))
+    elif batch is not None:
+        batch_inputs, batch_sizes = batch
+        result = await process_inputs(batch_inputs, 0)
+        if isinstance(result, asyncio.Task):
+            async def split_when_done():
+                return split(await result)
+            split_task = asyncio.create_task(split_when_done())
+            async def get_item(i):
+                return (await split_task)[i]
+            results.extend(asyncio.create_task(get_item(i)) for i in range(max_len_input))
+        else:
+            results.extend(split(result))
     else:
-        for i in range(max_len_input):
-            input_dict = slice_dict(input_data_all, i)
-            await process_inputs(input_dict, i)
+        results.extend(await process_items())
     return results
 
 
@@ -311,8 +406,8 @@ def merge_result_data(results, obj):
             output.append([o[i] for o in results])
     return output
 
-async def get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=None, pre_execute_cb=None, hidden_inputs=None):
-    return_values = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, hidden_inputs=hidden_inputs)
+async def get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=None, pre_execute_cb=None, hidden_inputs=None, sync_executor=None):
+    return_values = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, obj.FUNCTION, allow_interrupt=True, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, hidden_inputs=hidden_inputs, sync_executor=sync_executor, allow_batching=True)
     has_pending_task = any(isinstance(r, asyncio.Task) and not r.done() for r in return_values)
     if has_pending_task:
         return return_values, {}, False, has_pending_task
@@ -392,7 +487,100 @@ def format_value(x):
     else:
         return str(x)
 
-async def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes):
+async def execute_loop_node(server, dynprompt, caches, node_id, objects, outputs, extra_data, prompt_id, sync_executor=None):
+    node = dynprompt.get_node(node_id)
+    class_def = nodes.NODE_CLASS_MAPPINGS[node["class_type"]]
+    input_data_all, _, hidden_inputs = get_input_data(node["inputs"], class_def, node_id, outputs, dynprompt, extra_data)
+    obj = objects.get(node_id)
+    if obj is None:
+        obj = objects[node_id] = class_def()
+    def pre_execute_cb(call_index):
+        GraphBuilder.set_default_prefix(node_id, call_index, 0)
+    return_values = await _async_map_node_over_list(prompt_id, node_id, obj, input_data_all, obj.FUNCTION, allow_interrupt=True, pre_execute_cb=pre_execute_cb, hidden_inputs=hidden_inputs, sync_executor=sync_executor, allow_batching=True)
+    return_values = await resolve_map_node_over_list_results(return_values)
+    output_data, output_ui, has_subgraph = get_output_from_returns(return_values, class_def)
+    if has_subgraph:
+        results = []
+        for new_graph, node_outputs in output_data:
+            if new_graph is None:
+                results.append(node_outputs)
+            elif isinstance(new_graph, LoopBody):
+                results.append(await execute_loop(server, dynprompt, caches, node_id, new_graph, node_outputs, extra_data, prompt_id, sync_executor))
+            else:
+                raise LoopBodyError(f"Node {node_id} in a loop body expanded a subgraph, only loops can be nested in loop bodies")
+        output_data = merge_result_data(results, class_def)
+    return output_data, output_ui
+
+async def execute_loop(server, dynprompt, caches, unique_id, loop, result, extra_data, prompt_id, sync_executor=None):
+    """
+    Run the LoopBody returned by node unique_id and return its result. The body is added to dynprompt
+    and scheduled once, and every iteration overwrites the outputs of the previous one and reuses the
+    node objects, instead of adding ephemeral nodes, subcaches and execution list entries per iteration.
+    """
+    # Nodes returning only a loop (e.g. output nodes) have no result
+    result = result or []
+    graph = loop.finalize()
+    for node_id, node_info in graph.items():
+        # A loop nested in another one adds the same nodes again in every iteration of the outer loop
+        if dynprompt.has_node(node_id) and dynprompt.get_parent_node_id(node_id) != unique_id:
+            raise DuplicateNodeError(f"Attempt to add duplicate node {node_id}. Ensure node ids are unique and deterministic or use graph_utils.GraphBuilder.")
+        display_id = node_info.get("override_display_id", unique_id)
+        dynprompt.add_ephemeral_node(node_id, node_info, unique_id, display_id)
+    targets = list(loop.next_state.values()) + [loop.condition] + list(result)
+    schedule = LoopSchedule(graph, loop.state_id, [value[0] for value in targets if is_link(value)])
+
+    outputs = {}
+    for node_id in schedule.external_node_ids:
+        node_output = caches.outputs.get(node_id)
+        if node_output is None:
+            raise LoopBodyError(f"The loop body of node {unique_id} links to node {node_id}, which hasn't been executed. Pass the value as an input of node {unique_id} instead.")
+        outputs[node_id] = node_output
+    def resolve(value):
+        if is_link(value):
+            return outputs[value[0]][value[1]]
+        return [value]
+    outputs[loop.state_id] = [resolve(value) for value in loop.initial_state]
+
+    objects = {}
+    iteration = 0
+    while loop.max_iterations is None or iteration < loop.max_iterations:
+        comfy.model_management.throw_exception_if_processing_interrupted()
+        for node_id in schedule.order:
+            outputs[node_id], output_ui = await execute_loop_node(server, dynprompt, caches, node_id, objects, outputs, extra_data, prompt_id, sync_executor)
+            if len(output_ui) > 0 and server.client_id is not None:
+                server.send_sync("executed", { "node": node_id, "display_node": dynprompt.get_display_node_id(node_id), "output": output_ui, "prompt_id": prompt_id }, server.client_id)
+        outputs[loop.state_id] = [resolve(loop.next_state[name]) for name in loop.state_names]
+        iteration += 1
+        if loop.max_iterations is not None:
+            get_progress_state().update_progress(unique_id, iteration, loop.max_iterations)
+        if loop.condition is not None:
+            condition = resolve(loop.condition)
+            if len(condition) == 0 or isinstance(condition[0], ExecutionBlocker) or not condition[0]:
+                break
+
+    resolved_output = []
+    for r in result:
+        if is_link(r):
+            if r[0] not in outputs:
+                raise LoopBodyError(f"The result of node {unique_id} links to {r[0]}, which didn't run in its loop body")
+            for o in outputs[r[0]][r[1]]:
+                resolved_output.append(o)
+        else:
+            resolved_output.append(r)
+    return tuple(resolved_output)
+
+def add_execution_time(node_execution_times, unique_id, start_time):
+    # Nodes that return PENDING (lazy inputs, async tasks, expansions) are executed in several passes
+    node_execution_times[unique_id] = node_execution_times.get(unique_id, 0.0) + time.perf_counter() - start_time
+
+async def execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor=None, profiler=None):
+    if profiler is None:
+        return await _execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor)
+    node = dynprompt.get_node(current_item)
+    with profiler.node(current_item, node["class_type"], dynprompt.get_display_node_id(current_item)):
+        return await _execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor)
+
+async def _execute(server, dynprompt, caches, current_item, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor=None):
     unique_id = current_item
     real_node_id = dynprompt.get_real_node_id(unique_id)
     display_node_id = dynprompt.get_display_node_id(unique_id)
@@ -400,7 +588,12 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
     inputs = dynprompt.get_node(unique_id)['inputs']
     class_type = dynprompt.get_node(unique_id)['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-    if caches.outputs.get(unique_id) is not None:
+    with profile_phase("cache"):
+        cached = caches.outputs.get(unique_id)
+    if unique_id not in pending_async_nodes and unique_id not in pending_subgraph_results:
+        node_cache_lookups.inc(result="hit" if cached is not None else "miss")
+    if cached is not None:
+        mark_cache_hit()
         if server.client_id is not None:
             cached_output = caches.ui.get(unique_id) or {}
             server.send_sync("executed", { "node": unique_id, "display_node": display_node_id, "output": cached_output.get("output",None), "prompt_id": prompt_id }, server.client_id)
@@ -408,6 +601,7 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
         return (ExecutionResult.SUCCESS, None, None)
 
     input_data_all = None
+    start_time = time.perf_counter()
     try:
         if unique_id in pending_async_nodes:
             results = []
@@ -446,7 +640,8 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
             has_subgraph = False
         else:
             get_progress_state().start_progress(unique_id)
-            input_data_all, missing_keys, hidden_inputs = get_input_data(inputs, class_def, unique_id, caches.outputs, dynprompt, extra_data)
+            with profile_phase("input"):
+                input_data_all, missing_keys, hidden_inputs = get_input_data(inputs, class_def, unique_id, caches.outputs, dynprompt, extra_data)
             if server.client_id is not None:
                 server.last_node_id = display_node_id
                 server.send_sync("executing", { "node": unique_id, "display_node": display_node_id, "prompt_id": prompt_id }, server.client_id)
@@ -461,8 +656,9 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
             else:
                 lazy_status_present = getattr(obj, "check_lazy_status", None) is not None
             if lazy_status_present:
-                required_inputs = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, "check_lazy_status", allow_interrupt=True, hidden_inputs=hidden_inputs)
-                required_inputs = await resolve_map_node_over_list_results(required_inputs)
+                with profile_phase("function"):
+                    required_inputs = await _async_map_node_over_list(prompt_id, unique_id, obj, input_data_all, "check_lazy_status", allow_interrupt=True, hidden_inputs=hidden_inputs)
+                    required_inputs = await resolve_map_node_over_list_results(required_inputs)
                 required_inputs = set(sum([r for r in required_inputs if isinstance(r,list)], []))
                 required_inputs = [x for x in required_inputs if isinstance(x,str) and (
                     x not in input_data_all or x in missing_keys
@@ -470,6 +666,7 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
                 if len(required_inputs) > 0:
                     for i in required_inputs:
                         execution_list.make_input_strong_link(unique_id, i)
+                    add_execution_time(node_execution_times, unique_id, start_time)
                     return (ExecutionResult.PENDING, None, None)
 
             def execution_block_cb(block):
@@ -491,15 +688,19 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
                 else:
                     return block
             def pre_execute_cb(call_index):
-                # TODO - How to handle this with async functions without contextvars (which requires Python 3.12)?
+                # The default prefix lives in a contextvar, so nodes executing concurrently in other tasks
+                # or worker threads each see their own prefix.
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
-            output_data, output_ui, has_subgraph, has_pending_tasks = await get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, hidden_inputs=hidden_inputs)
+            with profile_phase("function"):
+                output_data, output_ui, has_subgraph, has_pending_tasks = await get_output_data(prompt_id, unique_id, obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb, hidden_inputs=hidden_inputs, sync_executor=sync_executor)
             if has_pending_tasks:
                 pending_async_nodes[unique_id] = output_data
                 unblock = execution_list.add_external_block(unique_id)
                 async def await_completion():
                     tasks = [x for x in output_data if isinstance(x, asyncio.Task)]
                     await asyncio.gather(*tasks, return_exceptions=True)
+                    # Includes the time the tasks ran after this pass returned
+                    add_execution_time(node_execution_times, unique_id, start_time)
                     unblock()
                 asyncio.create_task(await_completion())
                 return (ExecutionResult.PENDING, None, None)
@@ -524,6 +725,9 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
                 new_graph, node_outputs = output_data[i]
                 if new_graph is None:
                     cached_outputs.append((False, node_outputs))
+                elif isinstance(new_graph, LoopBody):
+                    node_outputs = await execute_loop(server, dynprompt, caches, unique_id, new_graph, node_outputs, extra_data, prompt_id, sync_executor)
+                    cached_outputs.append((False, node_outputs))
                 else:
                     # Check for conflicts
                     for node_id in new_graph.keys():
@@ -543,17 +747,28 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
                             from_node_id, from_socket = node_outputs[i][0], node_outputs[i][1]
                             new_output_links.append((from_node_id, from_socket))
                     cached_outputs.append((True, node_outputs))
-            new_node_ids = set(new_node_ids)
-            for cache in caches.all:
-                subcache = await cache.ensure_subcache_for(unique_id, new_node_ids)
-                subcache.clean_unused()
-            for node_id in new_output_ids:
-                execution_list.add_node(node_id)
-            for link in new_output_links:
-                execution_list.add_strong_link(link[0], link[1], unique_id)
-            pending_subgraph_results[unique_id] = cached_outputs
-            return (ExecutionResult.PENDING, None, None)
-        caches.outputs.set(unique_id, output_data)
+            if all(not is_subgraph for is_subgraph, _ in cached_outputs):
+                # Only loops, which have already run
+                output_data = merge_result_data([r for _, r in cached_outputs], class_def)
+            else:
+                new_node_ids = set(new_node_ids)
+                for cache in caches.all:
+                    subcache = await cache.ensure_subcache_for(unique_id, new_node_ids)
+                    subcache.clean_unused()
+                for node_id in new_output_ids:
+                    execution_list.add_node(node_id)
+                for link in new_output_links:
+                    execution_list.add_strong_link(link[0], link[1], unique_id)
+                pending_subgraph_results[unique_id] = cached_outputs
+                add_execution_time(node_execution_times, unique_id, start_time)
+                return (ExecutionResult.PENDING, None, None)
+        execution_time = node_execution_times.pop(unique_id, 0.0) + time.perf_counter() - start_time
+        caches.outputs.set_execution_cost(unique_id, execution_time)
+        node_duration_seconds.observe(execution_time, class_type=class_type)
+        node_timing_stats.record(class_type, execution_time)
+        with profile_phase("cache"):
+            caches.outputs.set(unique_id, output_data)
+        execution_list.output_produced(unique_id, output_data)
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -597,14 +812,30 @@ async def execute(server, dynprompt, caches, current_item, extra_data, executed,
     return (ExecutionResult.SUCCESS, None, None)
 
 class PromptExecutor:
-    def __init__(self, server, cache_type=False, cache_size=None):
+    def __init__(self, server, cache_type=False, cache_size=None, max_parallel_nodes=1, cache_spill=None, persistent_store=None, eliminate_common_subexpressions=False, profile=False, scheduling_policy="ux", offload_sync_nodes=False, distributed=None):
+        self.eliminate_common_subexpressions = eliminate_common_subexpressions
+        self.profile = profile
+        self.execution_list_class = get_execution_list_class(scheduling_policy)
         self.cache_size = cache_size
         self.cache_type = cache_type
+        self.cache_spill = cache_spill
+        self.persistent_store = persistent_store
+        # DistributedCoordinator executing the subgraphs up to the cut points of prompts on other processes
+        self.distributed = distributed
         self.server = server
+        self.max_parallel_nodes = max(1, max_parallel_nodes)
+        # Sync node functions run in this pool when independent nodes are executed concurrently. With
+        # offload_sync_nodes they run on a dedicated thread even when executing one node at a time,
+        # which keeps the event loop free for async nodes, their pending tasks and progress updates.
+        self.sync_executor = None
+        if self.max_parallel_nodes > 1:
+            self.sync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel_nodes, thread_name_prefix="node-executor")
+        elif offload_sync_nodes:
+            self.sync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="node-executor")
         self.reset()
 
     def reset(self):
-        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size)
+        self.caches = CacheSet(cache_type=self.cache_type, cache_size=self.cache_size, cache_spill=self.cache_spill, persistent_store=self.persistent_store)
         self.status_messages = []
         self.success = True
 
@@ -624,6 +855,7 @@ class PromptExecutor:
         # First, send back the status to the frontend depending
         # on the exception type
         if isinstance(ex, comfy.model_management.InterruptProcessingException):
+            interrupts.inc()
             mes = {
                 "prompt_id": prompt_id,
                 "node_id": node_id,
@@ -632,6 +864,7 @@ class PromptExecutor:
             }
             self.add_message("execution_interrupted", mes, broadcast=True)
         else:
+            node_failures.inc(class_type=class_type)
             mes = {
                 "prompt_id": prompt_id,
                 "node_id": node_id,
@@ -645,10 +878,59 @@ class PromptExecutor:
             }
             self.add_message("execution_error", mes, broadcast=False)
 
-    def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
-        asyncio.run(self.execute_async(prompt, prompt_id, extra_data, execute_outputs))
+    async def execute_parallel(self, dynamic_prompt, prompt_id, extra_data, executed, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, profiler=None):
+        """
+        Execute the ready nodes of execution_list concurrently, up to max_parallel_nodes at a time.
+        Sync node functions run in the executor's thread pool while async ones stay on the event loop.
+        All cache writes and execution list updates happen on the event loop. Returns the error
+        details and exception of the first failure (or cycle), otherwise (None, None).
+        """
+        running = {}
+        unblock_waiter = None
+        try:
+            while not execution_list.is_empty():
+                for node_id in execution_list.stage_ready_nodes(self.max_parallel_nodes - len(running)):
+                    task = asyncio.create_task(execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor=self.sync_executor, profiler=profiler))
+                    running[task] = node_id
+
+                waiting = set(running)
+                if execution_list.externalBlocks > 0:
+                    if unblock_waiter is None:
+                        unblock_waiter = asyncio.create_task(execution_list.wait_for_unblock())
+                    waiting.add(unblock_waiter)
+                if len(waiting) == 0:
+                    return execution_list.get_cycle_error()
+
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if unblock_waiter in done:
+                    unblock_waiter = None
+                for task in done:
+                    node_id = running.pop(task, None)
+                    if node_id is None:
+                        continue
+                    result, error, ex = task.result()
+                    self.success = result != ExecutionResult.FAILURE
+                    if result == ExecutionResult.FAILURE:
+                        # Let the nodes that are already running finish so no worker thread is still
+                        # writing to the caches once the error is reported.
+                        if len(running) > 0:
+                            await asyncio.wait(running)
+                        return error, ex
+                    elif result == ExecutionResult.PENDING:
+                        execution_list.unstage_node(node_id)
+                    else: # result == ExecutionResult.SUCCESS:
+                        execution_list.complete_node(node_id)
+            return None, None
+        finally:
+            if unblock_waiter is not None:
+                unblock_waiter.cancel()
 
-    async def execute_async(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
+    def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[], preset_outputs=None):
+        # Prompts of other workers executing at the same time keep their own interrupt flags
+        with comfy.model_management.interrupt_scope(prompt_id):
+            asyncio.run(self.execute_async(prompt, prompt_id, extra_data, execute_outputs, preset_outputs))
+
+    async def execute_async(self, prompt, prompt_id, extra_data={}, execute_outputs=[], preset_outputs=None):
         nodes.interrupt_processing(False)
 
         if "client_id" in extra_data:
@@ -658,18 +940,39 @@ class PromptExecutor:
 
         self.status_messages = []
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
+        execution_start_time = time.perf_counter()
+
+        profiler = None
+        if self.profile or extra_data.get("profile", False):
+            profiler = ExecutionProfiler(prompt_id, comfy.model_management.get_torch_device())
 
         with torch.inference_mode():
             dynamic_prompt = DynamicPrompt(prompt)
+            is_changed_cache = IsChangedCache(prompt_id, dynamic_prompt, self.caches.outputs)
+            if self.eliminate_common_subexpressions:
+                optimized_prompt, merged = await eliminate_common_subexpressions(dynamic_prompt, is_changed_cache, execute_outputs)
+                if len(merged) > 0:
+                    # Hidden PROMPT inputs still receive the prompt as submitted
+                    dynamic_prompt = DynamicPrompt(optimized_prompt, user_prompt=prompt)
+                    # The constant inputs of the remaining nodes didn't change
+                    is_changed_cache = IsChangedCache(prompt_id, dynamic_prompt, self.caches.outputs, is_changed=is_changed_cache.is_changed)
             reset_progress_state(prompt_id, dynamic_prompt)
             add_progress_handler(WebUIProgressHandler(self.server))
-            is_changed_cache = IsChangedCache(prompt_id, dynamic_prompt, self.caches.outputs)
             for cache in self.caches.all:
-                await cache.set_prompt(dynamic_prompt, prompt.keys(), is_changed_cache)
+                await cache.set_prompt(dynamic_prompt, dynamic_prompt.original_prompt.keys(), is_changed_cache)
                 cache.clean_unused()
 
+            if preset_outputs is not None:
+                # Outputs computed elsewhere (see comfy_execution.distributed), their nodes aren't executed
+                for node_id, value in preset_outputs.items():
+                    self.caches.outputs.set(node_id, value)
+
+            distributed_error, distributed_ex = None, None
+            if self.distributed is not None:
+                distributed_error, distributed_ex = await self.distributed.execute_subgraphs(dynamic_prompt, prompt_id, extra_data, execute_outputs, self.caches.outputs)
+
             cached_nodes = []
-            for node_id in prompt:
+            for node_id in dynamic_prompt.original_prompt:
                 if self.caches.outputs.get(node_id) is not None:
                     cached_nodes.append(node_id)
 
@@ -679,31 +982,42 @@ class PromptExecutor:
                           broadcast=False)
             pending_subgraph_results = {}
             pending_async_nodes = {} # TODO - Unify this with pending_subgraph_results
+            node_execution_times = {} # node id -> seconds spent on it before re-entering it
             executed = set()
-            execution_list = ExecutionList(dynamic_prompt, self.caches.outputs)
+            execution_list = self.execution_list_class(dynamic_prompt, self.caches.outputs)
             current_outputs = self.caches.outputs.all_node_ids()
             for node_id in list(execute_outputs):
                 execution_list.add_node(node_id)
 
-            while not execution_list.is_empty():
-                node_id, error, ex = await execution_list.stage_node_execution()
+            if distributed_error is not None:
+                self.success = False
+                self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, distributed_error, distributed_ex)
+            elif self.max_parallel_nodes > 1:
+                error, ex = await self.execute_parallel(dynamic_prompt, prompt_id, extra_data, executed, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, profiler=profiler)
                 if error is not None:
                     self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-
-                assert node_id is not None, "Node ID should not be None at this point"
-                result, error, ex = await execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes)
-                self.success = result != ExecutionResult.FAILURE
-                if result == ExecutionResult.FAILURE:
-                    self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
-                    break
-                elif result == ExecutionResult.PENDING:
-                    execution_list.unstage_node_execution()
-                else: # result == ExecutionResult.SUCCESS:
-                    execution_list.complete_node_execution()
+                else:
+                    self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
             else:
-                # Only execute when the while-loop ends without break
-                self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
+                while not execution_list.is_empty():
+                    node_id, error, ex = await execution_list.stage_node_execution()
+                    if error is not None:
+                        self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                        break
+
+                    assert node_id is not None, "Node ID should not be None at this point"
+                    result, error, ex = await execute(self.server, dynamic_prompt, self.caches, node_id, extra_data, executed, prompt_id, execution_list, pending_subgraph_results, pending_async_nodes, node_execution_times, sync_executor=self.sync_executor, profiler=profiler)
+                    self.success = result != ExecutionResult.FAILURE
+                    if result == ExecutionResult.FAILURE:
+                        self.handle_execution_error(prompt_id, dynamic_prompt.original_prompt, current_outputs, executed, error, ex)
+                        break
+                    elif result == ExecutionResult.PENDING:
+                        execution_list.unstage_node_execution()
+                    else: # result == ExecutionResult.SUCCESS:
+                        execution_list.complete_node_execution()
+                else:
+                    # Only execute when the while-loop ends without break
+                    self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
 
             ui_outputs = {}
             meta_outputs = {}
@@ -717,11 +1031,42 @@ class PromptExecutor:
                 "outputs": ui_outputs,
                 "meta": meta_outputs,
             }
+            if profiler is not None:
+                profiler.finish()
+                self.history_result["profile"] = profiler.as_dict()
+            status = {"execution_success": "success", "execution_interrupted": "interrupted"}.get(self.status_messages[-1][0], "error")
+            prompts_executed.inc(status=status)
+            prompt_duration_seconds.observe(time.perf_counter() - execution_start_time, status=status)
             self.server.last_node_id = None
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
 
+async def validate_linked_node(prompt_id, prompt, x, info, val, validated):
+    o_id = val[0]
+    try:
+        r = await validate_inputs(prompt_id, prompt, o_id, validated)
+        # If `r` is False it will be set in `validated[o_id]` already
+        return r[0] is not False
+    except Exception as ex:
+        typ, _, tb = sys.exc_info()
+        exception_type = full_type_name(typ)
+        reasons = [{
+            "type": "exception_during_inner_validation",
+            "message": "Exception when validating inner node",
+            "details": str(ex),
+            "extra_info": {
+                "input_name": x,
+                "input_config": info,
+                "exception_message": str(ex),
+                "exception_type": exception_type,
+                "traceback": traceback.format_tb(tb),
+                "linked_node": val
+            }
+        }]
+        validated[o_id] = (False, reasons, o_id)
+        return False
+
 async def validate_inputs(prompt_id, prompt, item, validated):
     unique_id = item
     if unique_id in validated:
@@ -731,25 +1076,48 @@ async def validate_inputs(prompt_id, prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    class_inputs = obj_class.INPUT_TYPES()
+    schema = get_node_schema(obj_class)
+    class_inputs = schema.input_types
     valid_inputs = set(class_inputs.get('required',{})).union(set(class_inputs.get('optional',{})))
 
     errors = []
     valid = True
 
-    validate_function_inputs = []
-    validate_has_kwargs = False
     if issubclass(obj_class, _ComfyNodeInternal):
         validate_function_name = "validate_inputs"
         validate_function = first_real_override(obj_class, validate_function_name)
     else:
         validate_function_name = "VALIDATE_INPUTS"
         validate_function = getattr(obj_class, validate_function_name, None)
+
+    # Validate functions can depend on anything (files on disk, hidden inputs like PROMPT), so their
+    # results can't be keyed on the inputs and are run every time
+    validation_key = None
+    if validate_function is None:
+        validation_key = validation_cache.get_key(prompt, unique_id)
+    if validation_key is not None:
+        converted_inputs = validation_cache.get(validation_key, schema)
+        if converted_inputs is not None:
+            inputs.update(converted_inputs)
+            for x in valid_inputs:
+                val = inputs.get(x)
+                if not isinstance(val, list) or x in converted_inputs:
+                    continue
+                input_type, _, extra_info = get_input_info(obj_class, x, class_inputs)
+                if not await validate_linked_node(prompt_id, prompt, x, (input_type, extra_info), val, validated):
+                    valid = False
+            ret = (valid, [], unique_id)
+            validated[unique_id] = ret
+            return ret
+
+    validate_function_inputs = []
+    validate_has_kwargs = False
     if validate_function is not None:
         argspec = inspect.getfullargspec(validate_function)
         validate_function_inputs = argspec.args
         validate_has_kwargs = argspec.varkw is not None
     received_types = {}
+    constant_inputs = []
 
     for x in valid_inputs:
         input_type, input_category, extra_info = get_input_info(obj_class, x, class_inputs)
@@ -804,32 +1172,11 @@ async def validate_inputs(prompt_id, prompt, item, validated):
                 }
                 errors.append(error)
                 continue
-            try:
-                r = await validate_inputs(prompt_id, prompt, o_id, validated)
-                if r[0] is False:
-                    # `r` will be set in `validated[o_id]` already
-                    valid = False
-                    continue
-            except Exception as ex:
-                typ, _, tb = sys.exc_info()
+            if not await validate_linked_node(prompt_id, prompt, x, info, val, validated):
                 valid = False
-                exception_type = full_type_name(typ)
-                reasons = [{
-                    "type": "exception_during_inner_validation",
-                    "message": "Exception when validating inner node",
-                    "details": str(ex),
-                    "extra_info": {
-                        "input_name": x,
-                        "input_config": info,
-                        "exception_message": str(ex),
-                        "exception_type": exception_type,
-                        "traceback": traceback.format_tb(tb),
-                        "linked_node": val
-                    }
-                }]
-                validated[o_id] = (False, reasons, o_id)
                 continue
         else:
+            constant_inputs.append(x)
             try:
                 # Unwraps values wrapped in __value__ key. This is used to pass
                 # list widget value to execution, as by default list value is
@@ -953,6 +1300,8 @@ async def validate_inputs(prompt_id, prompt, item, validated):
         ret = (False, errors, unique_id)
     else:
         ret = (True, [], unique_id)
+        if validation_key is not None:
+            validation_cache.set(validation_key, schema, {x: inputs[x] for x in constant_inputs})
 
     validated[unique_id] = ret
     return ret
@@ -964,6 +1313,8 @@ def full_type_name(klass):
     return module + '.' + klass.__qualname__
 
 async def validate_prompt(prompt_id, prompt, partial_execution_list: Union[list[str], None]):
+    # Pick up model/file list changes before validating against the cached node schemas
+    refresh_node_schemas()
     outputs = set()
     for x in prompt:
         if 'class_type' not in prompt[x]:
@@ -1082,24 +1433,211 @@ class PromptQueue:
         self.task_counter = 0
         self.queue = []
         self.currently_running = {}
-        self.history = {}
+        self.history = HistoryStore(MAXIMUM_HISTORY_SIZE)
         self.flags = {}
+        self.enqueued_at = {}
+        self.journal = None
+        self.coalescer = None
+        # prompt_id -> history entry of prompts coalesced with a finished prompt, until announce_coalesced
+        self.unannounced = {}
+
+    def attach_coalescer(self, coalescer):
+        """Attach prompts put with a digest to a queued, running or finished prompt with the same digest (see comfy_execution.coalescing)"""
+        with self.mutex:
+            self.coalescer = coalescer
 
-    def put(self, item):
+    def attach_journal(self, journal):
+        """Queue the prompts recovered from journal (a QueueJournal) and record every change in it from now on"""
+        with self.mutex:
+            recovered = [freeze(item) for item in journal.recover()]
+            for item in recovered:
+                self.push_item(item)
+                self.enqueued_at[item[1]] = time.perf_counter()
+            self.journal = journal
+            if len(recovered) > 0:
+                logging.info(f"Recovered {len(recovered)} queued prompt(s) from the queue journal")
+                self.server.queue_updated()
+                self.not_empty.notify_all()
+            return recovered
+
+    def put(self, item, digest=None):
+        """
+        Queue item. With a coalescer attached and the digest of the prompt given, returns the prompt_id
+        of the prompt item was attached to instead of being queued, None if it was queued.
+        """
+        # Frozen once, then shared by the queue, the executor and the history without copies
+        item = freeze(item)
         with self.mutex:
-            heapq.heappush(self.queue, item)
+            if self.coalescer is not None and digest is not None:
+                leader_id = self.coalesce(item, digest)
+                if leader_id is not None:
+                    return leader_id
+            if self.journal is not None:
+                self.journal.record_put(item)
+            self.push_item(item)
+            self.enqueued_at[item[1]] = time.perf_counter()
+            queue_enqueued.inc()
             self.server.queue_updated()
-            self.not_empty.notify()
+            # Wake every worker, with select functions the first one woken may not take the item
+            self.not_empty.notify_all()
+            return None
+
+    def coalesce(self, item, digest):
+        # Called with the mutex held
+        leader_id, finished = self.coalescer.find(digest)
+        if leader_id is None:
+            self.coalescer.lead(item[1], digest)
+            return None
+        if leader_id == item[1]:
+            # Submitted again with the same prompt_id, e.g. a retry
+            return leader_id
+        if finished:
+            entry = self.history.get(leader_id)
+            if entry is None:
+                self.coalescer.forget_finished(digest)
+                self.coalescer.lead(item[1], digest)
+                return None
+            # Its messages are sent by announce_coalesced, after the client got the prompt_id
+            self.add_coalesced_history(item, leader_id, entry, announce=False)
+        else:
+            if self.journal is not None:
+                self.journal.record_put(item)
+            self.coalescer.follow(leader_id, item)
+            self.server.queue_updated()
+        logging.info(f"Prompt {item[1]} is identical to prompt {leader_id}, using its results")
+        return leader_id
+
+    def add_coalesced_history(self, item, leader_id, entry, announce=True):
+        """
+        Add the history entry of the prompt item was attached to as that of item. Its client gets the messages
+        of an execution that found every node cached, right away or, with announce=False, on announce_coalesced.
+        """
+        item = strip_sensitive_extra_data(item)
+        prompt_id = item[1]
+        entry = dict(entry, prompt=item, coalesced_with=leader_id)
+        self.history.add(prompt_id, entry, client_id=item[3].get("client_id"))
+        if announce:
+            self.send_coalesced_messages(entry)
+        else:
+            self.unannounced[prompt_id] = entry
 
-    def get(self, timeout=None):
+    def announce_coalesced(self, prompt_id):
+        """Send the messages of a prompt that put() coalesced with a finished prompt, once its client knows the prompt_id"""
+        with self.mutex:
+            entry = self.unannounced.pop(prompt_id, None)
+        if entry is not None:
+            self.send_coalesced_messages(entry)
+
+    def send_coalesced_messages(self, entry):
+        # The same sequence as PromptExecutor.execute and PromptWorker produce
+        prompt_id, prompt, extra_data = entry["prompt"][1:4]
+        client_id = extra_data.get("client_id")
+        if client_id is None:
+            return
+        timestamp = int(time.time() * 1000)
+        self.server.send_sync("execution_start", { "prompt_id": prompt_id, "timestamp": timestamp }, client_id)
+        self.server.send_sync("execution_cached", { "nodes": list(prompt.keys()), "prompt_id": prompt_id, "timestamp": timestamp }, client_id)
+        for node_id, output in entry.get("outputs", {}).items():
+            display_node = entry.get("meta", {}).get(node_id, {}).get("display_node", node_id)
+            self.server.send_sync("executed", { "node": node_id, "display_node": display_node, "output": output, "prompt_id": prompt_id }, client_id)
+        self.server.send_sync("execution_success", { "prompt_id": prompt_id, "timestamp": timestamp }, client_id)
+        self.server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, client_id)
+
+    def release_followers(self, prompt_id, success):
+        # Called with the mutex held, once prompt_id is no longer queued or running
+        digest, followers = self.coalescer.finish(prompt_id, success)
+        if len(followers) == 0:
+            return
+        if success:
+            entry = self.history.get(prompt_id)
+            for item in followers:
+                if self.journal is not None:
+                    self.journal.record_done(item[1])
+                self.add_coalesced_history(item, prompt_id, entry)
+        else:
+            # The first follower is executed instead and leads the others
+            leader = followers[0]
+            self.coalescer.lead(leader[1], digest)
+            for item in followers[1:]:
+                self.coalescer.follow(leader[1], item)
+            self.push_item(leader)
+            self.enqueued_at[leader[1]] = time.perf_counter()
+            self.not_empty.notify_all()
+
+    # The order in which queued items execute is defined by push_item, take_next_item, peek_items,
+    # take_item and remove_item, everything else goes through them (see comfy_execution.fair_queue)
+    def push_item(self, item):
+        heapq.heappush(self.queue, item)
+
+    def take_next_item(self):
+        """Remove and return the item to execute next, None if there is none (or none may start)"""
+        if len(self.queue) == 0:
+            return None
+        return heapq.heappop(self.queue)
+
+    def peek_items(self, count):
+        """The next count items in execution order"""
+        return heapq.nsmallest(count, self.queue)
+
+    def take_item(self, item):
+        """Remove item, picked by the select function of get(), for execution"""
+        self.remove_item(item)
+
+    def remove_item(self, item):
+        self.queue.remove(item)
+        heapq.heapify(self.queue)
+
+    # How many of the next queued items a select function of get() is offered
+    SELECT_WINDOW = 32
+    # How often a worker whose select function declined every item looks at the queue again
+    SELECT_POLL_INTERVAL = 0.1
+
+    def get(self, timeout=None, select=None):
+        """
+        Take the next item to execute. select, if given, lets the caller pick one of the next
+        SELECT_WINDOW items: it's called with them in execution order and returns the index of the
+        item to take, or None to wait for a better fit (e.g. a prompt another worker is busy with).
+        """
+        if select is not None:
+            return self.get_selected(timeout, select)
         with self.not_empty:
-            while len(self.queue) == 0:
+            item = self.take_next_item()
+            while item is None:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                item = self.take_next_item()
+                if timeout is not None and item is None:
                     return None
-            item = heapq.heappop(self.queue)
+            return self.start_item(item)
+
+    def get_selected(self, timeout, select):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.not_empty:
+            while True:
+                if len(self.queue) > 0:
+                    candidates = self.peek_items(self.SELECT_WINDOW)
+                    index = select(candidates) if len(candidates) > 0 else None
+                    if index is not None:
+                        item = candidates[index]
+                        self.take_item(item)
+                        return self.start_item(item)
+                wait = self.SELECT_POLL_INTERVAL if len(self.queue) > 0 else None
+                if deadline is not None:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.not_empty.wait(timeout=wait)
+
+    def start_item(self, item):
+        with self.mutex:
+            if self.journal is not None:
+                self.journal.record_start(item[1])
+            queue_dequeued.inc()
+            enqueued_at = self.enqueued_at.pop(item[1], None)
+            if enqueued_at is not None:
+                queue_wait_seconds.observe(time.perf_counter() - enqueued_at)
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            self.currently_running[i] = item
             self.task_counter += 1
             self.server.queue_updated()
             return (item, i)
@@ -1113,97 +1651,119 @@ class PromptQueue:
                   status: Optional['PromptQueue.ExecutionStatus']):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
+            if self.journal is not None:
+                self.journal.record_done(prompt[1])
 
             status_dict: Optional[dict] = None
             if status is not None:
                 status_dict = copy.deepcopy(status._asdict())
 
             # Remove sensitive data from extra_data before storing in history
-            for sensitive_val in SENSITIVE_EXTRA_DATA_KEYS:
-                if sensitive_val in prompt[3]:
-                    prompt[3].pop(sensitive_val)
+            prompt = strip_sensitive_extra_data(prompt)
 
-            self.history[prompt[1]] = {
+            entry = {
                 "prompt": prompt,
                 "outputs": {},
                 'status': status_dict,
             }
-            self.history[prompt[1]].update(history_result)
+            entry.update(history_result)
+            self.history.add(prompt[1], entry, client_id=prompt[3].get("client_id"))
+            if self.coalescer is not None:
+                self.release_followers(prompt[1], status is not None and status.status_str == "success")
             self.server.queue_updated()
 
-    # Note: slow
+    # Queue items are frozen, so these don't need to copy them
     def get_current_queue(self):
         with self.mutex:
             out = []
             for x in self.currently_running.values():
                 out += [x]
-            return (out, copy.deepcopy(self.queue))
+            queued = copy.copy(self.queue)
+            if self.coalescer is not None:
+                # Prompts attached to another one are pending too
+                queued += self.coalescer.get_followers()
+            return (out, queued)
 
-    # read-safe as long as queue items are immutable
     def get_current_queue_volatile(self):
         with self.mutex:
             running = [x for x in self.currently_running.values()]
             queued = copy.copy(self.queue)
+            if self.coalescer is not None:
+                queued += self.coalescer.get_followers()
             return (running, queued)
 
     def get_tasks_remaining(self):
         with self.mutex:
-            return len(self.queue) + len(self.currently_running)
+            remaining = len(self.queue) + len(self.currently_running)
+            if self.coalescer is not None:
+                remaining += self.coalescer.get_follower_count()
+            return remaining
 
     def wipe_queue(self):
         with self.mutex:
+            removed = list(self.queue)
+            if self.coalescer is not None:
+                removed += self.coalescer.get_followers()
+                for item in self.queue:
+                    self.coalescer.finish(item[1], False)
+                for followers in self.coalescer.followers.values():
+                    followers.clear()
+            if self.journal is not None:
+                for item in removed:
+                    self.journal.record_remove(item[1])
             self.queue = []
+            self.enqueued_at = {}
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
         with self.mutex:
             for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
+                item = self.queue[x]
+                if function(item):
+                    self.enqueued_at.pop(item[1], None)
+                    if self.journal is not None:
+                        self.journal.record_remove(item[1])
+                    self.remove_item(item)
+                    if self.coalescer is not None:
+                        self.release_followers(item[1], False)
+                    self.server.queue_updated()
+                    return True
+            if self.coalescer is not None:
+                item = self.coalescer.remove_follower(function)
+                if item is not None:
+                    if self.journal is not None:
+                        self.journal.record_remove(item[1])
                     self.server.queue_updated()
                     return True
         return False
 
+    # History entries aren't modified once added, so they are returned without copies or the queue mutex
     def get_history(self, prompt_id=None, max_items=None, offset=-1, map_function=None):
-        with self.mutex:
-            if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        p = self.history[k]
-                        if map_function is not None:
-                            p = map_function(p)
-                        out[k] = p
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
-            elif prompt_id in self.history:
-                p = self.history[prompt_id]
-                if map_function is None:
-                    p = copy.deepcopy(p)
-                else:
+        if prompt_id is None:
+            out = {}
+            if offset < 0 and max_items is not None:
+                offset = len(self.history) - max_items
+            for k, p in self.history.get_range(max(offset, 0), max_items):
+                if map_function is not None:
                     p = map_function(p)
-                return {prompt_id: p}
-            else:
-                return {}
+                out[k] = p
+            return out
+        p = self.history.get(prompt_id)
+        if p is None:
+            return {}
+        if map_function is not None:
+            p = map_function(p)
+        return {prompt_id: p}
+
+    def query_history(self, **kwargs):
+        """See HistoryStore.query"""
+        return self.history.query(**kwargs)
 
     def wipe_history(self):
-        with self.mutex:
-            self.history = {}
+        self.history.clear()
 
     def delete_history_item(self, id_to_delete):
-        with self.mutex:
-            self.history.pop(id_to_delete, None)
+        self.history.remove(id_to_delete)
 
     def set_flag(self, name, data):
         with self.mutex:
@@ -5,7 +5,7 @@ import time
 import mimetypes
 import logging
 from typing import Literal, List
-from collections.abc import Collection
+from collections.abc import Callable, Collection
 
 from comfy.cli_args import args
 
@@ -52,6 +52,8 @@ input_directory = os.path.join(base_path, "input")
 user_directory = os.path.join(base_path, "user")
 
 filename_list_cache: dict[str, tuple[list[str], dict[str, float], float]] = {}
+filename_list_listeners: list[Callable[[str, bool], None]] = []
+directory_listeners: list[Callable[[str], None]] = []
 
 class CacheHelper:
     """
@@ -111,17 +113,29 @@ def set_input_directory(input_dir: str) -> None:
     global input_directory
     input_directory = input_dir
 
+def add_directory_listener(callback: Callable[[str], None]) -> None:
+    """
+    Register callback(directory), called whenever get_output_directory, get_temp_directory or
+    get_input_directory returns directory, so callers can tell which directories code may list.
+    """
+    directory_listeners.append(callback)
+
+def notify_directory(directory: str) -> str:
+    for callback in directory_listeners:
+        callback(directory)
+    return directory
+
 def get_output_directory() -> str:
     global output_directory
-    return output_directory
+    return notify_directory(output_directory)
 
 def get_temp_directory() -> str:
     global temp_directory
-    return temp_directory
+    return notify_directory(temp_directory)
 
 def get_input_directory() -> str:
     global input_directory
-    return input_directory
+    return notify_directory(input_directory)
 
 def get_user_directory() -> str:
     return user_directory
@@ -344,14 +358,26 @@ def cached_filename_list_(folder_name: str) -> tuple[list[str], dict[str, float]
 
     return out
 
+def add_filename_list_listener(callback: Callable[[str, bool], None]) -> None:
+    """
+    Register callback(folder_name, changed), called on every get_filename_list. changed is True
+    when the list was rescanned and differs from the previously cached one.
+    """
+    filename_list_listeners.append(callback)
+
 def get_filename_list(folder_name: str) -> list[str]:
     folder_name = map_legacy(folder_name)
     out = cached_filename_list_(folder_name)
+    changed = False
     if out is None:
         out = get_filename_list_(folder_name)
         global filename_list_cache
+        previous = filename_list_cache.get(folder_name)
+        changed = previous is not None and previous[0] != out[0]
         filename_list_cache[folder_name] = out
     cache_helper.set(folder_name, out)
+    for callback in filename_list_listeners:
+        callback(folder_name, changed)
     return list(out[0])
 
 def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, image_height=0) -> tuple[str, str, int, str, str]:
@@ -4,7 +4,6 @@ import os
 import sys
 import asyncio
 import logging
-import argparse
 import threading
 import time
 
@@ -53,8 +52,55 @@ async def start_comfyui_core(asyncio_loop=None, args=None):
     listen_addr = args.listen if args else "127.0.0.1"
     port = args.port if args else 8188
     verbose = args.verbose if args else False
-    
-    await server_instance.start(listen_addr, port, verbose=verbose)
+    prompt_workers = args.prompt_workers if args else 1
+    max_parallel_nodes = args.max_parallel_nodes if args else 1
+    executor_devices = args.executor_devices if args else None
+    distributed_workers = args.distributed_workers if args else None
+    distributed_worker = args.distributed_worker if args else False
+    fair_queue = args.fair_queue if args else None
+    queue_journal = args.queue_journal if args else None
+    coalesce_prompts = args.coalesce_prompts if args else False
+
+    if fair_queue is not None:
+        from comfy_execution.fair_queue import FairPromptQueue
+        server_instance.prompt_queue = FairPromptQueue(server_instance,
+                                                       tenant_key=fair_queue,
+                                                       weights=args.fair_queue_weights,
+                                                       max_running=args.fair_queue_limits,
+                                                       default_max_running=args.fair_queue_max_running)
+
+    if queue_journal is not None:
+        import execution
+        from comfy_execution.queue_journal import QueueJournal
+        if queue_journal == "":
+            from app.database.db import get_db_path
+            queue_journal = get_db_path()
+        os.makedirs(os.path.dirname(os.path.abspath(queue_journal)), exist_ok=True)
+        journal = QueueJournal(queue_journal, sensitive_keys=execution.SENSITIVE_EXTRA_DATA_KEYS)
+        recovered = server_instance.prompt_queue.attach_journal(journal)
+        journal.start()
+        if len(recovered) > 0:
+            # New prompts go after the recovered ones
+            server_instance.number = max(server_instance.number, int(max(item[0] for item in recovered)) + 1)
+    
+    if coalesce_prompts:
+        from comfy_execution.coalescing import PromptCoalescer
+        server_instance.prompt_queue.attach_coalescer(PromptCoalescer())
+
+    # Start the workers that execute queued prompts and the loop that sends their messages
+    import prompt_worker
+    from comfy_execution import distributed
+    coordinator = None
+    if distributed_workers:
+        coordinator = distributed.DistributedCoordinator(distributed_workers, cut_classes=args.distributed_cut_classes)
+    if distributed_worker:
+        server_instance.subgraph_worker = distributed.SubgraphWorker(prompt_worker.WorkerServer(server_instance), max_parallel_nodes=max_parallel_nodes)
+    server_instance.worker_pool = prompt_worker.PromptWorkerPool(server_instance, num_workers=prompt_workers, max_parallel_nodes=max_parallel_nodes, devices=executor_devices, distributed=coordinator)
+    server_instance.worker_pool.start()
+    publish_task = asyncio.create_task(server_instance.publish_loop())
+    
+    # --listen takes a comma separated list of addresses
+    await server_instance.start_multi_address([(address, port) for address in listen_addr.split(",")], verbose=verbose)
     
     # Keep the server running
     print(f"ComfyUI-Core server started on {listen_addr}:{port}")
@@ -66,19 +112,17 @@ async def start_comfyui_core(asyncio_loop=None, args=None):
             await asyncio.sleep(1)
     except asyncio.CancelledError:
         print("Server shutdown requested")
+        publish_task.cancel()
         raise
 
 def main():
     """Main entry point"""
-    parser = argparse.ArgumentParser(description='ComfyUI Core - Minimal Runtime')
-    parser.add_argument('--listen', type=str, default="127.0.0.1", metavar="IP", nargs="?", const="0.0.0.0", help="Specify the IP address to listen on (default: 127.0.0.1). If --listen is provided without an argument, it defaults to 0.0.0.0. (listens on all)")
-    parser.add_argument('--port', type=int, default=8188, help="Set the listen port.")
-    parser.add_argument('--verbose', action='store_true', help="Enables more debug prints.")
-    
-    args = parser.parse_args()
-    
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
+    # All options are defined in comfy.cli_args, which every module reads them from
+    import comfy.cli_args
+    comfy.cli_args.parse_command_line()
+    args = comfy.cli_args.args
+    from app.logger import setup_logger
+    setup_logger(log_level=args.verbose, use_stdout=args.log_stdout)
     
     print("=" * 50)
     print("ComfyUI-Core: Minimal Runtime Starting...")
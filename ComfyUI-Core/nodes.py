@@ -19,6 +19,16 @@ EXTENSION_WEB_DIRS = {}
 # Loaded module directories for custom node manager
 LOADED_MODULE_DIRS = {}
 
+def before_node_execution():
+    """Raise if the current prompt was interrupted, checked before each node function call"""
+    import comfy.model_management
+    comfy.model_management.throw_exception_if_processing_interrupted()
+
+def interrupt_processing(value=True):
+    """Request (or clear) an interrupt of the prompt that is currently executing"""
+    import comfy.model_management
+    comfy.model_management.interrupt_current_processing(value)
+
 def get_module_name(module_path):
     """Get module name from path"""
     return os.path.basename(module_path)
@@ -92,14 +102,16 @@ async def init_external_custom_nodes():
 
 def get_object_info():
     """Get information about all loaded nodes"""
+    from comfy_execution.node_schema import get_node_schema
     out = {}
     for x in NODE_CLASS_MAPPINGS:
         try:
+            schema = get_node_schema(NODE_CLASS_MAPPINGS[x])
             out[x] = {
-                "input": NODE_CLASS_MAPPINGS[x].INPUT_TYPES(),
-                "output": NODE_CLASS_MAPPINGS[x].RETURN_TYPES,
-                "output_is_list": getattr(NODE_CLASS_MAPPINGS[x], "OUTPUT_IS_LIST", [False] * len(NODE_CLASS_MAPPINGS[x].RETURN_TYPES)),
-                "output_name": getattr(NODE_CLASS_MAPPINGS[x], "RETURN_NAMES", None),
+                "input": schema.input_types,
+                "output": schema.output_types,
+                "output_is_list": schema.output_is_list,
+                "output_name": schema.output_names,
                 "name": NODE_DISPLAY_NAME_MAPPINGS.get(x, x),
                 "display_name": NODE_DISPLAY_NAME_MAPPINGS.get(x, x),
                 "description": getattr(NODE_CLASS_MAPPINGS[x], "DESCRIPTION", ""),
@@ -0,0 +1,339 @@
+import contextlib
+import gc
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+import comfy.model_management
+import execution
+from comfy.cli_args import args
+from comfy_execution.graph_utils import is_link
+from comfy_execution.scheduling import node_timing_stats
+
+
+def get_cache_spill():
+    """The (directory, max_size) of the disk tier under the output cache, None when disabled"""
+    if args.cache_spill_dir is None:
+        return None
+    return args.cache_spill_dir, int(args.cache_spill_size * (1024 ** 3))
+
+
+def get_persistent_store():
+    """The store shared by all workers for --persistent-cache-dir, None when disabled"""
+    if args.persistent_cache_dir is None:
+        return None
+    from comfy_execution.caching import PersistentResultStore
+    return PersistentResultStore(args.persistent_cache_dir, int(args.persistent_cache_size * (1024 ** 3)), output_types=args.persistent_cache_types)
+
+
+def get_cache_type():
+    """Map the --cache-* command line options to the executor cache type"""
+    if args.cache_lru > 0:
+        return execution.CacheType.LRU, args.cache_lru
+    elif args.cache_ram_budget > 0:
+        if args.cache_vram_budget is not None:
+            vram_budget = int(args.cache_vram_budget * (1024 ** 3))
+        elif comfy.model_management.get_torch_device().type == "cpu":
+            vram_budget = 0
+        else:
+            vram_budget = comfy.model_management.get_total_memory() // 4
+        cache_type = execution.CacheType.COST_AWARE if args.cache_cost_aware else execution.CacheType.BYTE_BUDGET
+        return cache_type, (int(args.cache_ram_budget * (1024 ** 3)), vram_budget)
+    elif args.cache_none:
+        return execution.CacheType.DEPENDENCY_AWARE, None
+    return execution.CacheType.CLASSIC, None
+
+
+def get_source_node_keys(prompt):
+    """
+    Identify the nodes of prompt without linked inputs, mostly model loaders, by their class and
+    constant inputs. Returns {node_id: (key, class_type)}.
+    """
+    keys = {}
+    for node_id, node in prompt.items():
+        inputs = node.get("inputs", {})
+        if any(is_link(value) for value in inputs.values()):
+            continue
+        try:
+            key = json.dumps([node["class_type"], inputs], sort_keys=True)
+        except (KeyError, TypeError, ValueError):
+            continue
+        keys[node_id] = (key, node["class_type"])
+    return keys
+
+
+class WorkerServer:
+    """
+    Per-worker view of the PromptServer.
+
+    The executor keeps the id of the client it is currently executing for on the server
+    object. When several workers execute at the same time each one needs its own copy of
+    that state, everything else is forwarded to the real server.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.client_id = None
+        self.last_node_id = None
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+
+class WorkerStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.busy_time = 0.0
+        self.prompts_executed = 0
+        self.prompts_failed = 0
+        self.current_prompt_id = None
+        self.current_started_at = None
+
+    def begin(self, prompt_id):
+        self.current_prompt_id = prompt_id
+        self.current_started_at = time.perf_counter()
+
+    def end(self, success):
+        self.busy_time += time.perf_counter() - self.current_started_at
+        self.prompts_executed += 1
+        if not success:
+            self.prompts_failed += 1
+        self.current_prompt_id = None
+        self.current_started_at = None
+
+    def as_dict(self):
+        now = time.perf_counter()
+        busy_time = self.busy_time
+        current_prompt_id = self.current_prompt_id
+        current_started_at = self.current_started_at
+        if current_started_at is not None:
+            busy_time += now - current_started_at
+        uptime = now - self.started_at
+        return {
+            "busy": current_prompt_id is not None,
+            "current_prompt_id": current_prompt_id,
+            "prompts_executed": self.prompts_executed,
+            "prompts_failed": self.prompts_failed,
+            "busy_time": busy_time,
+            "uptime": uptime,
+            "utilization": busy_time / uptime if uptime > 0 else 0.0,
+        }
+
+
+class PromptWorker:
+    """Drains the prompt queue with its own PromptExecutor and caches."""
+
+    GC_COLLECT_INTERVAL = 10.0
+
+    # How many source nodes a worker remembers as resident, see get_source_node_keys
+    MAX_RESIDENT_NODES = 256
+
+    def __init__(self, pool, index, executor_server, max_parallel_nodes=1, persistent_store=None, device=None, distributed=None):
+        self.pool = pool
+        self.index = index
+        self.name = f"prompt-worker-{index}"
+        self.device = device
+        # Source nodes of recently executed prompts, whose outputs (loaded models) this worker likely still holds
+        self.resident = OrderedDict()
+        self.busy = False
+        with self.device_context():
+            cache_type, cache_size = get_cache_type()
+            self.executor = execution.PromptExecutor(executor_server,
+                                                     cache_type=cache_type,
+                                                     cache_size=cache_size,
+                                                     max_parallel_nodes=max_parallel_nodes,
+                                                     cache_spill=get_cache_spill(),
+                                                     persistent_store=persistent_store,
+                                                     eliminate_common_subexpressions=args.enable_common_subexpression_elimination,
+                                                     profile=args.profile_execution,
+                                                     scheduling_policy=args.scheduling_policy,
+                                                     offload_sync_nodes=args.offload_sync_nodes,
+                                                     distributed=distributed)
+        self.stats = WorkerStats()
+        self.reset_requested = False
+        self.thread = None
+
+    def add_resident_nodes(self, prompt):
+        for key, class_type in get_source_node_keys(prompt).values():
+            self.resident[key] = class_type
+            self.resident.move_to_end(key)
+        while len(self.resident) > self.MAX_RESIDENT_NODES:
+            self.resident.popitem(last=False)
+
+    def device_context(self):
+        if self.device is None:
+            return contextlib.nullcontext()
+        return comfy.model_management.torch_device_override(self.device)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def execute_item(self, item, item_id):
+        q = self.pool.prompt_queue
+        e = self.executor
+        server = e.server
+        prompt_id = item[1]
+
+        self.stats.begin(prompt_id)
+        execution_start_time = time.perf_counter()
+        try:
+            e.execute(item[2], prompt_id, item[3], item[4])
+        finally:
+            self.add_resident_nodes(item[2])
+            self.busy = False
+        q.task_done(item_id,
+                    e.history_result,
+                    status=execution.PromptQueue.ExecutionStatus(
+                        status_str='success' if e.success else 'error',
+                        completed=e.success,
+                        messages=e.status_messages))
+        if server.client_id is not None:
+            server.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server.client_id)
+        self.stats.end(e.success)
+
+        execution_time = time.perf_counter() - execution_start_time
+        logging.info("[{}] Prompt executed in {:.2f} seconds".format(self.name, execution_time))
+
+    def run(self):
+        with self.device_context():
+            self.process_queue()
+
+    def process_queue(self):
+        q = self.pool.prompt_queue
+        last_gc_collect = 0.0
+        need_gc = False
+
+        while True:
+            timeout = 1000.0
+            if need_gc:
+                timeout = max(self.GC_COLLECT_INTERVAL - (time.perf_counter() - last_gc_collect), 0.0)
+
+            queue_item = q.get(timeout=timeout, select=self.pool.get_selector(self))
+            if queue_item is not None:
+                item, item_id = queue_item
+                try:
+                    self.execute_item(item, item_id)
+                except Exception:
+                    logging.exception(f"[{self.name}] Unhandled error while executing prompt {item[1]}")
+                need_gc = True
+
+            flags = q.get_flags()
+            free_memory = flags.get("free_memory", False)
+
+            if flags.get("unload_models", free_memory):
+                comfy.model_management.unload_all_models()
+                need_gc = True
+                last_gc_collect = 0.0
+
+            if free_memory:
+                self.pool.request_reset()
+
+            if self.reset_requested:
+                self.reset_requested = False
+                self.executor.reset()
+                self.resident.clear()
+                need_gc = True
+                last_gc_collect = 0.0
+
+            if need_gc:
+                current_time = time.perf_counter()
+                if (current_time - last_gc_collect) > self.GC_COLLECT_INTERVAL:
+                    gc.collect()
+                    comfy.model_management.soft_empty_cache()
+                    last_gc_collect = current_time
+                    need_gc = False
+
+
+class PromptWorkerPool:
+    """
+    Runs num_workers PromptWorker threads against the server's PromptQueue.
+
+    Each worker owns a PromptExecutor (and so its own node output caches). With a single
+    worker the executor reports directly through the server, which keeps the behaviour of a
+    classic single executor ComfyUI process. max_parallel_nodes is passed on to every executor.
+
+    When devices are given there is one worker per device and get_torch_device() returns that
+    device inside the worker, so its models are loaded there. Queued prompts then go to the
+    worker that recently executed the same source nodes (and so likely has the models loaded),
+    weighted by how long those nodes take to run. An idle worker takes a prompt that fits another
+    worker better only when that worker is busy.
+
+    distributed (a DistributedCoordinator) is shared by the executors of all workers.
+    """
+    def __init__(self, server, num_workers=1, max_parallel_nodes=1, devices=None, distributed=None):
+        if devices is not None and len(devices) > 0:
+            num_workers = len(devices)
+        else:
+            devices = [None] * num_workers
+        if num_workers < 1:
+            raise ValueError(f"At least one prompt worker is required, got {num_workers}")
+        self.server = server
+        self.prompt_queue = server.prompt_queue
+        self.persistent_store = get_persistent_store()
+        self.device_affinity = num_workers > 1 and devices[0] is not None
+        self.item_keys = {}
+        self.workers = []
+        for i in range(num_workers):
+            executor_server = server if num_workers == 1 else WorkerServer(server)
+            device = torch.device(devices[i]) if devices[i] is not None else None
+            self.workers.append(PromptWorker(self, i, executor_server, max_parallel_nodes=max_parallel_nodes, persistent_store=self.persistent_store, device=device, distributed=distributed))
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        logging.info(f"Started {len(self.workers)} prompt worker(s)")
+
+    def get_selector(self, worker):
+        """The select function of PromptQueue.get for worker, None to take items in queue order"""
+        if not self.device_affinity:
+            return None
+        return lambda items: self.select_item(worker, items)
+
+    def get_affinity(self, worker, keys):
+        return sum(node_timing_stats.get_estimate(class_type) for key, class_type in keys.values() if key in worker.resident)
+
+    def select_item(self, worker, items):
+        # Called with the queue lock held, so the busy flags are consistent between workers
+        selected = None
+        for index, item in enumerate(items):
+            keys = self.item_keys.get(item[1])
+            if keys is None:
+                keys = self.item_keys[item[1]] = get_source_node_keys(item[2])
+            affinity = {w: self.get_affinity(w, keys) for w in self.workers}
+            best = max(affinity.values())
+            preferred = [w for w in self.workers if affinity[w] == best]
+            if worker in preferred or all(w.busy for w in preferred):
+                selected = index
+                break
+        if selected is None:
+            return None
+        worker.busy = True
+        self.item_keys.pop(items[selected][1], None)
+        if len(self.item_keys) > 4 * len(items):
+            current = {item[1] for item in items}
+            self.item_keys = {k: v for k, v in self.item_keys.items() if k in current}
+        return selected
+
+    def request_reset(self):
+        # Workers drop their caches the next time they are between prompts
+        for worker in self.workers:
+            worker.reset_requested = True
+
+    def get_stats(self):
+        workers = []
+        for worker in self.workers:
+            stats = worker.stats.as_dict()
+            stats["name"] = worker.name
+            stats["device"] = str(worker.device) if worker.device is not None else None
+            workers.append(stats)
+        busy = sum(1 for w in workers if w["busy"])
+        return {
+            "workers": workers,
+            "busy_workers": busy,
+            "total_workers": len(workers),
+            "queue_remaining": self.prompt_queue.get_tasks_remaining(),
+        }
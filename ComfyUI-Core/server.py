@@ -31,6 +31,13 @@ import node_helpers
 from comfyui_version import __version__
 from app.frontend_management import FrontendManager
 from comfy_api.internal import _ComfyNodeInternal
+from comfy_execution.node_schema import get_node_schema, invalidate_node_schemas, refresh_node_schemas
+from comfy_execution.history_store import HISTORY_FIELDS
+from comfy_execution.metrics import MetricFamily, metrics_registry
+from comfy_execution.profiler import to_chrome_trace
+from comfy_execution.coalescing import get_prompt_digest
+from comfy_execution.frozen import freeze
+from comfy_execution.sweep import SweepError, expand_sweep, get_variant_count, parse_sweep_parameters, validate_sweep_values
 
 from app.user_manager import UserManager
 from app.model_manager import ModelFileManager
@@ -159,6 +166,7 @@ class PromptServer():
         self.internal_routes = InternalRoutes(self)
         self.supports = ["custom_nodes_from_web"]
         self.prompt_queue = execution.PromptQueue(self)
+        metrics_registry.set_collector("server", self.collect_metrics)
         self.loop = loop
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
@@ -187,6 +195,8 @@ class PromptServer():
         self.routes = routes
         self.last_node_id = None
         self.client_id = None
+        self.worker_pool = None
+        self.subgraph_worker = None
 
         self.on_prompt_handlers = []
 
@@ -361,6 +371,8 @@ class PromptServer():
                     else:
                         with open(filepath, "wb") as f:
                             f.write(image.file.read())
+                    # Nodes list the input directory in INPUT_TYPES
+                    invalidate_node_schemas()
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
@@ -594,12 +606,13 @@ class PromptServer():
             obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
             if issubclass(obj_class, _ComfyNodeInternal):
                 return obj_class.GET_NODE_INFO_V1()
+            schema = get_node_schema(obj_class)
             info = {}
-            info['input'] = obj_class.INPUT_TYPES()
-            info['input_order'] = {key: list(value.keys()) for (key, value) in obj_class.INPUT_TYPES().items()}
-            info['output'] = obj_class.RETURN_TYPES
-            info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
-            info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
+            info['input'] = schema.input_types
+            info['input_order'] = {key: list(value.keys()) for (key, value) in schema.input_types.items()}
+            info['output'] = list(schema.output_types)
+            info['output_is_list'] = list(schema.output_is_list)
+            info['output_name'] = list(schema.output_names) if schema.output_names is not None else info['output']
             info['name'] = node_class
             info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
             info['description'] = obj_class.DESCRIPTION if hasattr(obj_class,'DESCRIPTION') else ''
@@ -628,6 +641,7 @@ class PromptServer():
         @routes.get("/object_info")
         async def get_object_info(request):
             with folder_paths.cache_helper:
+                refresh_node_schemas()
                 out = {}
                 for x in nodes.NODE_CLASS_MAPPINGS:
                     try:
@@ -647,16 +661,53 @@ class PromptServer():
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
+            query = request.rel_url.query
+            max_items = query.get("max_items", None)
             if max_items is not None:
                 max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            if not any(name in query for name in ("cursor", "order", "client_id", "since", "until", "status", "fields")):
+                return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+
+            # Filtered and paginated, the cursor of the next page is returned in X-Next-Cursor
+            try:
+                cursor = int(query["cursor"]) if "cursor" in query else None
+                since = float(query["since"]) if "since" in query else None
+                until = float(query["until"]) if "until" in query else None
+            except ValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+            fields = None
+            if "fields" in query:
+                fields = [field for field in query["fields"].split(",") if field != ""]
+                unknown = [field for field in fields if field not in HISTORY_FIELDS]
+                if len(unknown) > 0:
+                    return web.json_response({"error": f"Unknown history fields {unknown}, expected some of {list(HISTORY_FIELDS)}"}, status=400)
+            items, next_cursor = self.prompt_queue.query_history(max_items=max_items,
+                                                                 cursor=cursor,
+                                                                 descending=query.get("order", "asc") == "desc",
+                                                                 client_id=query.get("client_id"),
+                                                                 since=since,
+                                                                 until=until,
+                                                                 status=query.get("status"),
+                                                                 fields=fields)
+            headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else None
+            return web.json_response(dict(items), headers=headers)
 
         @routes.get("/history/{prompt_id}")
         async def get_history_prompt_id(request):
             prompt_id = request.match_info.get("prompt_id", None)
             return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
 
+        @routes.get("/history/{prompt_id}/profile")
+        async def get_history_profile(request):
+            prompt_id = request.match_info.get("prompt_id", None)
+            history = self.prompt_queue.get_history(prompt_id=prompt_id)
+            profile = history.get(prompt_id, {}).get("profile", None)
+            if profile is None:
+                return web.json_response({"error": "No profile recorded for this prompt"}, status=404)
+            if request.rel_url.query.get("format", "chrome") == "raw":
+                return web.json_response(profile)
+            return web.json_response(to_chrome_trace(profile), headers={"Content-Disposition": f"attachment; filename=\"profile-{prompt_id}.json\""})
+
         @routes.get("/queue")
         async def get_queue(request):
             queue_info = {}
@@ -665,6 +716,33 @@ class PromptServer():
             queue_info['queue_pending'] = current_queue[1]
             return web.json_response(queue_info)
 
+        @routes.get("/queue/tenants")
+        async def get_queue_tenants(request):
+            get_tenant_stats = getattr(self.prompt_queue, "get_tenant_stats", None)
+            if get_tenant_stats is None:
+                return web.json_response({"fair_queue": False, "tenants": {}})
+            tenants = get_tenant_stats()
+            if "tenant" in request.rel_url.query:
+                name = request.rel_url.query["tenant"]
+                tenants = {name: tenants[name]} if name in tenants else {}
+            return web.json_response({"fair_queue": True, "tenants": tenants})
+
+        @routes.get("/metrics")
+        async def get_metrics(request):
+            return web.Response(text=metrics_registry.render(), content_type="text/plain", charset="utf-8")
+
+        @routes.get("/workers")
+        async def get_workers(request):
+            if self.worker_pool is None:
+                return web.json_response({"workers": [], "busy_workers": 0, "total_workers": 0, "queue_remaining": self.prompt_queue.get_tasks_remaining()})
+            return web.json_response(self.worker_pool.get_stats())
+
+        @routes.post("/distributed/execute")
+        async def post_distributed_execute(request):
+            if self.subgraph_worker is None:
+                return web.json_response({"error": {"exception_message": "Not a distributed worker, start with --distributed-worker"}}, status=404)
+            return await self.subgraph_worker.handle_request(request)
+
         @routes.post("/prompt")
         async def post_prompt(request):
             logging.info("got prompt")
@@ -698,9 +776,21 @@ class PromptServer():
                     extra_data["client_id"] = json_data["client_id"]
                 if valid[0]:
                     outputs_to_execute = valid[2]
-                    self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+                    digest = None
+                    if self.prompt_queue.coalescer is not None:
+                        digest = await get_prompt_digest(prompt_id, prompt, outputs_to_execute, extra_data)
+                    coalesced_with = self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute), digest=digest)
                     response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
-                    return web.json_response(response)
+                    if coalesced_with is None:
+                        return web.json_response(response)
+                    response["coalesced_with"] = coalesced_with
+                    # A prompt coalesced with a finished one is done already, its messages must not reach the client
+                    # before the response telling it the prompt_id
+                    resp = web.json_response(response)
+                    await resp.prepare(request)
+                    await resp.write_eof()
+                    self.prompt_queue.announce_coalesced(prompt_id)
+                    return resp
                 else:
                     logging.warning("invalid prompt: {}".format(valid[1]))
                     return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
@@ -713,6 +803,80 @@ class PromptServer():
                 }
                 return web.json_response({"error": error, "node_errors": {}}, status=400)
 
+        @routes.post("/prompt/sweep")
+        async def post_prompt_sweep(request):
+            logging.info("got prompt sweep")
+            json_data = await request.json()
+            json_data = self.trigger_on_prompt(json_data)
+
+            if "prompt" not in json_data:
+                error = {
+                    "type": "no_prompt",
+                    "message": "No prompt provided",
+                    "details": "No prompt provided",
+                    "extra_info": {}
+                }
+                return web.json_response({"error": error, "node_errors": {}}, status=400)
+
+            prompt = json_data["prompt"]
+            sweep_id = str(json_data.get("sweep_id", uuid.uuid4()))
+            def sweep_error(message):
+                error = {
+                    "type": "invalid_sweep",
+                    "message": "Invalid sweep",
+                    "details": message,
+                    "extra_info": {}
+                }
+                return web.json_response({"error": error, "node_errors": {}}, status=400)
+
+            mode = json_data.get("mode", "grid")
+            try:
+                parameters = parse_sweep_parameters(prompt, json_data.get("parameters"))
+                get_variant_count(parameters, mode)
+            except SweepError as e:
+                return sweep_error(str(e))
+
+            # The base prompt is validated once, then only the swept values
+            valid = await execution.validate_prompt(sweep_id, prompt, json_data.get("partial_execution_targets"))
+            if not valid[0]:
+                logging.warning("invalid prompt: {}".format(valid[1]))
+                return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+            parameters, node_errors = await validate_sweep_values(sweep_id, prompt, parameters, mode)
+            if len(node_errors) > 0:
+                error = {
+                    "type": "sweep_values_failed_validation",
+                    "message": "Sweep values failed validation",
+                    "details": "\n".join(f"{e['message']}: {e['details']}" for errors in node_errors.values() for e in errors["errors"]),
+                    "extra_info": {}
+                }
+                return web.json_response({"error": error, "node_errors": node_errors}, status=400)
+
+            outputs_to_execute = valid[2]
+            try:
+                variants = expand_sweep(prompt, parameters, outputs_to_execute, mode, json_data.get("order", "cache"))
+            except SweepError as e:
+                return sweep_error(str(e))
+
+            extra_data = json_data.get("extra_data", {})
+            if "client_id" in json_data:
+                extra_data["client_id"] = json_data["client_id"]
+            # Frozen once, so the variants share the workflow and everything else in it
+            extra_data = freeze(extra_data)
+
+            first_number = self.number
+            self.number += len(variants)
+            response = []
+            for index, (variant, values) in enumerate(variants):
+                number = first_number + index
+                if json_data.get("front", False):
+                    # Still in sweep order, ahead of everything else
+                    number = -(first_number + len(variants) - 1 - index)
+                prompt_id = str(uuid.uuid4())
+                variant_extra_data = extra_data.set("sweep", {"sweep_id": sweep_id, "index": index, "values": values})
+                self.prompt_queue.put((number, prompt_id, variant, variant_extra_data, outputs_to_execute))
+                response.append({"prompt_id": prompt_id, "number": number, "values": values})
+            return web.json_response({"sweep_id": sweep_id, "prompts": response, "node_errors": valid[3]})
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
@@ -729,7 +893,18 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            json_data = {}
+            if request.can_read_body:
+                try:
+                    json_data = await request.json()
+                except json.JSONDecodeError:
+                    pass
+            prompt_id = json_data.get("prompt_id") if isinstance(json_data, dict) else None
+            if prompt_id is not None:
+                # Only that prompt, the other prompt workers keep executing theirs
+                comfy.model_management.interrupt_prompt_processing(str(prompt_id))
+            else:
+                nodes.interrupt_processing()
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -804,6 +979,42 @@ class PromptServer():
             web.static('/', self.web_root),
         ])
 
+    def collect_metrics(self):
+        running, queued = self.prompt_queue.get_current_queue_volatile()
+        yield MetricFamily("comfyui_queue_pending", "gauge", "Prompts waiting in the queue", [({}, len(queued))])
+        yield MetricFamily("comfyui_queue_running", "gauge", "Prompts currently executing", [({}, len(running))])
+
+        workers = self.worker_pool.workers if self.worker_pool is not None else []
+        entries = []
+        cache_bytes = []
+        disk_bytes = []
+        for worker in workers:
+            caches = worker.executor.caches
+            for name in ("outputs", "ui", "objects"):
+                entries.append(({"worker": worker.name, "cache": name}, getattr(caches, name).get_entry_count()))
+            if hasattr(caches.outputs, "get_memory_usage"):
+                usage = caches.outputs.get_memory_usage()
+                cache_bytes.append(({"worker": worker.name, "memory": "ram"}, usage["ram_used"]))
+                cache_bytes.append(({"worker": worker.name, "memory": "vram"}, usage["vram_used"]))
+            if caches.spill_tier is not None:
+                disk_bytes.append(({"worker": worker.name, "store": "spill"}, caches.spill_tier.size))
+        if self.worker_pool is not None and self.worker_pool.persistent_store is not None:
+            disk_bytes.append(({"worker": "shared", "store": "persistent"}, self.worker_pool.persistent_store.size))
+        yield MetricFamily("comfyui_cache_entries", "gauge", "Entries held by the node caches of each worker", entries)
+        yield MetricFamily("comfyui_cache_bytes", "gauge", "Memory held by byte budgeted output caches", cache_bytes)
+        yield MetricFamily("comfyui_cache_disk_bytes", "gauge", "Size of the on-disk output cache tiers", disk_bytes)
+
+        loaded_models = {}
+        loaded_bytes = {}
+        for loaded_model in list(comfy.model_management.current_loaded_models):
+            if loaded_model.model is None:
+                continue
+            device = str(loaded_model.device)
+            loaded_models[device] = loaded_models.get(device, 0) + 1
+            loaded_bytes[device] = loaded_bytes.get(device, 0) + loaded_model.model_loaded_memory()
+        yield MetricFamily("comfyui_loaded_models", "gauge", "Models loaded by comfy.model_management", [({"device": d}, v) for d, v in loaded_models.items()])
+        yield MetricFamily("comfyui_loaded_model_bytes", "gauge", "Memory used by the loaded models", [({"device": d}, v) for d, v in loaded_bytes.items()])
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
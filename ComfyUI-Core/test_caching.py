@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Regression tests for node signatures, the output caches and the validation cache
+"""
+
+import sys
+import os
+import asyncio
+import hashlib
+
+import pytest
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+
+class ConstNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT", {"default": 0, "min": 0, "max": 1000})}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, value):
+        return (value,)
+
+
+class AddNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"a": ("INT",), "b": ("INT",)}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, a, b):
+        return (a + b,)
+
+
+class OutputNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"a": ("INT",)}}
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self, a):
+        return {"ui": {"value": [a]}}
+
+
+TEST_NODES = {"TestCacheConst": ConstNode, "TestCacheAdd": AddNode, "TestCacheOutput": OutputNode}
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    import nodes
+    for name, class_def in TEST_NODES.items():
+        monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, name, class_def)
+
+
+class NoIsChanged:
+    async def get(self, node_id):
+        return False
+
+
+def make_prompt(a=1, b=100):
+    return {
+        "1": {"class_type": "TestCacheConst", "inputs": {"value": a}},
+        "2": {"class_type": "TestCacheConst", "inputs": {"value": b}},
+        "3": {"class_type": "TestCacheAdd", "inputs": {"a": ["1", 0], "b": ["2", 0]}},
+        "4": {"class_type": "TestCacheOutput", "inputs": {"a": ["3", 0]}},
+    }
+
+
+def get_signatures(prompt):
+    from comfy_execution.graph import DynamicPrompt
+    from comfy_execution.caching import CacheKeySetInputSignature
+
+    async def sign():
+        dynprompt = DynamicPrompt(prompt)
+        key_set = CacheKeySetInputSignature(dynprompt, list(prompt.keys()), NoIsChanged())
+        await key_set.add_keys(list(prompt.keys()))
+        return {node_id: key_set.get_data_key(node_id) for node_id in prompt}
+    return asyncio.run(sign())
+
+
+def make_cache(cache_class, prompt, *args, **kwargs):
+    from comfy_execution.caching import CacheKeySetInputSignature
+    cache = cache_class(CacheKeySetInputSignature, *args, **kwargs)
+    set_prompt(cache, prompt)
+    return cache
+
+
+def set_prompt(cache, prompt):
+    from comfy_execution.graph import DynamicPrompt
+    asyncio.run(cache.set_prompt(DynamicPrompt(prompt), list(prompt.keys()), NoIsChanged()))
+
+
+def test_signatures_are_stable():
+    """The same graph gets the same signatures, whatever the node ids and input order"""
+    first = get_signatures(make_prompt())
+    assert first == get_signatures(make_prompt())
+
+    renamed = {
+        "b": {"class_type": "TestCacheAdd", "inputs": {"b": ["c", 0], "a": ["d", 0]}},
+        "d": {"class_type": "TestCacheConst", "inputs": {"value": 1}},
+        "c": {"class_type": "TestCacheConst", "inputs": {"value": 100}},
+    }
+    assert get_signatures(renamed)["b"] == first["3"]
+
+
+def test_signatures_follow_ancestors():
+    """Changing an input changes the signature of the node and of everything downstream only"""
+    first = get_signatures(make_prompt())
+    changed = get_signatures(make_prompt(b=5))
+    assert changed["1"] == first["1"]
+    assert changed["2"] != first["2"]
+    assert changed["3"] != first["3"]
+    assert changed["4"] != first["4"]
+
+
+def test_signature_hash_of_mixed_key_dicts():
+    """Dicts whose keys can't be compared with each other are hashed independently of their order"""
+    from comfy_execution.caching import update_signature_hash
+
+    def digest(value):
+        hasher = hashlib.blake2b(digest_size=20)
+        assert update_signature_hash(hasher, value)
+        return hasher.hexdigest()
+
+    assert digest({1: "a", "1": "b", None: "c"}) == digest({None: "c", "1": "b", 1: "a"})
+    assert digest({1: "a", "1": "b"}) != digest({1: "b", "1": "a"})
+    assert digest({"a": [1, 2]}) != digest({"a": [2, 1]})
+    assert not update_signature_hash(hashlib.blake2b(), {"a": float("nan")})
+
+
+def test_byte_budget_cache_evicts_least_recently_used():
+    import torch
+    from comfy_execution.caching import ByteBudgetCache
+
+    size = 4000 * 4
+    cache = make_cache(ByteBudgetCache, make_prompt(a=1), ram_budget=int(size * 2.5), vram_budget=0)
+    cache.set("1", [torch.zeros(4000)])
+    set_prompt(cache, make_prompt(a=2))
+    cache.set("1", [torch.zeros(4000)])
+    set_prompt(cache, make_prompt(a=1))
+    assert cache.get("1") is not None
+    set_prompt(cache, make_prompt(a=3))
+    cache.set("1", [torch.zeros(4000)])
+
+    # The a=2 output is the least recently used one and goes first
+    assert cache.ram_used <= cache.ram_budget
+    set_prompt(cache, make_prompt(a=2))
+    assert cache.get("1") is None
+    set_prompt(cache, make_prompt(a=1))
+    assert cache.get("1") is not None
+
+
+def test_cost_aware_cache_keeps_expensive_outputs():
+    """GreedyDual-Size-Frequency evicts the output that is cheapest to recompute per byte first"""
+    import torch
+    from comfy_execution.caching import CostAwareCache
+
+    size = 4000 * 4
+    cache = make_cache(CostAwareCache, make_prompt(a=1), ram_budget=int(size * 2.5), vram_budget=0)
+    cache.set_execution_cost("1", 10.0)
+    cache.set("1", [torch.zeros(4000)])
+    for a, cost in ((2, 0.1), (3, 0.2)):
+        set_prompt(cache, make_prompt(a=a))
+        cache.set_execution_cost("1", cost)
+        cache.set("1", [torch.zeros(4000)])
+
+    # The oldest output is the most expensive one, LRU would have evicted it
+    set_prompt(cache, make_prompt(a=1))
+    assert cache.get("1") is not None
+    set_prompt(cache, make_prompt(a=2))
+    assert cache.get("1") is None
+
+
+def test_spill_round_trip(tmp_path):
+    import torch
+    from comfy_execution.caching import DiskSpillTier, LRUCache
+
+    tier = DiskSpillTier(str(tmp_path), 1024 ** 3)
+    value = [(torch.arange(6).reshape(2, 3),), [{"samples": torch.ones(1, 4), "batch_index": [0, 1]}, "text", 1.5, None]]
+    assert tier.store("key", value)
+    loaded = tier.load("key")
+    assert torch.equal(loaded[0][0], value[0][0])
+    assert isinstance(loaded[0], tuple)
+    assert torch.equal(loaded[1][0]["samples"], value[1][0]["samples"])
+    assert loaded[1][0]["batch_index"] == [0, 1]
+    assert loaded[1][1:] == ["text", 1.5, None]
+    # Values that aren't tensors, lists, dicts or primitives are not spilled
+    assert not tier.store("object", [object(), torch.ones(1)])
+
+    # An output evicted from a full LRU cache is loaded back from the tier
+    cache = make_cache(LRUCache, make_prompt(a=1), max_size=1, spill_tier=tier)
+    cache.set("1", [torch.full((3,), 1.0)])
+    set_prompt(cache, make_prompt(a=2))
+    cache.set("1", [torch.full((3,), 2.0)])
+    cache.clean_unused()
+    assert len(cache.cache) == 1
+    set_prompt(cache, make_prompt(a=1))
+    cache.clean_unused()
+    assert torch.equal(cache.get("1")[0], torch.full((3,), 1.0))
+
+
+def test_validation_cache_invalidation():
+    """Validations are reused until the schema of the node class is invalidated"""
+    import execution
+    from comfy_execution.node_schema import invalidate_node_schemas
+    from comfy_execution.validation_cache import validation_cache
+
+    def validate():
+        valid = asyncio.run(execution.validate_prompt("test", make_prompt(), None))
+        assert valid[0], valid[1]
+
+    validation_cache.clear()
+    validate()
+    hits = validation_cache.hits
+    validate()
+    assert validation_cache.hits > hits
+
+    invalidate_node_schemas(ConstNode)
+    misses = validation_cache.misses
+    validate()
+    assert validation_cache.misses == misses + 2
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the prompt queue: fair queueing, the queue journal and prompt coalescing
+"""
+
+import sys
+import os
+
+import pytest
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+
+class FakeServer:
+    """Records the messages the queue sends instead of sending them to websocket clients"""
+    def __init__(self):
+        self.client_id = None
+        self.messages = []
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data, sid))
+
+    def queue_updated(self):
+        pass
+
+
+def make_prompt(size=1, value=0):
+    return {str(i): {"class_type": "TestQueueNode", "inputs": {"value": value}} for i in range(size)}
+
+
+def take_all(queue):
+    order = []
+    while True:
+        taken = queue.get(timeout=0)
+        if taken is None:
+            return order
+        item, item_id = taken
+        order.append(item[1])
+        queue.task_done(item_id, {}, None)
+
+
+def test_fair_queue_deficit_round_robin(monkeypatch):
+    """Tenants take turns by weight and cost instead of by number"""
+    from comfy_execution import fair_queue
+    # A prompt is expected to take one second per node
+    monkeypatch.setattr(fair_queue, "estimate_prompt_cost", lambda prompt: float(len(prompt)))
+
+    queue = fair_queue.FairPromptQueue(FakeServer(), weights={"B": 2.0})
+    number = 0
+    for client_id, count, size in (("A", 4, 1), ("B", 4, 1), ("C", 2, 3)):
+        for i in range(count):
+            number += 1
+            # A puts its prompts in front of everyone else
+            queue.put((-number if client_id == "A" else number, f"{client_id}{i}", make_prompt(size), {"client_id": client_id}, []))
+
+    expected = ["A3", "B0", "B1", "A2", "B2", "B3", "A1", "C0", "A0", "C1"]
+    assert [item[1] for item in queue.peek_items(32)] == expected
+    assert take_all(queue) == expected
+
+
+def test_fair_queue_max_running():
+    from comfy_execution.fair_queue import FairPromptQueue
+
+    queue = FairPromptQueue(FakeServer(), default_max_running=1)
+    for i, client_id in enumerate(("A", "A", "B")):
+        queue.put((i, f"{client_id}{i}", make_prompt(), {"client_id": client_id}, []))
+
+    first, first_id = queue.get(timeout=0)
+    second, _ = queue.get(timeout=0)
+    assert (first[1], second[1]) == ("A0", "B2")
+    # A is at its limit until its running prompt is done
+    assert queue.get(timeout=0) is None
+    queue.task_done(first_id, {}, None)
+    assert queue.get(timeout=0)[0][1] == "A1"
+
+
+def test_queue_journal_recovery(tmp_path):
+    """Prompts queued or executing when the process stops are recovered, in order and without secrets"""
+    import execution
+    from comfy_execution.queue_journal import QueueJournal
+
+    path = str(tmp_path / "journal.db")
+    queue = execution.PromptQueue(FakeServer())
+    journal = QueueJournal(path, sensitive_keys=execution.SENSITIVE_EXTRA_DATA_KEYS)
+    queue.attach_journal(journal)
+    for i in range(5):
+        queue.put((i, f"p{i}", make_prompt(value=i), {"client_id": "c", "api_key_comfy_org": "secret"}, ["0"]))
+    done, done_id = queue.get(timeout=0)
+    queue.task_done(done_id, {}, None)
+    queue.get(timeout=0)  # still executing
+    queue.delete_queue_item(lambda item: item[1] == "p3")
+    journal.flush()
+    # The process stops without closing the journal
+
+    recovered = QueueJournal(path).recover()
+    assert [item[1] for item in recovered] == ["p1", "p2", "p4"]
+    assert recovered[0][2] == make_prompt(value=1)
+    assert recovered[0][3] == {"client_id": "c"}
+    assert recovered[0][4] == ["0"]
+
+    # A queue attached to the journal queues the recovered prompts again
+    queue = execution.PromptQueue(FakeServer())
+    assert len(queue.attach_journal(QueueJournal(path))) == 3
+    assert take_all(queue) == ["p1", "p2", "p4"]
+
+
+def test_coalesced_followers_run_when_the_leader_fails():
+    """The first follower of a failed prompt is executed instead and the others get its results"""
+    import execution
+    from comfy_execution.coalescing import PromptCoalescer
+
+    server = FakeServer()
+    queue = execution.PromptQueue(server)
+    queue.attach_coalescer(PromptCoalescer())
+    digest = "digest"
+    assert queue.put((0, "leader", make_prompt(), {}, ["0"]), digest=digest) is None
+    assert queue.put((1, "f1", make_prompt(), {}, ["0"]), digest=digest) == "leader"
+    assert queue.put((2, "f2", make_prompt(), {"client_id": "client"}, ["0"]), digest=digest) == "leader"
+    assert queue.get_tasks_remaining() == 3
+
+    item, item_id = queue.get(timeout=0)
+    assert item[1] == "leader"
+    queue.task_done(item_id, {"outputs": {}, "meta": {}}, execution.PromptQueue.ExecutionStatus("error", False, []))
+    assert "f2" not in queue.get_history()
+
+    item, item_id = queue.get(timeout=0)
+    assert item[1] == "f1"
+    assert queue.get(timeout=0) is None
+    outputs = {"0": {"value": [1]}}
+    queue.task_done(item_id, {"outputs": outputs, "meta": {}}, execution.PromptQueue.ExecutionStatus("success", True, []))
+
+    history = queue.get_history()
+    assert history["f2"]["outputs"] == outputs
+    assert history["f2"]["coalesced_with"] == "f1"
+    assert [event for event, _, sid in server.messages if sid == "client"] == ["execution_start", "execution_cached", "executed", "execution_success", "executing"]
+    assert queue.get_tasks_remaining() == 0
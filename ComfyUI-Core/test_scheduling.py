@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the order in which ready nodes are executed
+"""
+
+import sys
+import os
+import asyncio
+
+import pytest
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+
+class ConstNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT",)}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, value):
+        return (value,)
+
+
+class SlowNode(ConstNode):
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"a": ("INT",)}}
+
+    def run(self, a):
+        return (a,)
+
+
+class FastNode(SlowNode):
+    pass
+
+
+class AsyncNode(SlowNode):
+    async def run(self, a):
+        return (a,)
+
+
+class OutputNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"a": ("INT",)}}
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self, a):
+        return {}
+
+
+TEST_NODES = {
+    "TestOrderConst": ConstNode,
+    "TestOrderSlow": SlowNode,
+    "TestOrderFast": FastNode,
+    "TestOrderAsync": AsyncNode,
+    "TestOrderOutput": OutputNode,
+}
+
+
+@pytest.fixture(autouse=True)
+def test_nodes(monkeypatch):
+    import nodes
+    for name, class_def in TEST_NODES.items():
+        monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, name, class_def)
+
+
+class NoCache:
+    def get(self, node_id):
+        return None
+
+
+def node(class_type, **inputs):
+    return {"class_type": class_type, "inputs": inputs}
+
+
+def get_execution_order(execution_list, outputs):
+    """Execute every node serially and return the order they were picked in"""
+    for node_id in outputs:
+        execution_list.add_node(node_id)
+    order = []
+
+    async def run():
+        while not execution_list.is_empty():
+            node_id, error, _ = await execution_list.stage_node_execution()
+            assert error is None, error
+            order.append(node_id)
+            execution_list.complete_node_execution()
+    asyncio.run(run())
+    return order
+
+
+def test_ready_order():
+    """Output nodes first, then the nodes closest to an output, otherwise in the order they became ready"""
+    from comfy_execution.graph import DynamicPrompt, ExecutionList
+
+    prompt = {
+        "c1": node("TestOrderConst", value=1),
+        "c2": node("TestOrderConst", value=2),
+        "far": node("TestOrderFast", a=["c1", 0]),
+        "near": node("TestOrderFast", a=["far", 0]),
+        "out1": node("TestOrderOutput", a=["near", 0]),
+        "out2": node("TestOrderOutput", a=["c2", 0]),
+    }
+    order = get_execution_order(ExecutionList(DynamicPrompt(prompt), NoCache()), ["out1", "out2"])
+    assert order == ["c2", "out2", "c1", "far", "near", "out1"]
+
+
+def test_async_nodes_are_picked_first():
+    from comfy_execution.graph import DynamicPrompt, ExecutionList
+
+    prompt = {
+        "c": node("TestOrderConst", value=1),
+        "fast": node("TestOrderFast", a=["c", 0]),
+        "async": node("TestOrderAsync", a=["c", 0]),
+        "out1": node("TestOrderOutput", a=["fast", 0]),
+        "out2": node("TestOrderOutput", a=["async", 0]),
+    }
+    order = get_execution_order(ExecutionList(DynamicPrompt(prompt), NoCache()), ["out1", "out2"])
+    assert order.index("async") == 1
+
+
+def test_critical_path_order():
+    """The ready node with the longest expected path to an output is picked first"""
+    from comfy_execution.graph import DynamicPrompt
+    from comfy_execution.scheduling import CriticalPathExecutionList, NodeTimingStats
+
+    timing_stats = NodeTimingStats()
+    timing_stats.record("TestOrderConst", 0.01)
+    timing_stats.record("TestOrderFast", 0.1)
+    timing_stats.record("TestOrderSlow", 5.0)
+    timing_stats.record("TestOrderOutput", 0.01)
+    prompt = {
+        "c1": node("TestOrderConst", value=1),
+        "fast1": node("TestOrderFast", a=["c1", 0]),
+        "fast2": node("TestOrderFast", a=["fast1", 0]),
+        "out1": node("TestOrderOutput", a=["fast2", 0]),
+        "c2": node("TestOrderConst", value=2),
+        "slow": node("TestOrderSlow", a=["c2", 0]),
+        "out2": node("TestOrderOutput", a=["slow", 0]),
+    }
+    order = get_execution_order(CriticalPathExecutionList(DynamicPrompt(prompt), NoCache(), timing_stats=timing_stats), ["out1", "out2"])
+    assert order[:2] == ["c2", "slow"]
+
+
+def test_node_timing_stats():
+    from comfy_execution.scheduling import NodeTimingStats
+
+    timing_stats = NodeTimingStats(smoothing=0.5, default_estimate=2.0)
+    assert timing_stats.get_estimate("Unknown") == 2.0
+    timing_stats.record("A", 1.0)
+    timing_stats.record("A", 3.0)
+    timing_stats.record("B", 4.0)
+    assert timing_stats.get_estimate("A") == 2.0
+    # Classes that never ran are expected to take the mean
+    assert timing_stats.get_estimate("Unknown") == 3.0